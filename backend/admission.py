@@ -0,0 +1,370 @@
+"""
+准入控制模块
+按端点限制同时处理的请求数（有界等待队列 + 排队期限），以及按 (API 密钥, 模型) 的上游令牌桶；
+过载时立即拒绝（503 / 429）并给出建议的重试等待时间
+"""
+import os
+import math
+import time
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Tuple
+
+
+# Retry-After 的范围（秒）
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 120
+
+
+class Overloaded(Exception):
+    """请求因过载被拒绝"""
+    
+    def __init__(self, message: str, retry_after: float = MIN_RETRY_AFTER, status: int = 503,
+                 reason: str = 'queue_full'):
+        """
+        Args:
+            message: 错误信息
+            retry_after: 建议的重试等待秒数（取整到 [MIN_RETRY_AFTER, MAX_RETRY_AFTER]）
+            status: 响应状态码，服务端饱和为 503，超过速率限制为 429
+            reason: 拒绝原因 queue_full / queue_timeout / rate_limited
+        """
+        super().__init__(message)
+        self.retry_after = min(max(math.ceil(retry_after), MIN_RETRY_AFTER), MAX_RETRY_AFTER)
+        self.status = status
+        self.reason = reason
+
+
+class ServiceTime:
+    """请求处理耗时的指数移动平均，用于估算排到的等待时间"""
+    
+    def __init__(self, initial: float = 1.0, alpha: float = 0.2):
+        self.average = initial
+        self.alpha = alpha
+        self._lock = threading.Lock()
+    
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.average += self.alpha * (seconds - self.average)
+    
+    def retry_after(self, queued: int, concurrency: int) -> float:
+        """前面有 queued 个请求、同时处理 concurrency 个时，预计多久后能开始处理"""
+        return self.average * (queued + 1) / max(concurrency, 1)
+
+
+class ConcurrencyLimiter:
+    """单个端点的并发上限 + 有界等待队列（先到先得），队列满或排队超过期限时拒绝"""
+    
+    def __init__(self, name: str, concurrency: int, max_queue: int = 32,
+                 queue_timeout: float = 30.0):
+        """
+        Args:
+            name: 端点名称
+            concurrency: 同时处理的请求数
+            max_queue: 等待队列长度，0 表示并发已满时立即拒绝
+            queue_timeout: 最长排队秒数，0 表示不限
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'queue_timeout': 0}
+        self.service_time = ServiceTime()
+        self._waiters: Deque[Waiter] = deque()
+        self._cond = threading.Condition()
+    
+    def acquire(self) -> 'Permit':
+        """
+        占用一个处理名额，必要时排队等待（阻塞当前线程）
+        
+        Returns:
+            名额，处理结束后调用其 release
+        
+        Raises:
+            Overloaded: 等待队列已满，或排队超过 queue_timeout
+        """
+        with self._cond:
+            if self.active < self.concurrency and not self._waiters:
+                return self._admit()
+            
+            waiter = self._enqueue(Waiter())
+            deadline = time.monotonic() + self.queue_timeout if self.queue_timeout > 0 else None
+            while waiter.permit is None:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise self._expire(waiter)
+                self._cond.wait(remaining)
+            return waiter.permit
+    
+    async def acquire_async(self) -> 'Permit':
+        """
+        acquire 的异步版本：在事件循环中排队，不占用线程；与 acquire 共用同一个等待队列
+        
+        Returns:
+            名额，处理结束后调用其 release
+        
+        Raises:
+            Overloaded: 等待队列已满，或排队超过 queue_timeout
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.active < self.concurrency and not self._waiters:
+                return self._admit()
+            waiter = self._enqueue(Waiter(loop.create_future()))
+        
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # 调用方被取消：已转交的名额立即归还，未转交的退出队列
+            with self._cond:
+                if waiter.permit is None:
+                    self._waiters.remove(waiter)
+            if waiter.permit is not None:
+                waiter.permit.release()
+            raise
+        
+        with self._cond:
+            # 超时与转交可能同时发生，以是否已转交为准
+            if waiter.permit is None:
+                raise self._expire(waiter)
+            return waiter.permit
+    
+    def _enqueue(self, waiter: 'Waiter') -> 'Waiter':
+        """加入等待队列（调用方持有锁），队列已满时拒绝"""
+        if len(self._waiters) >= self.max_queue:
+            self.rejected['queue_full'] += 1
+            raise Overloaded(f'处理中的请求已达上限（{self.concurrency}），等待队列已满',
+                             self._retry_after())
+        self._waiters.append(waiter)
+        return waiter
+    
+    def _expire(self, waiter: 'Waiter') -> Overloaded:
+        """排队超时的等待者退出队列（调用方持有锁）"""
+        self._waiters.remove(waiter)
+        self.rejected['queue_timeout'] += 1
+        return Overloaded(f'排队超过 {self.queue_timeout:g} 秒', self._retry_after(),
+                          reason='queue_timeout')
+    
+    def _admit(self) -> 'Permit':
+        self.active += 1
+        self.admitted += 1
+        return Permit(self)
+    
+    def _release(self, permit: 'Permit') -> None:
+        with self._cond:
+            if permit.released:
+                return
+            permit.released = True
+            self.active -= 1
+            # 空出的名额按到达顺序直接转交给等待者
+            while self._waiters and self.active < self.concurrency:
+                waiter = self._waiters.popleft()
+                waiter.permit = self._admit()
+                if waiter.future is not None:
+                    waiter.future.get_loop().call_soon_threadsafe(waiter.wake)
+            self._cond.notify_all()
+        self.service_time.observe(time.monotonic() - permit.admitted_at)
+    
+    def _retry_after(self) -> float:
+        return self.service_time.retry_after(len(self._waiters), self.concurrency)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'concurrency': self.concurrency,
+                'maxQueue': self.max_queue,
+                'queueTimeout': self.queue_timeout,
+                'active': self.active,
+                'queued': len(self._waiters),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'averageSeconds': round(self.service_time.average, 3)
+            }
+
+
+class Waiter:
+    """排队中的请求，名额空出时由释放方直接转交；异步等待者通过 future 唤醒"""
+    
+    def __init__(self, future: Optional['asyncio.Future[None]'] = None):
+        self.future = future
+        self.permit: Optional[Permit] = None
+    
+    def wake(self) -> None:
+        if self.future is not None and not self.future.done():
+            self.future.set_result(None)
+
+
+class Permit:
+    """ConcurrencyLimiter 分配的处理名额，release 可以重复调用"""
+    
+    def __init__(self, limiter: ConcurrencyLimiter):
+        self.limiter = limiter
+        self.admitted_at = time.monotonic()
+        self.released = False
+    
+    def release(self) -> None:
+        self.limiter._release(self)
+
+
+class AdmissionController:
+    """按端点（Flask endpoint 名称）的并发限制，未配置的端点不限制"""
+    
+    def __init__(self, limiters: Optional[Dict[str, ConcurrencyLimiter]] = None):
+        self.limiters = limiters or {}
+    
+    @classmethod
+    def from_env(cls, defaults: Dict[str, int]) -> 'AdmissionController':
+        """
+        根据环境变量创建
+        
+        Args:
+            defaults: 端点名称 -> 默认并发数（0 表示默认不限制），
+                      可用 ADMISSION_<端点>_CONCURRENCY / _MAX_QUEUE / _QUEUE_TIMEOUT 覆盖
+        """
+        max_queue = int(os.getenv('ADMISSION_MAX_QUEUE', 32))
+        queue_timeout = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 30))
+        limiters = {}
+        for endpoint, concurrency in defaults.items():
+            prefix = f'ADMISSION_{endpoint.upper()}'
+            concurrency = int(os.getenv(f'{prefix}_CONCURRENCY', concurrency))
+            if concurrency > 0:
+                limiters[endpoint] = ConcurrencyLimiter(
+                    endpoint, concurrency,
+                    max_queue=int(os.getenv(f'{prefix}_MAX_QUEUE', max_queue)),
+                    queue_timeout=float(os.getenv(f'{prefix}_QUEUE_TIMEOUT', queue_timeout))
+                )
+        return cls(limiters)
+    
+    def get(self, endpoint: Optional[str]) -> Optional[ConcurrencyLimiter]:
+        return self.limiters.get(endpoint) if endpoint else None
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {endpoint: limiter.stats() for endpoint, limiter in self.limiters.items()}
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        预留一个令牌（调用方负责加锁）
+        
+        Returns:
+            需要等待的秒数；超过 max_wait 时不预留，返回 None
+        """
+        self.tokens = self.available()
+        self.updated = time.monotonic()
+        wait = max(1 - self.tokens, 0) / self.rate
+        if wait > max_wait:
+            return None
+        # 令牌数可以为负：后来的请求排在已预留的请求之后
+        self.tokens -= 1
+        return wait
+    
+    def available(self) -> float:
+        """当前令牌数（调用方负责加锁）"""
+        return min(self.burst, self.tokens + (time.monotonic() - self.updated) * self.rate)
+    
+    def wait_time(self) -> float:
+        """再取一个令牌需要等待的秒数（调用方负责加锁）"""
+        return max(1 - self.available(), 0) / self.rate
+
+
+class RateLimiter:
+    """按 (API 密钥, 模型) 的上游令牌桶，使请求速率不超过上游配额（线程安全）"""
+    
+    def __init__(self, rates: Dict[str, float], burst: float = 5, max_wait: float = 10.0):
+        """
+        Args:
+            rates: 模型 -> 每分钟请求数，未列出或为 0 的模型不限制
+            burst: 桶容量（允许的突发请求数）
+            max_wait: 令牌不足时最多等待的秒数，超过则拒绝（429）
+        """
+        self.rates = {model: rate for model, rate in rates.items() if rate > 0}
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._counters: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls, models: Iterable[str]) -> 'RateLimiter':
+        """
+        根据环境变量创建
+        
+        Args:
+            models: 上游模型名，可用 UPSTREAM_RATE_LIMIT_<模型> 单独配置每分钟请求数
+        """
+        default_rate = float(os.getenv('UPSTREAM_RATE_LIMIT', 0))
+        rates = {}
+        for model in models:
+            suffix = ''.join(char if char.isalnum() else '_' for char in model.upper())
+            rates[model] = float(os.getenv(f'UPSTREAM_RATE_LIMIT_{suffix}', default_rate))
+        return cls(
+            rates,
+            burst=float(os.getenv('UPSTREAM_RATE_BURST', 5)),
+            max_wait=float(os.getenv('UPSTREAM_RATE_MAX_WAIT', 10))
+        )
+    
+    @staticmethod
+    def key_id(api_key: Optional[str]) -> str:
+        """API 密钥的短指纹（统计和指标中不出现密钥本身）"""
+        return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:8]
+    
+    def reserve(self, api_key: Optional[str], model: str,
+                max_wait: Optional[float] = None) -> float:
+        """
+        为一次上游请求取一个令牌
+        
+        Args:
+            api_key: 上游 API 密钥
+            model: 上游模型名
+            max_wait: 最多等待的秒数，None 表示使用 self.max_wait
+        
+        Returns:
+            发出请求前需要等待的秒数（不超过 max_wait）
+        
+        Raises:
+            Overloaded: 令牌不足且等待时间超过 max_wait（429）
+        """
+        rate = self.rates.get(model)
+        if rate is None:
+            return 0.0
+        
+        key = (self.key_id(api_key), model)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate / 60, self.burst)
+                self._counters[key] = {'allowed': 0, 'delayed': 0, 'rejected': 0}
+            counters = self._counters[key]
+            wait = bucket.reserve(self.max_wait if max_wait is None else max_wait)
+            if wait is None:
+                counters['rejected'] += 1
+                raise Overloaded(f'模型 {model} 的请求速率超过上限（每分钟 {rate:g} 次）',
+                                 bucket.wait_time(), status=429, reason='rate_limited')
+            counters['delayed' if wait > 0 else 'allowed'] += 1
+            return wait
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            buckets = [dict(self._counters[key], key=key[0], model=key[1],
+                            tokens=round(bucket.available(), 2))
+                       for key, bucket in self._buckets.items()]
+        return {
+            'ratesPerMinute': dict(self.rates),
+            'burst': self.burst,
+            'maxWait': self.max_wait,
+            'buckets': buckets
+        }
@@ -0,0 +1,199 @@
+"""
+动画编码模块
+把处理后的帧（BGRA数组）编码为动画 GIF 或动画 WebP
+"""
+import io
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+import cv2
+
+from image_processor import parallel_map
+
+
+# 支持的动画格式及对应的 MIME 类型
+ANIMATION_MIMETYPES = {
+    'gif': 'image/gif',
+    'webp': 'image/webp'
+}
+
+# 低于该 alpha 值的像素在 GIF 中视为透明
+ALPHA_THRESHOLD = 128
+
+# GIF 调色板中保留给透明色的索引
+TRANSPARENT_INDEX = 255
+
+# 计算共享调色板时最多采样的像素数
+PALETTE_SAMPLE_PIXELS = 128 * 1024
+
+
+class AnimationEncoder:
+    """动画编码器"""
+    
+    @staticmethod
+    def build_shared_palette(frames: Sequence[np.ndarray],
+                             colors: int = TRANSPARENT_INDEX) -> np.ndarray:
+        """
+        从所有帧的不透明像素计算一个共享调色板
+        
+        所有帧使用同一调色板，避免逐帧量化造成的颜色闪烁。
+        
+        Args:
+            frames: 帧列表（BGRA格式）
+            colors: 调色板颜色数（不超过255，保留一个索引给透明色）
+        
+        Returns:
+            调色板数组（RGB格式，形状为 (颜色数, 3)）
+        """
+        colors = max(1, min(colors, TRANSPARENT_INDEX))
+        total = sum(int(np.count_nonzero(frame[:, :, 3] >= ALPHA_THRESHOLD)) for frame in frames)
+        if total == 0:
+            return np.zeros((1, 3), dtype=np.uint8)
+        
+        # 像素过多时按固定步长均匀采样
+        step = max(1, -(-total // PALETTE_SAMPLE_PIXELS))
+        samples = []
+        for frame in frames:
+            opaque = frame[frame[:, :, 3] >= ALPHA_THRESHOLD]
+            samples.append(opaque[::step, 2::-1])
+        pixels = np.ascontiguousarray(np.concatenate(samples))
+        
+        sample = Image.fromarray(pixels.reshape(1, -1, 3), 'RGB')
+        quantized = sample.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+        used = len(quantized.getcolors(colors) or [])
+        palette = np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)
+        return palette[:max(used, 1)]
+    
+    @staticmethod
+    def map_to_palette(frame: np.ndarray, palette: np.ndarray, dither: bool = False) -> np.ndarray:
+        """
+        把单帧映射到共享调色板
+        
+        Args:
+            frame: 帧（BGRA格式）
+            palette: build_shared_palette 返回的调色板
+            dither: 是否使用 Floyd-Steinberg 抖动
+        
+        Returns:
+            调色板索引数组，透明像素为 TRANSPARENT_INDEX
+        """
+        # 未使用的调色板项填充为第一个颜色，映射到这些项的像素可以无损改回索引0
+        full_palette = np.tile(palette[:1], (256, 1))
+        full_palette[:len(palette)] = palette
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(full_palette.tobytes())
+        
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB)
+        dither_mode = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+        indices = np.array(Image.fromarray(rgb, 'RGB').quantize(palette=palette_image,
+                                                                 dither=dither_mode))
+        indices[indices >= len(palette)] = 0
+        indices[frame[:, :, 3] < ALPHA_THRESHOLD] = TRANSPARENT_INDEX
+        return indices
+    
+    @classmethod
+    def encode_gif(cls, frames: Sequence[np.ndarray], delay: int = 100, loop: int = 0,
+                   colors: int = TRANSPARENT_INDEX, dither: bool = False,
+                   workers: Optional[int] = None) -> bytes:
+        """
+        编码动画 GIF
+        
+        Args:
+            frames: 帧列表（BGRA格式）
+            delay: 帧延迟（毫秒）
+            loop: 循环次数，0表示无限循环
+            colors: 共享调色板颜色数
+            dither: 是否使用抖动
+            workers: 逐帧映射调色板的线程数（结果顺序不变）
+        
+        Returns:
+            GIF 文件字节
+        """
+        if len(frames) == 0:
+            raise ValueError('没有可用的帧')
+        
+        palette = cls.build_shared_palette(frames, colors)
+        full_palette = np.zeros((256, 3), dtype=np.uint8)
+        full_palette[:len(palette)] = palette
+        
+        def to_indexed(frame: np.ndarray) -> Image.Image:
+            image = Image.fromarray(cls.map_to_palette(frame, palette, dither), 'P')
+            image.putpalette(full_palette.tobytes())
+            return image
+        
+        images = parallel_map(to_indexed, frames, workers)
+        
+        buffer = io.BytesIO()
+        images[0].save(
+            buffer,
+            format='GIF',
+            save_all=True,
+            append_images=images[1:],
+            duration=delay,
+            loop=loop,
+            transparency=TRANSPARENT_INDEX,
+            disposal=2,  # 每帧显示前恢复为背景（透明）
+            optimize=False
+        )
+        return buffer.getvalue()
+    
+    @staticmethod
+    def encode_webp(frames: Sequence[np.ndarray], delay: int = 100, loop: int = 0,
+                    quality: int = 90, lossless: bool = False,
+                    workers: Optional[int] = None) -> bytes:
+        """
+        编码动画 WebP（保留完整 alpha 通道）
+        
+        Args:
+            frames: 帧列表（BGRA格式）
+            delay: 帧延迟（毫秒）
+            loop: 循环次数，0表示无限循环
+            quality: 有损压缩质量（0-100）
+            lossless: 是否无损压缩
+            workers: 颜色转换的线程数（libwebp 的动画编码本身是串行的）
+        
+        Returns:
+            WebP 文件字节
+        """
+        if len(frames) == 0:
+            raise ValueError('没有可用的帧')
+        
+        images: List[Image.Image] = parallel_map(
+            lambda frame: Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGRA2RGBA), 'RGBA'),
+            frames, workers
+        )
+        
+        buffer = io.BytesIO()
+        images[0].save(
+            buffer,
+            format='WEBP',
+            save_all=True,
+            append_images=images[1:],
+            duration=delay,
+            loop=loop,
+            quality=quality,
+            lossless=lossless,
+            method=4
+        )
+        return buffer.getvalue()
+    
+    @classmethod
+    def encode(cls, frames: Sequence[np.ndarray], format: str = 'gif', delay: int = 100,
+               loop: int = 0, quality: int = 90, lossless: bool = False,
+               colors: int = TRANSPARENT_INDEX, dither: bool = False,
+               workers: Optional[int] = None) -> Tuple[bytes, str]:
+        """
+        按格式编码动画
+        
+        Returns:
+            (文件字节, MIME类型)
+        """
+        if format == 'gif':
+            data = cls.encode_gif(frames, delay, loop, colors=colors, dither=dither, workers=workers)
+        elif format == 'webp':
+            data = cls.encode_webp(frames, delay, loop, quality=quality, lossless=lossless,
+                                   workers=workers)
+        else:
+            raise ValueError(f'不支持的动画格式: {format}')
+        return data, ANIMATION_MIMETYPES[format]
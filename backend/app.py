@@ -1,25 +1,132 @@
+import io
 import os
 import re
+import base64
+import hashlib
+import functools
+import json
 import math
+import time
+import queue
+import zipfile
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Iterable, Iterator, List, Tuple
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, g, jsonify, request, send_file, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_cors import CORS
 from dotenv import load_dotenv
-import requests
 
-# 导入图像处理模块
+from admission import AdmissionController, Overloaded, RateLimiter
+from job_manager import Job, JobCancelled, JobManager
+from generation_cache import GenerationCache, SingleFlight
+from upstream_client import DEFAULT_TIMEOUTS, UPSTREAM_ERRORS, RateLimit, UpstreamClient
+from metrics import MetricsRegistry, StageTimer, timed
+
+# 图像处理模块（依赖 cv2 / numpy / PIL，导入较慢）在 load_image_processing 中按需导入，
+# 健康检查、API 信息和静态文件不需要等待
 IMAGE_PROCESSING_AVAILABLE = False
+IMAGE_PROCESSING_STATE = 'pending'  # pending / loading / ready / unavailable
+IMAGE_PROCESSING_TIMINGS: Dict[str, float] = {}
 ImageProcessor = None  # type: ignore
+MemoryTracker = None  # type: ignore
+ImageTooLargeError = None  # type: ignore
+get_result_cache = None  # type: ignore
+get_key_luts = None  # type: ignore
+FRAME_ENCODERS: Dict[str, Any] = {}
+resolve_encoder = None  # type: ignore
+AnimationEncoder = None  # type: ignore
+ANIMATION_MIMETYPES: Dict[str, str] = {}
+FrameInterpolator = None  # type: ignore
+INTERPOLATION_MODES: Tuple[str, ...] = ()
+MAX_INTERPOLATION_COUNT = 0
+DEFAULT_ATLAS_PADDING = 0
+MAX_ATLAS_PADDING = 0
+MAX_DEDUPE_THRESHOLD = 0
+BatchProcessor = None  # type: ignore
+batch_processor = None
+KeySessionStore = None  # type: ignore
+key_sessions = None
+_image_processing_lock = threading.Lock()
+
+
+def load_image_processing() -> bool:
+    """
+    导入图像处理模块（只导入一次，导入期间的并发调用会等待导入完成）
+    
+    Returns:
+        图像处理功能是否可用
+    """
+    global IMAGE_PROCESSING_AVAILABLE, IMAGE_PROCESSING_STATE, ImageProcessor, MemoryTracker, ImageTooLargeError
+    global get_result_cache, get_key_luts, FRAME_ENCODERS, resolve_encoder, AnimationEncoder, ANIMATION_MIMETYPES, FrameInterpolator
+    global INTERPOLATION_MODES, MAX_INTERPOLATION_COUNT, BatchProcessor, batch_processor, KeySessionStore, key_sessions
+    global DEFAULT_ATLAS_PADDING, MAX_ATLAS_PADDING, MAX_DEDUPE_THRESHOLD
+    
+    if IMAGE_PROCESSING_STATE in ('ready', 'unavailable'):
+        return IMAGE_PROCESSING_AVAILABLE
+    
+    with _image_processing_lock:
+        if IMAGE_PROCESSING_STATE in ('ready', 'unavailable'):
+            return IMAGE_PROCESSING_AVAILABLE
+        IMAGE_PROCESSING_STATE = 'loading'
+        started = time.perf_counter()
+        try:
+            from image_processor import ImageProcessor, MemoryTracker, get_result_cache  # type: ignore
+            from image_processor import FRAME_ENCODERS, resolve_encoder, ImageTooLargeError  # type: ignore
+            from animation_encoder import AnimationEncoder, ANIMATION_MIMETYPES  # type: ignore
+            from frame_interpolation import FrameInterpolator, INTERPOLATION_MODES, MAX_INTERPOLATION_COUNT  # type: ignore
+            from batch_processor import BatchProcessor  # type: ignore
+            from key_lut import get_key_luts  # type: ignore
+            from key_session import KeySessionStore  # type: ignore
+            from atlas import DEFAULT_ATLAS_PADDING, MAX_ATLAS_PADDING  # type: ignore
+            from frame_dedup import MAX_DEDUPE_THRESHOLD  # type: ignore
+        except ImportError as e:
+            print(f'警告: 图像处理模块不可用: {e}')
+            print('请安装依赖: pip install Pillow numpy opencv-python')
+            IMAGE_PROCESSING_STATE = 'unavailable'
+            return False
+        
+        # 批量处理进程池（BATCH_WORKERS 个进程，首次批量请求时启动）
+        batch_processor = BatchProcessor.from_env()  # type: ignore
+        # 抠图会话（每个服务进程各自保存）
+        key_sessions = KeySessionStore.from_env()  # type: ignore
+        IMAGE_PROCESSING_TIMINGS['importSeconds'] = round(time.perf_counter() - started, 3)
+        IMAGE_PROCESSING_AVAILABLE = True
+        IMAGE_PROCESSING_STATE = 'ready'
+        print(f"✓ 图像处理模块导入完成（{IMAGE_PROCESSING_TIMINGS['importSeconds']:.2f} 秒）")
+        return True
+
+
+def warm_up_image_processing() -> None:
+    """导入图像处理模块并处理一张很小的精灵图，提前完成 OpenCV 和编码器的初始化"""
+    if not load_image_processing():
+        return
+    
+    started = time.perf_counter()
+    try:
+        ImageProcessor.warmup()  # type: ignore
+    except Exception as e:
+        print(f'警告: 图像处理预热失败: {e}')
+        return
+    IMAGE_PROCESSING_TIMINGS['warmupSeconds'] = round(time.perf_counter() - started, 3)
+    print(f"✓ 图像处理预热完成（{IMAGE_PROCESSING_TIMINGS['warmupSeconds']:.2f} 秒）")
 
-try:
-    from image_processor import ImageProcessor  # type: ignore
-    IMAGE_PROCESSING_AVAILABLE = True
-except ImportError as e:
-    print(f'警告: 图像处理模块不可用: {e}')
-    print('请安装依赖: pip install Pillow numpy opencv-python')
+
+def start_image_processing(preload: Optional[str] = None) -> None:
+    """
+    服务启动时按 IMAGE_PRELOAD 加载图像处理模块
+    
+    Args:
+        preload: 'background'=后台线程导入并预热（默认），'eager'=同步导入并预热，
+                 'lazy'=首次图像请求时才导入；None时读取环境变量 IMAGE_PRELOAD
+    """
+    preload = preload or os.getenv('IMAGE_PRELOAD', 'background')
+    if preload == 'eager':
+        warm_up_image_processing()
+    elif preload == 'background':
+        threading.Thread(target=warm_up_image_processing, name='image-warmup', daemon=True).start()
 
 # 加载环境变量
 load_dotenv()
@@ -27,6 +134,9 @@ load_dotenv()
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
 CORS(app)
 
+# 请求体大小上限（MAX_REQUEST_BYTES，默认 128MB，0 表示不限制），超过时返回 413
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_REQUEST_BYTES', 128 * 1024 * 1024)) or None
+
 # 配置
 PORT = int(os.getenv('PORT', 3000))
 # 优先从系统环境变量读取，然后从.env文件读取
@@ -40,13 +150,34 @@ GEMINI_IMAGE_GEN_URL = f'{API_BASE}/v1beta/models/gemini-2.5-flash-image:generat
 GEMINI_IMAGE_EDIT_URL = f'{API_BASE}/v1beta/models/gemini-2.5-flash-image-preview:generateContent'
 GEMINI_3_PRO_IMAGE_URL = f'{API_BASE}/v1beta/models/gemini-3-pro-image-preview:generateContent'
 
-# 配置请求会话
-session = requests.Session()
-if PROXY_URL:
-    session.proxies = {
-        'http': PROXY_URL,
-        'https': PROXY_URL
-    }
+# 后台任务（AI 生成等耗时操作）
+job_manager = JobManager.from_env()
+
+# AI 生成结果缓存（GENERATION_CACHE_DIR 未配置时只合并并发请求）
+generation_cache = GenerationCache.from_env()
+generation_flight = SingleFlight()
+
+# 上游请求客户端（连接池、超时、重试、对冲）
+upstream = UpstreamClient.from_env(proxy_url=PROXY_URL, workers=job_manager.workers)
+
+# 准入控制：耗时端点的并发上限、等待队列和排队期限（ADMISSION_*，0 表示默认不限制），
+# 上游请求按 (API 密钥, 模型) 限速（UPSTREAM_RATE_*）
+admission = AdmissionController.from_env({
+    'process_image': os.cpu_count() or 1,
+    'encode_animation': os.cpu_count() or 1,
+    'process_batch': 2,
+    'create_key_session': 0,
+    'key_session_frames': 0,
+    'generate_sprite_animation': 0
+})
+upstream_limiter = RateLimiter.from_env(DEFAULT_TIMEOUTS)
+
+# 请求和处理阶段指标（/api/metrics）；SERVER_TIMING_ENABLED=true 时在响应头返回阶段耗时
+metrics = MetricsRegistry()
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+
+# 后台生成任务的指标端点标签（任务不属于某个请求）
+GENERATION_JOB_ENDPOINT = 'generate_sprite_animation_job'
 
 
 def load_prompt_template(template_name: str = 'default') -> Optional[str]:
@@ -95,16 +226,157 @@ def get_default_prompt_template() -> str:
     return '{prompt}'
 
 
+@app.before_request
+def start_request_timer():
+    """为每个请求创建阶段计时"""
+    g.request_started = time.perf_counter()
+    g.timer = StageTimer()
+
+
+@app.before_request
+def reject_oversized_request():
+    """声明的请求体大小超过上限时不读取请求体，直接返回 413"""
+    limit = app.config.get('MAX_CONTENT_LENGTH')
+    if limit and request.content_length and request.content_length > limit:
+        return request_too_large(RequestEntityTooLarge())
+
+
+@app.before_request
+def admit_request():
+    """耗时端点的准入控制：并发已满时排队，队列已满或排队超过期限时返回 503 和 Retry-After"""
+    limiter = admission.get(request.endpoint)
+    if limiter is None:
+        return None
+    
+    with g.timer.stage('queue'):
+        try:
+            g.admission = limiter.acquire()
+        except Overloaded as e:
+            return overloaded_response(e)
+    return None
+
+
+@app.after_request
+def release_admission(response):
+    """释放准入名额：普通响应在此释放，流式响应在发送结束或客户端断开时释放"""
+    permit = g.pop('admission', None)
+    if permit is None:
+        return response
+    if response.is_streamed:
+        # WSGI 服务器发送结束后会关闭响应；测试客户端等读完响应体但不关闭时同样释放
+        response.response = release_when_exhausted(response.response, permit.release)
+        response.call_on_close(permit.release)
+    else:
+        permit.release()
+    return response
+
+
+def release_when_exhausted(chunks: Iterable[Any], release: Callable[[], None]) -> Iterator[Any]:
+    """逐块转发响应体，读完或关闭时调用 release"""
+    try:
+        yield from chunks
+    finally:
+        release()
+
+
+@app.teardown_request
+def release_unsent_admission(exc):
+    """请求未生成响应就结束时释放准入名额"""
+    permit = g.pop('admission', None)
+    if permit is not None:
+        permit.release()
+
+
+def overloaded_payload(e: Overloaded) -> Dict[str, Any]:
+    """过载拒绝的响应数据"""
+    return {
+        'error': '请求过于频繁' if e.status == 429 else '服务繁忙',
+        'message': str(e),
+        'retryAfter': e.retry_after
+    }
+
+
+def set_retry_after(response, payload: Dict[str, Any]):
+    """错误数据带 retryAfter 时附加 Retry-After 响应头"""
+    if payload.get('retryAfter'):
+        response.headers['Retry-After'] = str(payload['retryAfter'])
+    return response
+
+
+def overloaded_response(e: Overloaded):
+    """过载拒绝响应（503 / 429 + Retry-After）"""
+    payload = overloaded_payload(e)
+    return set_retry_after(jsonify(payload), payload), e.status
+
+
+@app.after_request
+def record_request_metrics(response):
+    """记录请求计数、耗时、收发字节和阶段耗时"""
+    endpoint = request.endpoint or 'unknown'
+    started = g.get('request_started')
+    if started is not None:
+        metrics.observe('frameworker_request_duration_seconds', time.perf_counter() - started,
+                        endpoint=endpoint)
+    metrics.inc('frameworker_requests_total', endpoint=endpoint, status=str(response.status_code))
+    if request.content_length:
+        metrics.inc('frameworker_bytes_in_total', request.content_length, endpoint=endpoint)
+    if not response.is_streamed and response.content_length:
+        metrics.inc('frameworker_bytes_out_total', response.content_length, endpoint=endpoint)
+    
+    timer = g.get('timer')
+    if timer is not None and timer.stages:
+        metrics.record_stages(endpoint, timer)
+        if SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+
+def record_error(e: BaseException, endpoint: Optional[str] = None) -> None:
+    """按异常类型计数处理失败"""
+    metrics.inc('frameworker_errors_total', endpoint=endpoint or request.endpoint or 'unknown',
+                type=type(e).__name__)
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查"""
     return jsonify({
         'status': 'ok',
         'message': 'FrameWorker 后端服务运行正常',
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': datetime.utcnow().isoformat(),
+        'imageProcessing': dict(IMAGE_PROCESSING_TIMINGS, state=IMAGE_PROCESSING_STATE)
     })
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的指标"""
+    collect_admission_metrics()
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def collect_admission_metrics() -> None:
+    """把准入控制和上游限速的当前状态写入指标（处理中、排队数、拒绝数）"""
+    endpoints = admission.stats()
+    jobs = job_manager.stats()
+    endpoints[GENERATION_JOB_ENDPOINT] = {
+        'active': jobs[Job.RUNNING],
+        'queued': jobs[Job.QUEUED],
+        'rejected': jobs['rejected']
+    }
+    for endpoint, stats in endpoints.items():
+        metrics.set('frameworker_admission_active', stats['active'], endpoint=endpoint)
+        metrics.set('frameworker_admission_queue_depth', stats['queued'], endpoint=endpoint)
+        for reason, count in stats['rejected'].items():
+            metrics.set('frameworker_admission_rejected_total', count,
+                        endpoint=endpoint, reason=reason)
+    
+    for bucket in upstream_limiter.stats()['buckets']:
+        for outcome in ('allowed', 'delayed', 'rejected'):
+            metrics.set('frameworker_upstream_rate_limit_total', bucket[outcome],
+                        model=bucket['model'], key=bucket['key'], outcome=outcome)
+
+
 @app.route('/api/info', methods=['GET'])
 def api_info():
     """API 信息"""
@@ -121,12 +393,48 @@ def api_info():
         ],
         'endpoints': {
             'health': '/api/health',
+            'metrics': '/api/metrics',
             'info': '/api/info',
-            'aiImageKey': '/api/ai-image-key'
+            'aiImageKey': '/api/ai-image-key',
+            'processImage': '/api/process-image',
+            'processBatch': '/api/process-batch',
+            'encodeAnimation': '/api/encode-animation',
+            'generateSpriteAnimation': '/api/generate-sprite-animation',
+            'generateSpriteAnimationJob': '/api/jobs/generate-sprite-animation',
+            'job': '/api/jobs/<jobId>',
+            'keySessions': '/api/key-sessions',
+            'keySession': '/api/key-sessions/<sessionId>',
+            'keySessionKey': '/api/key-sessions/<sessionId>/key',
+            'cacheStats': '/api/cache/stats',
+            'admissionStats': '/api/admission/stats'
         }
     })
 
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """缓存统计：图像处理结果缓存、抠图查找表、抠图会话和 AI 生成缓存"""
+    generations = generation_cache.stats()
+    generations['sharedRequests'] = generation_flight.shared
+    return jsonify({
+        'results': get_result_cache().stats() if IMAGE_PROCESSING_AVAILABLE else None,  # type: ignore
+        'keyTables': get_key_luts().stats() if IMAGE_PROCESSING_AVAILABLE else None,  # type: ignore
+        'keySessions': key_sessions.stats() if IMAGE_PROCESSING_AVAILABLE else None,  # type: ignore
+        'generations': generations,
+        'upstream': upstream.stats()
+    })
+
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    """准入控制统计：各端点的并发和排队、AI 生成任务队列、上游限速"""
+    return jsonify({
+        'endpoints': admission.stats(),
+        'jobs': job_manager.stats(),
+        'upstreamRate': upstream_limiter.stats()
+    })
+
+
 @app.route('/api/ai-image-key', methods=['GET'])
 def get_ai_image_key():
     """获取 AI 图像生成密钥"""
@@ -142,254 +450,435 @@ def get_ai_image_key():
     })
 
 
-@app.route('/api/generate-sprite-animation', methods=['POST'])
-def generate_sprite_animation():
-    """AI 生成精灵图动画"""
+def validate_generation_request(data: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], int]]:
+    """校验 AI 生成请求，返回 (错误信息, 状态码)，校验通过时返回 None"""
+    if not data.get('prompt'):
+        return {
+            'error': '缺少必要参数',
+            'message': '请提供 prompt 参数'
+        }, 400
+    
+    if not AI_IMAGE_API_KEY:
+        return {
+            'error': 'API 密钥未配置',
+            'message': '请在 .env 文件中配置 AI_IMAGE_API_KEY'
+        }, 500
+    
+    if not load_image_processing():
+        return {
+            'error': '图像处理功能不可用',
+            'message': '请安装依赖: pip install Pillow numpy opencv-python'
+        }, 500
+    
     try:
-        data = request.get_json()
-        prompt = data.get('prompt')
-        frame_count = data.get('frameCount', 16)
-        model = data.get('model', 'gemini-2.5-image')
-        tolerance = data.get('tolerance', 50)  # 背景移除容差
-        loop_consistency = data.get('loopConsistency', True)  # 首尾帧一致性
+        parse_atlas(data)
+        parse_dedupe(data)
+    except ValueError as e:
+        return {
+            'error': '参数错误',
+            'message': str(e)
+        }, 400
+    
+    return None
+
+
+def upstream_headers() -> Dict[str, str]:
+    """上游请求头"""
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {AI_IMAGE_API_KEY}'
+    }
+
+
+def upstream_request(model: str, enhanced_prompt: str) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    上游生成请求的目标和请求体（同步和异步客户端共用）
+    
+    Args:
+        model: 模型名称
+        enhanced_prompt: 完整渲染后的 prompt
         
-        if not prompt:
-            return jsonify({
-                'error': '缺少必要参数',
-                'message': '请提供 prompt 参数'
-            }), 400
+    Returns:
+        (上游模型名（决定超时和耗时统计）, 请求地址, JSON 请求体)
+    """
+    if model == 'dalle':
+        # 使用 DALL-E 3
+        return 'dalle', DALLE_API_URL, {
+            'model': 'dall-e-3',
+            'prompt': enhanced_prompt,
+            'n': 1,
+            'size': '1024x1024',
+            'quality': 'standard',
+            'response_format': 'url'
+        }
+    
+    if model == 'gemini-2.5-image-preview':
+        # 使用 Gemini 2.5 Flash Image Preview
+        target, url = 'gemini-2.5-image-preview', GEMINI_IMAGE_EDIT_URL
+    elif model == 'gemini-3-pro-image-preview':
+        # 使用 Gemini 3 Pro Image Preview
+        target, url = 'gemini-3-pro-image-preview', GEMINI_3_PRO_IMAGE_URL
+    else:
+        # 使用 Gemini 2.5 Flash Image（默认）
+        target, url = 'gemini-2.5-image', GEMINI_IMAGE_GEN_URL
+    return target, url, {
+        'contents': [{
+            'parts': [{
+                'text': enhanced_prompt
+            }]
+        }],
+        'generationConfig': {
+            'responseModalities': ['IMAGE']
+        }
+    }
+
+
+def parse_dalle_image_url(result: Dict[str, Any]) -> str:
+    """DALL-E 响应中的图片临时链接"""
+    if result.get('data') and len(result['data']) > 0:
+        return result['data'][0]['url']
+    raise Exception('DALL-E API 返回数据格式错误')
+
+
+def parse_gemini_image(result: Dict[str, Any]) -> Tuple[bytes, str]:
+    """
+    解析 Gemini API 响应
+    
+    Returns:
+        (原始图片字节, MIME类型)
+    """
+    if (result.get('candidates') and 
+        len(result['candidates']) > 0 and
+        result['candidates'][0].get('content') and
+        result['candidates'][0]['content'].get('parts') and
+        len(result['candidates'][0]['content']['parts']) > 0):
         
-        if not AI_IMAGE_API_KEY:
-            return jsonify({
-                'error': 'API 密钥未配置',
-                'message': '请在 .env 文件中配置 AI_IMAGE_API_KEY'
-            }), 500
+        part = result['candidates'][0]['content']['parts'][0]
         
-        if not IMAGE_PROCESSING_AVAILABLE:
-            return jsonify({
-                'error': '图像处理功能不可用',
-                'message': '请安装依赖: pip install Pillow numpy opencv-python'
-            }), 500
-        
-        # 计算精灵图的行列数
-        cols = math.ceil(math.sqrt(frame_count))
-        rows = math.ceil(frame_count / cols)
-        
-        # 加载 prompt 模板
-        template_name = os.getenv('PROMPT_TEMPLATE_NAME', 'default')
-        prompt_template = load_prompt_template(template_name)
-        
-        if not prompt_template:
-            prompt_template = get_default_prompt_template()
-            print('使用内置默认模板')
-        
-        # 替换占位符
-        loop_consistency_text = ''
-        if loop_consistency:
-            loop_consistency_text = '''- **关键要求：首尾帧必须完全一致**
+        if part.get('inlineData') and part['inlineData'].get('data'):
+            base64_data = part['inlineData']['data']
+            mime_type = part['inlineData'].get('mimeType', 'image/png')
+        elif part.get('inline_data') and part['inline_data'].get('data'):
+            base64_data = part['inline_data']['data']
+            mime_type = part['inline_data'].get('mime_type', 'image/png')
+        else:
+            raise Exception('Gemini API 返回的图片数据格式错误：缺少 inlineData')
+    else:
+        raise Exception('Gemini API 返回数据格式错误：响应结构不完整')
+    
+    return base64.b64decode(base64_data), mime_type
+
+
+def upstream_rate_limit(target: str) -> RateLimit:
+    """上游模型的令牌桶（UPSTREAM_RATE_LIMIT），由上游客户端在每次实际发出请求前调用"""
+    return functools.partial(upstream_limiter.reserve, AI_IMAGE_API_KEY, target)
+
+
+def request_upstream_image(model: str, enhanced_prompt: str) -> Tuple[bytes, str]:
+    """
+    调用上游 AI 接口生成图片
+    
+    Args:
+        model: 模型名称
+        enhanced_prompt: 完整渲染后的 prompt
+        
+    Returns:
+        (原始图片字节, MIME类型)
+    
+    Raises:
+        Overloaded: 超过该模型的上游速率限制（UPSTREAM_RATE_LIMIT）
+    """
+    target, url, payload = upstream_request(model, enhanced_prompt)
+    response = upstream.post(target, url, rate_limit=upstream_rate_limit(target),
+                             json=payload, headers=upstream_headers())
+    response.raise_for_status()
+    
+    if model == 'dalle':
+        # DALL-E 返回的是临时链接，下载原始图片
+        image_response = upstream.get('dalle', parse_dalle_image_url(response.json()))
+        image_response.raise_for_status()
+        mime_type = image_response.headers.get('Content-Type', 'image/png').split(';')[0]
+        return image_response.content, mime_type
+    
+    return parse_gemini_image(response.json())
+
+
+def fetch_generated_image(model: str, enhanced_prompt: str,
+                          use_cache: bool = True) -> Tuple[bytes, str, str]:
+    """
+    获取生成的图片：先查磁盘缓存，并发的相同请求只调用一次上游
+    
+    Args:
+        model: 模型名称
+        enhanced_prompt: 完整渲染后的 prompt
+        use_cache: False 时跳过缓存和请求合并，总是重新生成
+        
+    Returns:
+        (原始图片字节, MIME类型, 缓存状态 hit/miss/shared/bypass)
+    """
+    if not use_cache:
+        image_data, mime_type = request_upstream_image(model, enhanced_prompt)
+        return image_data, mime_type, 'bypass'
+    
+    key = GenerationCache.make_key(model, enhanced_prompt)
+    
+    def load() -> Tuple[bytes, str, str]:
+        cached = generation_cache.get(key)
+        if cached:
+            return cached[0], cached[1], 'hit'
+        image_data, mime_type = request_upstream_image(model, enhanced_prompt)
+        generation_cache.put(key, image_data, mime_type)
+        return image_data, mime_type, 'miss'
+    
+    (image_data, mime_type, cache_status), shared = generation_flight.do(key, load)
+    return image_data, mime_type, 'shared' if shared else cache_status
+
+
+def generation_grid(data: Dict[str, Any]) -> Tuple[int, int]:
+    """按帧数计算精灵图的 (行数, 列数)"""
+    frame_count = data.get('frameCount', 16)
+    cols = math.ceil(math.sqrt(frame_count))
+    rows = math.ceil(frame_count / cols)
+    return rows, cols
+
+
+def render_generation_prompt(data: Dict[str, Any]) -> str:
+    """按 PROMPT_TEMPLATE_NAME 模板渲染发送给上游的完整 prompt"""
+    prompt = data.get('prompt')
+    frame_count = data.get('frameCount', 16)
+    loop_consistency = data.get('loopConsistency', True)  # 首尾帧一致性
+    rows, cols = generation_grid(data)
+    
+    # 加载 prompt 模板
+    template_name = os.getenv('PROMPT_TEMPLATE_NAME', 'default')
+    prompt_template = load_prompt_template(template_name)
+    
+    if not prompt_template:
+        prompt_template = get_default_prompt_template()
+        print('使用内置默认模板')
+    
+    # 替换占位符
+    loop_consistency_text = ''
+    if loop_consistency:
+        loop_consistency_text = '''- **关键要求：首尾帧必须完全一致**
   * 第一帧（左上角第一个格子）和最后一帧（右下角最后一个格子）必须是完全相同的画面
   * 这两帧应该展示动作循环的起始/结束状态
   * 确保动画可以无缝循环播放'''
+    
+    enhanced_prompt = prompt_template\
+        .replace('{rows}', str(rows))\
+        .replace('{cols}', str(cols))\
+        .replace('{frameCount}', str(frame_count))\
+        .replace('{prompt}', prompt)\
+        .replace('{loopConsistency}', loop_consistency_text)
+    return enhanced_prompt
+
+
+def report_generation_stage(job: Job, emit: Optional[Callable[[Dict[str, Any]], None]],
+                            stage: str, completed: Optional[int] = None,
+                            total: Optional[int] = None) -> None:
+    """检查取消并更新任务进度；流式模式下进入新阶段时发送 stage 事件"""
+    job.check_cancelled()
+    job.set_progress(stage, completed, total)
+    if emit is not None and completed is None:
+        emit({'event': 'stage', 'stage': stage})
+
+
+def run_sprite_generation(job: Job, data: Dict[str, Any],
+                          emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+                          timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    """
+    执行 AI 精灵图生成和背景移除（在任务线程中运行，不依赖请求上下文）
+    
+    Args:
+        job: 当前任务，用于上报进度和检查取消
+        data: 请求参数
+        emit: 流式事件回调（可选）。提供时每个阶段和每一帧编码完成后立即回调，
+              返回的响应数据不再包含 frames
+        timer: 阶段计时（可选），记录 upstream、image_decode、key、encode 和 compose 阶段
         
-        enhanced_prompt = prompt_template\
-            .replace('{rows}', str(rows))\
-            .replace('{cols}', str(cols))\
-            .replace('{frameCount}', str(frame_count))\
-            .replace('{prompt}', prompt)\
-            .replace('{loopConsistency}', loop_consistency_text)
-        
-        # 配置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {AI_IMAGE_API_KEY}'
-        }
+    Returns:
+        响应数据，见 process_generated_image
+    """
+    enhanced_prompt = render_generation_prompt(data)
+    report_generation_stage(job, emit, 'upstream')
+    with timed(timer, 'upstream'):
+        image_data, mime_type, cache_status = fetch_generated_image(
+            data.get('model', 'gemini-2.5-image'), enhanced_prompt,
+            use_cache=not data.get('noCache', False)
+        )
+    return process_generated_image(job, data, enhanced_prompt, image_data, mime_type,
+                                   cache_status, emit, timer)
+
+
+def process_generated_image(job: Job, data: Dict[str, Any], enhanced_prompt: str,
+                            image_data: bytes, mime_type: str, cache_status: str,
+                            emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+                            timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    """
+    对上游返回的精灵图去除背景并编码（CPU 密集，同步和异步服务模式共用）
+    
+    Args:
+        job: 当前任务，用于上报进度和检查取消
+        data: 请求参数
+        enhanced_prompt: 发送给上游的完整 prompt
+        image_data: 上游返回的原始图片字节
+        mime_type: 图片的 MIME 类型
+        cache_status: 生成缓存状态（见 fetch_generated_image）
+        emit: 流式事件回调（可选），见 run_sprite_generation
+        timer: 阶段计时（可选）
         
-        image_url = None
-        
-        if model == 'dalle':
-            # 使用 DALL-E 3
-            response = session.post(
-                DALLE_API_URL,
-                json={
-                    'model': 'dall-e-3',
-                    'prompt': enhanced_prompt,
-                    'n': 1,
-                    'size': '1024x1024',
-                    'quality': 'standard',
-                    'response_format': 'url'
-                },
-                headers=headers,
-                timeout=120
+    Returns:
+        响应数据；output=atlas 时以图集（atlas、manifest）代替 frames 和 imageUrl；
+        dedupe 时 frames 只含不同的帧，另加 frameRefs
+    """
+    prompt = data.get('prompt')
+    frame_count = data.get('frameCount', 16)
+    model = data.get('model', 'gemini-2.5-image')
+    tolerance = data.get('tolerance', 50)  # 背景移除容差
+    rows, cols = generation_grid(data)
+    
+    def set_stage(stage: str, completed: Optional[int] = None, total: Optional[int] = None) -> None:
+        report_generation_stage(job, emit, stage, completed, total)
+    
+    image_url = f"data:{mime_type};base64,{base64.b64encode(image_data).decode('ascii')}"
+    
+    # 打印实际发送的prompt到控制台
+    print('\n' + '='*80)
+    print('📝 实际发送给AI的Prompt:')
+    print('-'*80)
+    print(enhanced_prompt)
+    print('='*80 + '\n')
+    
+    # 立即进行背景移除处理
+    set_stage('keying')
+    print('🔄 正在进行背景移除处理...')
+    keyed_sheet = ImageProcessor.key_image_bytes(  # type: ignore
+        image_data,
+        rows=rows,
+        cols=cols,
+        tolerance=tolerance,
+        mode='green',
+        timer=timer
+    )
+    
+    atlas = parse_atlas(data)
+    dedupe = parse_dedupe(data)
+    processed_frames = frame_refs = None
+    processed_sprite_url = atlas_url = manifest = None
+    if atlas:
+        # 图集模式：裁剪透明区域后打包，不再输出逐帧图片和原尺寸的精灵图
+        set_stage('atlas')
+        atlas_image, manifest = ImageProcessor.pack_atlas(  # type: ignore
+            keyed_sheet, rows, cols, timer=timer, dedupe=dedupe, **atlas
+        )
+        atlas_url = ImageProcessor.png_to_data_url(atlas_image)  # type: ignore
+    elif dedupe is not None:
+        # 重复帧只编码一次：frames 只含不同的帧，frameRefs 为每帧在其中的位置
+        with timed(timer, 'encode'):
+            encoded_frames, frame_refs = ImageProcessor.iter_unique_frames(  # type: ignore
+                keyed_sheet, rows, cols, dedupe
             )
-            response.raise_for_status()
-            
-            result = response.json()
-            if result.get('data') and len(result['data']) > 0:
-                image_url = result['data'][0]['url']
+            if emit is None:
+                processed_frames = []
+                unique_count = len(set(frame_refs))
+                for frame in encoded_frames:
+                    processed_frames.append(ImageProcessor.png_to_data_url(frame))  # type: ignore
+                    set_stage('encoding', len(processed_frames), unique_count)
             else:
-                raise Exception('DALL-E API 返回数据格式错误')
-                
-        elif model == 'gemini-2.5-image-preview':
-            # 使用 Gemini 2.5 Flash Image Preview
-            response = session.post(
-                GEMINI_IMAGE_EDIT_URL,
-                json={
-                    'contents': [{
-                        'parts': [{
-                            'text': enhanced_prompt
-                        }]
-                    }],
-                    'generationConfig': {
-                        'responseModalities': ['IMAGE']
-                    }
-                },
-                headers=headers,
-                timeout=120
-            )
-            response.raise_for_status()
-            
-        elif model == 'gemini-3-pro-image-preview':
-            # 使用 Gemini 3 Pro Image Preview
-            response = session.post(
-                GEMINI_3_PRO_IMAGE_URL,
-                json={
-                    'contents': [{
-                        'parts': [{
-                            'text': enhanced_prompt
-                        }]
-                    }],
-                    'generationConfig': {
-                        'responseModalities': ['IMAGE']
-                    }
-                },
-                headers=headers,
-                timeout=120
+                emit({'event': 'stage', 'stage': 'encoding', 'total': rows * cols})
+                for event in deduped_frame_events(encoded_frames, frame_refs):
+                    set_stage('encoding', event['index'] + 1, rows * cols)
+                    emit(event)
+    elif emit is None:
+        # 帧和去背景后的精灵图都直接从同一块整图编码，各编码一次
+        with timed(timer, 'encode'):
+            processed_frames = ImageProcessor.encode_frames_to_base64(  # type: ignore
+                keyed_sheet, rows, cols,
+                progress=lambda completed, total: set_stage('encoding', completed, total)
             )
-            response.raise_for_status()
-            
-        else:
-            # 使用 Gemini 2.5 Flash Image（默认）
-            response = session.post(
-                GEMINI_IMAGE_GEN_URL,
-                json={
-                    'contents': [{
-                        'parts': [{
-                            'text': enhanced_prompt
-                        }]
-                    }],
-                    'generationConfig': {
-                        'responseModalities': ['IMAGE']
-                    }
-                },
-                headers=headers,
-                timeout=120
-            )
-            response.raise_for_status()
-        
-        # 解析 Gemini API 响应
-        if model != 'dalle':
-            result = response.json()
-            if (result.get('candidates') and 
-                len(result['candidates']) > 0 and
-                result['candidates'][0].get('content') and
-                result['candidates'][0]['content'].get('parts') and
-                len(result['candidates'][0]['content']['parts']) > 0):
-                
-                part = result['candidates'][0]['content']['parts'][0]
-                
-                if part.get('inlineData') and part['inlineData'].get('data'):
-                    base64_data = part['inlineData']['data']
-                    mime_type = part['inlineData'].get('mimeType', 'image/png')
-                    image_url = f'data:{mime_type};base64,{base64_data}'
-                elif part.get('inline_data') and part['inline_data'].get('data'):
-                    base64_data = part['inline_data']['data']
-                    mime_type = part['inline_data'].get('mime_type', 'image/png')
-                    image_url = f'data:{mime_type};base64,{base64_data}'
-                else:
-                    raise Exception('Gemini API 返回的图片数据格式错误：缺少 inlineData')
-            else:
-                raise Exception('Gemini API 返回数据格式错误：响应结构不完整')
-        
-        if not image_url:
-            raise Exception('未能生成图片URL')
-        
-        # 打印实际发送的prompt到控制台
-        print('\n' + '='*80)
-        print('📝 实际发送给AI的Prompt:')
-        print('-'*80)
-        print(enhanced_prompt)
-        print('='*80 + '\n')
-        
-        # 立即进行背景移除处理
-        print('🔄 正在进行背景移除处理...')
-        processed_frames = ImageProcessor.process_sprite_sheet(  # type: ignore
-            base64_image=image_url,
-            rows=rows,
-            cols=cols,
-            tolerance=tolerance,
-            mode='green'
-        )
-        print(f'✅ 背景移除完成，处理了 {len(processed_frames)} 帧')
-        
-        # 重新组合处理后的帧为精灵图
-        import numpy as np
-        from PIL import Image
-        import io
-        import base64
-        
-        # 解码第一帧获取尺寸
-        first_frame_data = processed_frames[0].split(',')[1]
-        first_frame_bytes = base64.b64decode(first_frame_data)
-        first_frame_img = Image.open(io.BytesIO(first_frame_bytes))
-        frame_width, frame_height = first_frame_img.size
-        
-        # 创建新的精灵图画布（RGBA模式支持透明）
-        sprite_width = frame_width * cols
-        sprite_height = frame_height * rows
-        sprite_sheet = Image.new('RGBA', (sprite_width, sprite_height), (0, 0, 0, 0))
-        
-        # 将所有帧拼接到精灵图上
-        for idx, frame_base64 in enumerate(processed_frames):
-            frame_data = frame_base64.split(',')[1]
-            frame_bytes = base64.b64decode(frame_data)
-            frame_img = Image.open(io.BytesIO(frame_bytes))
-            
-            row = idx // cols
-            col = idx % cols
-            x = col * frame_width
-            y = row * frame_height
-            
-            sprite_sheet.paste(frame_img, (x, y), frame_img)
-        
-        # 将精灵图转换为base64
-        buffer = io.BytesIO()
-        sprite_sheet.save(buffer, format='PNG')
-        buffer.seek(0)
-        sprite_base64 = base64.b64encode(buffer.read()).decode('utf-8')
-        processed_sprite_url = f'data:image/png;base64,{sprite_base64}'
-        
-        # 调试：确认返回的数据
-        print(f'✅ 准备返回数据:')
-        print(f'   - imageUrl: {processed_sprite_url[:50]}...')
-        print(f'   - rawImageUrl: {image_url[:50]}...')
-        print(f'   - frames数量: {len(processed_frames)}')
-        print(f'   - rows: {rows}, cols: {cols}')
-        
-        return jsonify({
-            'success': True,
-            'imageUrl': processed_sprite_url,  # 返回去背景后的精灵图
-            'rawImageUrl': image_url,  # 保留原始未处理的图片URL
-            'frames': processed_frames,  # 返回所有去背景后的帧
-            'rows': rows,
-            'cols': cols,
-            'frameCount': frame_count,
-            'prompt': prompt,
-            'enhancedPrompt': enhanced_prompt,
-            'model': model,
-            'message': '精灵图生成并背景移除成功！'
-        })
-        
-    except requests.exceptions.RequestException as e:
+    else:
+        # 流式模式：每帧编码完成即发送，不保留全部帧
+        total = rows * cols
+        emit({'event': 'stage', 'stage': 'encoding', 'total': total})
+        encoded_frames = ImageProcessor.iter_encoded_frames(keyed_sheet, rows, cols)  # type: ignore
+        for index, frame in enumerate(encoded_frames):
+            set_stage('encoding', index + 1, total)
+            emit({
+                'event': 'frame',
+                'index': index,
+                'image': ImageProcessor.png_to_data_url(frame)  # type: ignore
+            })
+    if not atlas:
+        with timed(timer, 'compose'):
+            processed_sprite_url = ImageProcessor.encode_image_to_base64(keyed_sheet)  # type: ignore
+    print(f'✅ 背景移除完成，处理了 {rows * cols} 帧')
+    
+    # 调试：确认返回的数据
+    print(f'✅ 准备返回数据:')
+    print(f'   - imageUrl: {(processed_sprite_url or atlas_url)[:50]}...')
+    print(f'   - rawImageUrl: {image_url[:50]}...')
+    print(f'   - frames数量: {rows * cols}')
+    print(f'   - rows: {rows}, cols: {cols}')
+    
+    result = {
+        'success': True,
+        'imageUrl': processed_sprite_url,  # 返回去背景后的精灵图
+        'rawImageUrl': image_url,  # 保留原始未处理的图片URL
+        'frames': processed_frames,  # 返回所有去背景后的帧
+        'rows': rows,
+        'cols': cols,
+        'frameCount': frame_count,
+        'prompt': prompt,
+        'enhancedPrompt': enhanced_prompt,
+        'model': model,
+        'cacheStatus': cache_status,
+        'message': '精灵图生成并背景移除成功！'
+    }
+    if processed_frames is None:
+        del result['frames']
+    if frame_refs is not None:
+        result['frameRefs'] = frame_refs
+    if atlas:
+        del result['imageUrl']
+        result['atlas'] = atlas_url
+        result['manifest'] = manifest
+    return result
+
+
+def run_generation_job(job: Job, data: Dict[str, Any],
+                       emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+                       timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    """
+    生成任务入口：执行 run_sprite_generation 并记录任务指标
+    
+    timer 由同步请求传入时，阶段耗时随该请求记录（并可返回 Server-Timing）；
+    否则（任务接口、流式响应）在任务结束时直接记录
+    """
+    own_timer = timer is None
+    timer = timer or StageTimer()
+    try:
+        result = run_sprite_generation(job, data, emit, timer)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        record_error(e, GENERATION_JOB_ENDPOINT)
+        raise
+    finally:
+        if own_timer:
+            metrics.record_stages(GENERATION_JOB_ENDPOINT, timer)
+    
+    metrics.inc('frameworker_frames_processed_total', result['rows'] * result['cols'],
+                endpoint=GENERATION_JOB_ENDPOINT)
+    return result
+
+
+def generation_error_payload(e: BaseException) -> Dict[str, Any]:
+    """把生成过程中的异常转换为错误响应数据"""
+    if isinstance(e, Overloaded):
+        return dict(overloaded_payload(e), details=None, statusCode=e.status)
+    
+    if isinstance(e, UPSTREAM_ERRORS):
         error_message = 'AI 图像生成失败'
         error_details = str(e)
         
@@ -400,80 +889,1329 @@ def generate_sprite_animation():
             except:
                 error_details = e.response.text or str(e)
         
-        return jsonify({
+        return {
             'error': error_message,
             'message': error_details,
             'details': None,
             'statusCode': e.response.status_code if hasattr(e, 'response') and e.response else None
-        }), 500
-        
-    except Exception as e:
-        return jsonify({
+        }
+    
+    return {
+        'error': 'AI 图像生成失败',
+        'message': str(e),
+        'details': None,
+        'statusCode': None
+    }
+
+
+def generation_outcome(job: Job) -> Tuple[Dict[str, Any], int]:
+    """已结束的生成任务的 (响应数据, 状态码)：成功时为结果，取消或失败时为错误信息"""
+    if job.state == Job.SUCCEEDED:
+        return job.result, 200
+    if job.state == Job.CANCELLED:
+        return {
             'error': 'AI 图像生成失败',
-            'message': str(e),
+            'message': '任务已取消',
             'details': None,
             'statusCode': None
-        }), 500
+        }, 500
+    if isinstance(job.exception, Overloaded):
+        # 排队超时或上游限速：503 / 429，附带 retryAfter
+        return generation_error_payload(job.exception), job.exception.status
+    return generation_error_payload(job.exception), 500  # type: ignore
 
 
-@app.route('/api/process-image', methods=['POST'])
-def process_image():
+def job_response(job: Job, include_result: bool = True):
+    """任务状态响应（结束后附带结果或错误信息）"""
+    payload = job.to_dict()
+    if include_result and job.state == Job.SUCCEEDED:
+        payload['result'] = job.result
+    elif job.state == Job.FAILED and job.exception is not None:
+        payload['error'] = generation_error_payload(job.exception)
+    return jsonify(payload)
+
+
+def submit_generation_job(data: Dict[str, Any],
+                          emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+                          timer: Optional[StageTimer] = None):
+    """校验请求并提交 AI 生成任务，返回 (任务, None) 或 (None, 错误响应)"""
+    invalid = validate_generation_request(data)
+    if invalid:
+        return None, (jsonify(invalid[0]), invalid[1])
+    
+    try:
+        return job_manager.submit('generate-sprite-animation', run_generation_job,
+                                  data, emit, timer), None
+    except Overloaded as e:
+        return None, overloaded_response(e)
+
+
+# 流式响应格式（查询参数 stream=sse|ndjson，或对应的 Accept 头）
+STREAM_MIMETYPES = {
+    'sse': 'text/event-stream',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def requested_stream_format() -> Optional[str]:
+    """客户端请求的流式响应格式，非流式请求返回None"""
+    stream = request.args.get('stream')
+    if stream in STREAM_MIMETYPES:
+        return stream
+    accepted = set(request.accept_mimetypes.values())
+    for stream, mimetype in STREAM_MIMETYPES.items():
+        if mimetype in accepted:
+            return stream
+    return None
+
+
+def encode_stream_event(event: Dict[str, Any], stream: str) -> str:
+    """按流式格式编码单个事件（SSE 格式下 event 字段同时作为事件名）"""
+    payload = json.dumps(event, ensure_ascii=False)
+    if stream == 'sse':
+        return f"event: {event['event']}\ndata: {payload}\n\n"
+    return payload + '\n'
+
+
+def stream_response(events: Iterator[Dict[str, Any]], stream: str):
     """
-    处理图像：切割并去除背景
+    把事件序列编码为流式响应
+    
+    每个事件是带 event 字段的字典。SSE 格式下 event 字段同时作为事件名，
+    NDJSON 格式下每行一个 JSON 对象。
     """
-    if not IMAGE_PROCESSING_AVAILABLE:
-        return jsonify({
-            'error': '图像处理功能不可用',
-            'message': '请安装依赖: pip install Pillow numpy opencv-python'
-        }), 500
+    def generate():
+        try:
+            for event in events:
+                yield encode_stream_event(event, stream)
+        finally:
+            # 客户端断开时停止产生事件
+            events.close()  # type: ignore
     
+    response = app.response_class(generate(), mimetype=STREAM_MIMETYPES[stream])
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+    return response
+
+
+def generation_events(job: Job, events: 'queue.Queue[Dict[str, Any]]') -> Iterator[Dict[str, Any]]:
+    """转发生成任务的流式事件，任务结束后产出 done 或 error 事件"""
     try:
-        data = request.get_json()
-        
-        # 获取参数
-        base64_image = data.get('image')
-        rows = data.get('rows', 1)
-        cols = data.get('cols', 1)
-        tolerance = data.get('tolerance', 50)
-        mode = data.get('mode', 'green')  # 'green' 或 'auto'
-        
-        if not base64_image:
-            return jsonify({
-                'error': '缺少必要参数',
-                'message': '请提供 image 参数'
-            }), 400
-        
-        if rows < 1 or cols < 1:
-            return jsonify({
-                'error': '参数错误',
-                'message': '行数和列数必须大于 0'
-            }), 400
-        
-        # 处理图像
-        processed_frames = ImageProcessor.process_sprite_sheet(  # type: ignore
-            base64_image=base64_image,
-            rows=rows,
-            cols=cols,
-            tolerance=tolerance,
-            mode=mode
-        )
+        yield {'event': 'job', 'jobId': job.id}
+        while True:
+            try:
+                yield events.get(timeout=0.5)
+            except queue.Empty:
+                # 任务结束后不会再有新事件
+                if job.finished and events.empty():
+                    break
         
-        return jsonify({
-            'success': True,
-            'frames': processed_frames,
-            'count': len(processed_frames),
-            'rows': rows,
-            'cols': cols,
-            'message': f'成功处理 {len(processed_frames)} 帧图像'
-        })
+        payload, _ = generation_outcome(job)
+        yield dict(payload, event='done' if job.state == Job.SUCCEEDED else 'error')
+    finally:
+        if not job.finished:
+            job_manager.cancel(job.id)
+        # 结果已通过流发送，任务接口不再需要它
+        job_manager.discard(job.id)
+
+
+@app.route('/api/generate-sprite-animation', methods=['POST'])
+def generate_sprite_animation():
+    """
+    AI 生成精灵图动画（同步接口：提交任务并等待结果）
+    
+    流式模式（?stream=sse|ndjson）下依次发送阶段事件和每一帧，最后发送 done 事件
+    """
+    data = request.get_json(silent=True) or {}
+    stream = requested_stream_format()
+    if stream:
+        events: 'queue.Queue[Dict[str, Any]]' = queue.Queue()
+        job, error_response = submit_generation_job(data, emit=events.put)
+        if error_response:
+            return error_response
+        return stream_response(generation_events(job, events), stream)
+    
+    job, error_response = submit_generation_job(data, timer=g.timer)
+    if error_response:
+        return error_response
+    
+    job.wait()
+    # 同步调用方拿不到 jobId，结果不需要保留到 JOB_RESULT_TTL
+    job_manager.discard(job.id)
+    payload, status = generation_outcome(job)
+    if job.state == Job.SUCCEEDED:
+        with timed(g.timer, 'json_serialize'):
+            return jsonify(payload)
+    return set_retry_after(jsonify(payload), payload), status
+
+
+@app.route('/api/jobs/generate-sprite-animation', methods=['POST'])
+def submit_generate_sprite_animation():
+    """提交 AI 生成任务，立即返回任务ID"""
+    job, error_response = submit_generation_job(request.get_json(silent=True) or {})
+    if error_response:
+        return error_response
+    
+    payload = job.to_dict()
+    payload['statusUrl'] = f'/api/jobs/{job.id}'
+    return jsonify(payload), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    """
+    查询任务状态
+    
+    查询参数 wait=N 表示长轮询：最多等待 N 秒（上限 60）直到任务结束
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({
+            'error': '任务不存在',
+            'message': f'任务 {job_id} 不存在或已过期'
+        }), 404
+    
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 60)
+    if wait and not job.finished:
+        job.wait(wait)
+    return job_response(job)
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id: str):
+    """取消任务"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({
+            'error': '任务不存在',
+            'message': f'任务 {job_id} 不存在或已过期'
+        }), 404
+    return job_response(job, include_result=False)
+
+
+def not_modified_response(etag: str):
+    """客户端携带的 If-None-Match 与结果一致时返回 304，否则返回 None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+# 二进制传输模式接受的请求类型
+BINARY_UPLOAD_MIMETYPES = ('application/octet-stream', 'multipart/form-data')
+
+
+def param_flag(params: Dict[str, Any], name: str, default: bool) -> bool:
+    """读取布尔参数（JSON 布尔值或查询字符串中的 1/true/yes）"""
+    value = params.get(name, default)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def parse_interpolation(params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    读取插帧参数：interpolate（每两帧插入帧数）、interpolationMode（linear/flow）、
+    smoothInterpolation（是否缓动）
+    
+    Returns:
+        插帧参数，不插帧时返回None
+    
+    Raises:
+        ValueError: 参数不合法
+    """
+    count = int(params.get('interpolate', 0))
+    if count == 0:
+        return None
+    
+    mode = params.get('interpolationMode', 'linear')
+    if not 0 < count <= MAX_INTERPOLATION_COUNT:
+        raise ValueError(f'interpolate 必须在 0 到 {MAX_INTERPOLATION_COUNT} 之间')
+    if mode not in INTERPOLATION_MODES:
+        raise ValueError(f"interpolationMode 必须是 {', '.join(INTERPOLATION_MODES)} 之一")
+    
+    return {
+        'count': count,
+        'mode': mode,
+        'smooth': param_flag(params, 'smoothInterpolation', False)
+    }
+
+
+def parse_atlas(params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    读取输出方式：output=frames（默认，逐帧输出）或 atlas（裁剪透明区域后打包为图集），
+    图集参数为 atlasPadding（帧间距）和 atlasPowerOfTwo（宽高取2的幂）
+    
+    Returns:
+        图集参数，逐帧输出时返回None
+    
+    Raises:
+        ValueError: 参数不合法
+    """
+    output = params.get('output', 'frames')
+    if output not in ('frames', 'atlas'):
+        raise ValueError('output 必须是 frames 或 atlas')
+    if output == 'frames':
+        return None
+    
+    padding = int(params.get('atlasPadding', DEFAULT_ATLAS_PADDING))
+    if not 0 <= padding <= MAX_ATLAS_PADDING:
+        raise ValueError(f'atlasPadding 必须在 0 到 {MAX_ATLAS_PADDING} 之间')
+    return {
+        'padding': padding,
+        'power_of_two': param_flag(params, 'atlasPowerOfTwo', False)
+    }
+
+
+def parse_dedupe(params: Dict[str, Any]) -> Optional[int]:
+    """
+    读取重复帧检测参数：dedupe（是否检测）和 dedupeThreshold（感知哈希的汉明距离阈值，
+    默认 0 只合并完全相同的帧）
+    
+    Returns:
+        检测阈值，不检测时返回None
+    
+    Raises:
+        ValueError: 参数不合法
+    """
+    if not param_flag(params, 'dedupe', False):
+        return None
+    threshold = int(params.get('dedupeThreshold', 0))
+    if not 0 <= threshold <= MAX_DEDUPE_THRESHOLD:
+        raise ValueError(f'dedupeThreshold 必须在 0 到 {MAX_DEDUPE_THRESHOLD} 之间')
+    return threshold
+
+
+def deduped_frame_events(encoded_frames: Iterator[bytes], frame_refs: List[int],
+                         mimetype: str = 'image/png') -> Iterator[Dict[str, Any]]:
+    """
+    按帧顺序产出 frame 事件：第一次出现的帧带 image，重复帧只带 ref（与其相同的已发送帧的序号）
+    
+    Args:
+        encoded_frames: 按首次出现顺序编码的不同帧
+        frame_refs: 每帧在不同帧中的位置
+        mimetype: 帧的 MIME 类型
+    """
+    first_index: Dict[int, int] = {}
+    for index, position in enumerate(frame_refs):
+        if position in first_index:
+            yield {'event': 'frame', 'index': index, 'ref': first_index[position]}
+            continue
+        first_index[position] = index
+        yield {
+            'event': 'frame',
+            'index': index,
+            'image': ImageProcessor.data_url(next(encoded_frames), mimetype)  # type: ignore
+        }
+
+
+def parse_tiled(params: Dict[str, Any]) -> Optional[bool]:
+    """读取 tiled 参数（按行分块处理），未指定时返回None，由图像大小决定（见 ImageProcessor.should_tile）"""
+    if params.get('tiled') is None:
+        return None
+    return param_flag(params, 'tiled', False)
+
+
+@app.route('/api/process-image', methods=['POST'])
+def process_image():
+    """
+    处理图像：切割并去除背景
+    
+    JSON 模式：请求体为 {image: base64, rows, cols, tolerance, mode}，返回 base64 帧数组。
+    二进制模式：请求体为原始图像（application/octet-stream，或 multipart 的 image 字段），
+    参数通过查询字符串传递，返回 zip（manifest.json + 每帧 PNG）。
+    两种模式都支持流式响应（?stream=sse|ndjson），每帧处理完成即发送；
+    都支持插帧参数（见 parse_interpolation）。
+    大图按行分块处理（tiled 参数，默认超过 IMAGE_TILED_MIN_PIXELS 时自动分块），
+    像素数超过 IMAGE_MAX_PIXELS 时返回 413。
+    """
+    if not load_image_processing():
+        return jsonify({
+            'error': '图像处理功能不可用',
+            'message': '请安装依赖: pip install Pillow numpy opencv-python'
+        }), 500
+    
+    if request.mimetype in BINARY_UPLOAD_MIMETYPES:
+        return process_image_binary()
+    
+    try:
+        data = request.get_json()
+        
+        # 获取参数
+        base64_image = data.get('image')
+        rows = data.get('rows', 1)
+        cols = data.get('cols', 1)
+        tolerance = data.get('tolerance', 50)
+        mode = data.get('mode', 'green')  # 'green' 或 'auto'
+        tiled = parse_tiled(data)
+        
+        try:
+            interpolation = parse_interpolation(data)
+            encoder = resolve_encoder(data.get('encoder'))  # type: ignore
+            atlas = parse_atlas(data)
+            dedupe = parse_dedupe(data)
+            if atlas and requested_stream_format():
+                raise ValueError('output=atlas 不支持流式响应')
+        except ValueError as e:
+            return jsonify({
+                'error': '参数错误',
+                'message': str(e)
+            }), 400
+        
+        if not base64_image:
+            return jsonify({
+                'error': '缺少必要参数',
+                'message': '请提供 image 参数'
+            }), 400
         
+        if rows < 1 or cols < 1:
+            return jsonify({
+                'error': '参数错误',
+                'message': '行数和列数必须大于 0'
+            }), 400
+        
+        # 结果由图像内容和参数唯一确定，客户端已有相同结果时直接返回 304
+        with timed(g.timer, 'base64_decode'):
+            image_data = ImageProcessor.decode_base64_payload(base64_image)  # type: ignore
+        ImageProcessor.check_image_size(image_data)  # type: ignore
+        result_key = ImageProcessor.result_key(  # type: ignore
+            image_data, rows, cols, tolerance, mode, interpolation, encoder
+        )
+        
+        if atlas:
+            result_key = ImageProcessor.atlas_key(result_key, dedupe=dedupe, **atlas)  # type: ignore
+        elif dedupe is not None:
+            result_key = ImageProcessor.dedupe_key(result_key, dedupe)  # type: ignore
+        
+        stream = requested_stream_format()
+        if stream:
+            return stream_response(process_image_events(
+                image_data, rows, cols, tolerance, mode, result_key, interpolation, encoder, tiled,
+                dedupe
+            ), stream)
+        
+        etag = f'{result_key}-json'
+        cached_response = not_modified_response(etag)
+        if cached_response:
+            return cached_response
+        
+        # 处理图像
+        tracker = MemoryTracker()  # type: ignore
+        if atlas:
+            atlas_image, manifest = ImageProcessor.process_sprite_sheet_atlas(  # type: ignore
+                image_data, rows, cols, tolerance, mode, tracker=tracker, cache_key=result_key,
+                interpolation=interpolation, timer=g.timer, encoder=encoder, dedupe=dedupe, **atlas
+            )
+            del image_data
+            count = len(manifest['frames'])
+            metrics.inc('frameworker_frames_processed_total', count, endpoint=request.endpoint)
+            
+            with timed(g.timer, 'json_serialize'):
+                response = jsonify({
+                    'success': True,
+                    'atlas': ImageProcessor.data_url(  # type: ignore
+                        atlas_image, FRAME_ENCODERS[encoder].mimetype
+                    ),
+                    'manifest': manifest,
+                    'count': count,
+                    'rows': rows,
+                    'cols': cols,
+                    'peakMemoryBytes': tracker.peak,
+                    'message': f'成功处理 {count} 帧图像'
+                })
+            response.set_etag(etag, weak=True)
+            return response
+        
+        if dedupe is not None:
+            # 重复帧只返回一次，frameRefs 为每帧在 frames 中的位置
+            unique_frames, frame_refs = ImageProcessor.process_sprite_sheet_unique(  # type: ignore
+                image_data, rows, cols, tolerance, mode, dedupe, tracker=tracker,
+                cache_key=result_key, interpolation=interpolation, timer=g.timer, encoder=encoder
+            )
+            del image_data
+            count = len(frame_refs)
+            metrics.inc('frameworker_frames_processed_total', count, endpoint=request.endpoint)
+            
+            with timed(g.timer, 'json_serialize'):
+                mimetype = FRAME_ENCODERS[encoder].mimetype
+                response = jsonify({
+                    'success': True,
+                    'frames': [ImageProcessor.data_url(frame, mimetype)  # type: ignore
+                               for frame in unique_frames],
+                    'frameRefs': frame_refs,
+                    'count': count,
+                    'uniqueCount': len(unique_frames),
+                    'rows': rows,
+                    'cols': cols,
+                    'peakMemoryBytes': tracker.peak,
+                    'message': f'成功处理 {count} 帧图像（{len(unique_frames)} 帧不重复）'
+                })
+            response.set_etag(etag, weak=True)
+            return response
+        
+        processed_frames = ImageProcessor.process_sprite_sheet_bytes(  # type: ignore
+            image_data,
+            rows=rows,
+            cols=cols,
+            tolerance=tolerance,
+            mode=mode,
+            tracker=tracker,
+            cache_key=result_key,
+            interpolation=interpolation,
+            timer=g.timer,
+            encoder=encoder,
+            tiled=tiled
+        )
+        del image_data
+        metrics.inc('frameworker_frames_processed_total', len(processed_frames),
+                    endpoint=request.endpoint)
+        
+        with timed(g.timer, 'json_serialize'):
+            response = jsonify({
+                'success': True,
+                'frames': processed_frames,
+                'count': len(processed_frames),
+                'rows': rows,
+                'cols': cols,
+                'peakMemoryBytes': tracker.peak,
+                'message': f'成功处理 {len(processed_frames)} 帧图像'
+            })
+        response.set_etag(etag, weak=True)
+        return response
+        
+    except ImageTooLargeError as e:  # type: ignore
+        return jsonify({
+            'error': '图像过大',
+            'message': str(e)
+        }), 413
     except Exception as e:
+        record_error(e)
         return jsonify({
             'error': '图像处理失败',
             'message': str(e)
         }), 500
 
 
+def read_binary_upload() -> bytes:
+    """读取二进制上传的原始图像（octet-stream 请求体或 multipart 的 image 字段）"""
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        return upload.read() if upload else b''
+    return request.get_data(cache=False)
+
+
+def process_image_events(image_data: bytes, rows: int, cols: int, tolerance: int,
+                         mode: str, result_key: str,
+                         interpolation: Optional[Dict[str, Any]] = None,
+                         encoder: str = 'png',
+                         tiled: Optional[bool] = None,
+                         dedupe: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    流式处理图像：产出阶段事件，每帧编码完成后立即产出该帧
+    
+    事件依次为 stage(keying)、stage(encoding)、frame × N、done；
+    缓存命中时为 stage(cached)、frame × N、done；
+    按行分块处理时为 stage(tiled)、frame × N、done，每行处理完成即发送该行的帧；
+    检测重复帧时（dedupe，result_key 为 dedupe_key）为 stage(dedupe)、frame × N、done，
+    全部不同的帧编码完成后才开始发送，重复帧的 frame 事件只带 ref（见 deduped_frame_events）；
+    出错时以 error 事件结束
+    
+    响应开始发送后已离开请求上下文，指标以 process_image_stream 端点记录
+    （编码与发送交替进行，只记录解码和去背景阶段；分块处理时各阶段都不含发送时间）
+    """
+    endpoint = 'process_image_stream'
+    timer = StageTimer()
+    total = rows * cols
+    mimetype = FRAME_ENCODERS[encoder].mimetype
+    if interpolation:
+        total = FrameInterpolator.output_count(total, interpolation['count'])  # type: ignore
+    try:
+        cache = get_result_cache()  # type: ignore
+        tracker = MemoryTracker()  # type: ignore
+        cached_frames = cache.get(result_key) if dedupe is None else None
+        collected = None
+        if dedupe is not None:
+            yield {'event': 'stage', 'stage': 'dedupe', 'total': total}
+            unique_frames, frame_refs = ImageProcessor.process_sprite_sheet_unique(  # type: ignore
+                image_data, rows, cols, tolerance, mode, dedupe, tracker=tracker,
+                cache_key=result_key if cache.enabled else None, interpolation=interpolation,
+                timer=timer, encoder=encoder
+            )
+            del image_data
+            yield from deduped_frame_events(iter(unique_frames), frame_refs, mimetype)
+            encoded_frames = iter(())
+        elif cached_frames is not None:
+            yield {'event': 'stage', 'stage': 'cached', 'total': total}
+            encoded_frames = iter(cached_frames)
+        elif ImageProcessor.should_tile(image_data, tiled):  # type: ignore
+            # 内存中只保留当前一行，已发送的帧不保留（不写入缓存）
+            yield {'event': 'stage', 'stage': 'tiled', 'total': total}
+            encoded_frames = ImageProcessor.iter_tiled_frames(  # type: ignore
+                image_data, rows, cols, tolerance, mode, tracker=tracker,
+                interpolation=interpolation, timer=timer, encoder=encoder
+            )
+            del image_data
+        else:
+            yield {'event': 'stage', 'stage': 'keying', 'total': total}
+            keyed = ImageProcessor.key_image_bytes(  # type: ignore
+                image_data, rows, cols, tolerance, mode, tracker=tracker, timer=timer
+            )
+            del image_data
+            yield {'event': 'stage', 'stage': 'encoding', 'total': total}
+            encoded_frames = ImageProcessor.iter_encoded_frames(  # type: ignore
+                keyed, rows, cols, interpolation=interpolation, encoder=encoder
+            )
+            # 只有启用缓存时才保留已发送的帧
+            collected = [] if cache.enabled else None
+        
+        for index, frame in enumerate(encoded_frames):
+            if collected is not None:
+                collected.append(frame)
+            yield {
+                'event': 'frame',
+                'index': index,
+                'image': ImageProcessor.data_url(frame, mimetype)  # type: ignore
+            }
+        
+        if collected is not None:
+            cache.put(result_key, collected)
+        metrics.inc('frameworker_frames_processed_total', total, endpoint=endpoint)
+        
+        yield {
+            'event': 'done',
+            'success': True,
+            'count': total,
+            'rows': rows,
+            'cols': cols,
+            'peakMemoryBytes': tracker.peak,
+            'message': f'成功处理 {total} 帧图像'
+        }
+        
+    except Exception as e:
+        record_error(e, endpoint)
+        yield {
+            'event': 'error',
+            'error': '图像处理失败',
+            'message': str(e)
+        }
+    finally:
+        metrics.record_stages(endpoint, timer)
+
+
+class ZipStream(io.RawIOBase):
+    """只追加的 zip 输出：已写入的字节由 drain 取走（不可定位，zipfile 会改用数据描述符）"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return memoryview(data).nbytes
+    
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def tiled_zip_stream(image_data: bytes, rows: int, cols: int, tolerance: int, mode: str,
+                     interpolation: Optional[Dict[str, Any]] = None,
+                     encoder: str = 'png') -> Iterator[bytes]:
+    """
+    按行分块处理并流式输出 zip：每行的帧编码完成即发送，manifest.json 位于最后
+    
+    出错时中断响应（不写 zip 目录），客户端会得到不完整的 zip；
+    指标以 process_image_zip_stream 端点记录
+    """
+    endpoint = 'process_image_zip_stream'
+    timer = StageTimer()
+    tracker = MemoryTracker()  # type: ignore
+    frame_format = FRAME_ENCODERS[encoder].format
+    encoded_frames = ImageProcessor.iter_tiled_frames(  # type: ignore
+        image_data, rows, cols, tolerance, mode, tracker=tracker,
+        interpolation=interpolation, timer=timer, encoder=encoder
+    )
+    del image_data
+    
+    output = ZipStream()
+    frame_names: List[str] = []
+    try:
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+            for index, frame in enumerate(encoded_frames):
+                frame_names.append(f'frame_{index:03d}.{frame_format}')
+                with archive.open(frame_names[-1], 'w') as entry:
+                    entry.write(frame)
+                yield output.drain()
+            
+            manifest = {
+                'success': True,
+                'format': frame_format,
+                'encoder': encoder,
+                'frames': frame_names,
+                'count': len(frame_names),
+                'rows': rows,
+                'cols': cols,
+                'peakMemoryBytes': tracker.peak,
+                'message': f'成功处理 {len(frame_names)} 帧图像'
+            }
+            archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False))
+        yield output.drain()
+        metrics.inc('frameworker_frames_processed_total', len(frame_names), endpoint=endpoint)
+    except Exception as e:
+        record_error(e, endpoint)
+        raise
+    finally:
+        metrics.record_stages(endpoint, timer)
+
+
+def process_image_binary():
+    """处理图像（二进制传输模式）"""
+    try:
+        rows = request.args.get('rows', 1, type=int)
+        cols = request.args.get('cols', 1, type=int)
+        tolerance = request.args.get('tolerance', 50, type=int)
+        mode = request.args.get('mode', 'green')
+        tiled = parse_tiled(request.args)
+        image_data = read_binary_upload()
+        
+        if not image_data:
+            return jsonify({
+                'error': '缺少必要参数',
+                'message': '请上传 image 文件'
+            }), 400
+        
+        if rows < 1 or cols < 1:
+            return jsonify({
+                'error': '参数错误',
+                'message': '行数和列数必须大于 0'
+            }), 400
+        
+        try:
+            interpolation = parse_interpolation(request.args)
+            encoder = resolve_encoder(request.args.get('encoder'))  # type: ignore
+            atlas = parse_atlas(request.args)
+            dedupe = parse_dedupe(request.args)
+            if atlas and requested_stream_format():
+                raise ValueError('output=atlas 不支持流式响应')
+        except ValueError as e:
+            return jsonify({
+                'error': '参数错误',
+                'message': str(e)
+            }), 400
+        
+        ImageProcessor.check_image_size(image_data)  # type: ignore
+        result_key = ImageProcessor.result_key(  # type: ignore
+            image_data, rows, cols, tolerance, mode, interpolation, encoder
+        )
+        
+        if atlas:
+            result_key = ImageProcessor.atlas_key(result_key, dedupe=dedupe, **atlas)  # type: ignore
+        elif dedupe is not None:
+            result_key = ImageProcessor.dedupe_key(result_key, dedupe)  # type: ignore
+        
+        stream = requested_stream_format()
+        if stream:
+            return stream_response(process_image_events(
+                image_data, rows, cols, tolerance, mode, result_key, interpolation, encoder, tiled,
+                dedupe
+            ), stream)
+        
+        etag = f'{result_key}-zip'
+        cached_response = not_modified_response(etag)
+        if cached_response:
+            return cached_response
+        
+        if atlas:
+            # 图集需要全部帧，不分块处理
+            atlas_image, manifest = ImageProcessor.process_sprite_sheet_atlas(  # type: ignore
+                image_data, rows, cols, tolerance, mode, cache_key=result_key,
+                interpolation=interpolation, timer=g.timer, encoder=encoder, dedupe=dedupe, **atlas
+            )
+            del image_data
+            metrics.inc('frameworker_frames_processed_total', len(manifest['frames']),
+                        endpoint=request.endpoint)
+            
+            buffer = io.BytesIO()
+            with timed(g.timer, 'zip_serialize'):
+                with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                    archive.writestr('atlas.json', json.dumps(manifest, ensure_ascii=False))
+                    archive.writestr(manifest['meta']['image'], atlas_image)
+            buffer.seek(0)
+            
+            response = send_file(buffer, mimetype='application/zip', download_name='atlas.zip',
+                                 etag=False)
+            response.set_etag(etag, weak=True)
+            return response
+        
+        if dedupe is None and ImageProcessor.should_tile(image_data, tiled):  # type: ignore
+            # 分块处理时 zip 边处理边发送
+            response = app.response_class(tiled_zip_stream(
+                image_data, rows, cols, tolerance, mode, interpolation, encoder
+            ), mimetype='application/zip')
+            response.headers['Content-Disposition'] = 'attachment; filename=frames.zip'
+            response.set_etag(etag, weak=True)
+            return response
+        
+        # 处理图像
+        tracker = MemoryTracker()  # type: ignore
+        frame_refs = None
+        if dedupe is not None:
+            encoded_frames, frame_refs = ImageProcessor.process_sprite_sheet_unique(  # type: ignore
+                image_data, rows, cols, tolerance, mode, dedupe, tracker=tracker,
+                cache_key=result_key, interpolation=interpolation, timer=g.timer, encoder=encoder
+            )
+        else:
+            encoded_frames = ImageProcessor.process_sprite_sheet_png(  # type: ignore
+                image_data,
+                rows=rows,
+                cols=cols,
+                tolerance=tolerance,
+                mode=mode,
+                tracker=tracker,
+                cache_key=result_key,
+                interpolation=interpolation,
+                timer=g.timer,
+                encoder=encoder
+            )
+        del image_data
+        count = len(frame_refs) if frame_refs is not None else len(encoded_frames)
+        metrics.inc('frameworker_frames_processed_total', count, endpoint=request.endpoint)
+        
+        frame_format = FRAME_ENCODERS[encoder].format
+        file_names = [f'frame_{idx:03d}.{frame_format}' for idx in range(count)]
+        frame_names = file_names
+        if frame_refs is not None:
+            # 重复帧只存一份，以第一次出现的序号命名；manifest 中的 frames 按帧顺序列出对应文件
+            first_index = {position: index for index, position in reversed(list(enumerate(frame_refs)))}
+            file_names = [file_names[first_index[position]] for position in range(len(encoded_frames))]
+            frame_names = [file_names[position] for position in frame_refs]
+        manifest = {
+            'success': True,
+            'format': frame_format,
+            'encoder': encoder,
+            'frames': frame_names,
+            'count': count,
+            'rows': rows,
+            'cols': cols,
+            'peakMemoryBytes': tracker.peak,
+            'message': f'成功处理 {count} 帧图像'
+        }
+        if frame_refs is not None:
+            manifest['frameRefs'] = frame_refs
+            manifest['uniqueCount'] = len(encoded_frames)
+        
+        # 帧已经压缩过，zip 只做存储
+        buffer = io.BytesIO()
+        with timed(g.timer, 'zip_serialize'):
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False))
+                for name, frame in zip(file_names, encoded_frames):
+                    with archive.open(name, 'w') as entry:
+                        entry.write(frame)
+        buffer.seek(0)
+        
+        response = send_file(buffer, mimetype='application/zip', download_name='frames.zip',
+                             etag=False)
+        response.set_etag(etag, weak=True)
+        return response
+        
+    except ImageTooLargeError as e:  # type: ignore
+        return jsonify({
+            'error': '图像过大',
+            'message': str(e)
+        }), 413
+    except Exception as e:
+        record_error(e)
+        return jsonify({
+            'error': '图像处理失败',
+            'message': str(e)
+        }), 500
+
+
+def image_processing_unavailable():
+    """图像处理模块不可用时的错误响应"""
+    return jsonify({
+        'error': '图像处理功能不可用',
+        'message': '请安装依赖: pip install Pillow numpy opencv-python'
+    }), 500
+
+
+def session_not_found(session_id: str):
+    """会话不存在（已过期、被淘汰或由其他服务进程创建）时的错误响应"""
+    return jsonify({
+        'error': '会话不存在',
+        'message': f'会话 {session_id} 不存在或已过期，请重新创建'
+    }), 404
+
+
+@app.route('/api/key-sessions', methods=['POST'])
+def create_key_session():
+    """
+    创建抠图会话：上传并解码一次精灵图，之后调整参数时只需请求 /api/key-sessions/<id>/key
+    
+    请求体为 {image: base64}，或原始图像（application/octet-stream，或 multipart 的 image 字段）。
+    像素数超过 IMAGE_MAX_PIXELS 或超过会话内存上限时返回 413。
+    """
+    if not load_image_processing():
+        return image_processing_unavailable()
+    
+    try:
+        if request.mimetype in BINARY_UPLOAD_MIMETYPES:
+            image_data = read_binary_upload()
+        else:
+            base64_image = (request.get_json(silent=True) or {}).get('image')
+            with timed(g.timer, 'base64_decode'):
+                image_data = ImageProcessor.decode_base64_payload(base64_image) if base64_image else b''  # type: ignore
+        
+        if not image_data:
+            return jsonify({
+                'error': '缺少必要参数',
+                'message': '请提供 image 参数'
+            }), 400
+        
+        with timed(g.timer, 'decode'):
+            image = ImageProcessor.decode_image_bytes(image_data)  # type: ignore
+        del image_data
+        session = key_sessions.create(image)  # type: ignore
+        
+        response = jsonify(dict(session.to_dict(), success=True,
+                                keyUrl=f'/api/key-sessions/{session.id}/key'))
+        return response, 201
+        
+    except ImageTooLargeError as e:  # type: ignore
+        return jsonify({
+            'error': '图像过大',
+            'message': str(e)
+        }), 413
+    except Exception as e:
+        record_error(e)
+        return jsonify({
+            'error': '图像处理失败',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/key-sessions/<session_id>', methods=['GET'])
+def get_key_session(session_id: str):
+    """查询抠图会话"""
+    if not load_image_processing():
+        return image_processing_unavailable()
+    
+    session = key_sessions.get(session_id)  # type: ignore
+    if session is None:
+        return session_not_found(session_id)
+    return jsonify(session.to_dict())
+
+
+@app.route('/api/key-sessions/<session_id>', methods=['DELETE'])
+def delete_key_session(session_id: str):
+    """删除抠图会话（释放内存）"""
+    if not load_image_processing():
+        return image_processing_unavailable()
+    
+    if not key_sessions.delete(session_id):  # type: ignore
+        return session_not_found(session_id)
+    return jsonify({'success': True, 'sessionId': session_id})
+
+
+@app.route('/api/key-sessions/<session_id>/key', methods=['POST'])
+def key_session_frames(session_id: str):
+    """
+    在抠图会话上按新参数去除背景
+    
+    请求体为 {rows, cols, tolerance, mode, encoder, output}：output=frames（默认）返回 base64 帧数组，
+    支持插帧参数；output=alpha 只返回每帧的透明度掩码（灰度图，masks 字段），客户端用原图合成预览。
+    同一会话上只有阈值及之后的步骤会重新运行，交互调整时建议使用 encoder=preview。
+    """
+    if not load_image_processing():
+        return image_processing_unavailable()
+    
+    session = key_sessions.get(session_id)  # type: ignore
+    if session is None:
+        return session_not_found(session_id)
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        rows = int(data.get('rows', 1))
+        cols = int(data.get('cols', 1))
+        tolerance = int(data.get('tolerance', 50))
+        mode = data.get('mode', 'green')
+        output = data.get('output', 'frames')
+        
+        try:
+            interpolation = parse_interpolation(data)
+            encoder = resolve_encoder(data.get('encoder'))  # type: ignore
+            if output not in ('frames', 'alpha'):
+                raise ValueError('output 必须是 frames 或 alpha')
+            if output == 'alpha' and interpolation:
+                raise ValueError('output=alpha 不支持插帧')
+        except ValueError as e:
+            return jsonify({
+                'error': '参数错误',
+                'message': str(e)
+            }), 400
+        
+        height, width = session.image.shape[:2]
+        if not (0 < rows <= height and 0 < cols <= width):
+            return jsonify({
+                'error': '参数错误',
+                'message': '行数和列数必须大于 0 且不超过图像尺寸'
+            }), 400
+        
+        tracker = MemoryTracker()  # type: ignore
+        with timed(g.timer, 'key'):
+            keyed = key_sessions.key(session, rows, cols, tolerance, mode, tracker)  # type: ignore
+        
+        if output == 'alpha':
+            # 单通道的透明度整图，按同样的网格切割编码
+            keyed = keyed[..., 3].copy()
+        
+        with timed(g.timer, 'encode'):
+            mimetype = f'image/{FRAME_ENCODERS[encoder].format}'
+            encoded = [ImageProcessor.data_url(frame, mimetype)  # type: ignore
+                       for frame in ImageProcessor.iter_encoded_frames(  # type: ignore
+                           keyed, rows, cols, interpolation=interpolation, encoder=encoder)]
+        metrics.inc('frameworker_frames_processed_total', len(encoded), endpoint=request.endpoint)
+        
+        return jsonify({
+            'success': True,
+            'sessionId': session.id,
+            'masks' if output == 'alpha' else 'frames': encoded,
+            'count': len(encoded),
+            'rows': rows,
+            'cols': cols,
+            'peakMemoryBytes': tracker.peak
+        })
+        
+    except Exception as e:
+        record_error(e)
+        return jsonify({
+            'error': '图像处理失败',
+            'message': str(e)
+        }), 500
+
+
+def read_batch_entries():
+    """
+    读取批量请求：返回 (默认参数, [(图像, 单项参数)])
+    
+    JSON 模式下图像为 base64 字符串，multipart 模式下为原始字节
+    
+    Raises:
+        ValueError: 请求格式不合法
+    """
+    if request.mimetype == 'multipart/form-data':
+        defaults: Dict[str, Any] = request.args.to_dict()
+        defaults.update(request.form.to_dict())
+        uploads = [upload.read() for upload in request.files.getlist('image')]
+        overrides = json.loads(defaults.pop('items', None) or '[]')
+        if not isinstance(overrides, list) or len(overrides) > len(uploads):
+            raise ValueError('items 必须是与上传文件一一对应的参数数组')
+        overrides += [{}] * (len(uploads) - len(overrides))
+        return defaults, list(zip(uploads, overrides))
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list):
+        raise ValueError('请提供 items 数组')
+    defaults = {name: value for name, value in data.items() if name != 'items'}
+    entries = []
+    for item in data['items']:
+        if not isinstance(item, dict):
+            raise ValueError('items 的每一项必须是对象')
+        entries.append((item.get('image'), item))
+    return defaults, entries
+
+
+def parse_batch_item(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    读取单项处理参数
+    
+    Raises:
+        ValueError: 参数不合法
+    """
+    rows = int(params.get('rows', 1))
+    cols = int(params.get('cols', 1))
+    if rows < 1 or cols < 1:
+        raise ValueError('行数和列数必须大于 0')
+    return {
+        'rows': rows,
+        'cols': cols,
+        'tolerance': int(params.get('tolerance', 50)),
+        'mode': params.get('mode', 'green'),
+        'interpolation': parse_interpolation(params),
+        'encoder': resolve_encoder(params.get('encoder')),  # type: ignore
+        'tiled': parse_tiled(params)
+    }
+
+
+def batch_results(invalid: Dict[int, Dict[str, Any]], items: list, indices: list,
+                  ordered: bool, endpoint: str) -> Iterator[Dict[str, Any]]:
+    """
+    逐项产出批量处理结果：参数不合法的项最先产出，其余按完成顺序（ordered 时按输入顺序）
+    
+    Args:
+        invalid: 参数不合法的项 {输入序号: 错误结果}
+        items: 提交到进程池的 (图像字节, 处理参数)
+        indices: items 中每一项的输入序号
+        ordered: 是否按输入顺序产出
+        endpoint: 指标端点标签
+    """
+    yield from invalid.values()
+    
+    for position, frames, error in batch_processor.map(items, ordered=ordered):  # type: ignore
+        index = indices[position]
+        params = items[position][1]
+        if error is not None:
+            record_error(error, endpoint)
+            yield {
+                'index': index,
+                'success': False,
+                'error': '图像处理失败',
+                'message': str(error)
+            }
+            continue
+        
+        metrics.inc('frameworker_frames_processed_total', len(frames), endpoint=endpoint)  # type: ignore
+        mimetype = FRAME_ENCODERS[params['encoder']].mimetype
+        yield {
+            'index': index,
+            'success': True,
+            'frames': [ImageProcessor.data_url(frame, mimetype) for frame in frames],  # type: ignore
+            'count': len(frames),  # type: ignore
+            'rows': params['rows'],
+            'cols': params['cols']
+        }
+
+
+def batch_events(results: Iterator[Dict[str, Any]], total: int) -> Iterator[Dict[str, Any]]:
+    """批量处理的流式事件：stage、item × N、done"""
+    failed = 0
+    try:
+        yield {'event': 'stage', 'stage': 'processing', 'total': total}
+        for result in results:
+            failed += not result['success']
+            yield dict(result, event='item')
+        yield {
+            'event': 'done',
+            'success': failed == 0,
+            'count': total,
+            'failed': failed
+        }
+    finally:
+        # 客户端断开时取消尚未开始的处理
+        results.close()  # type: ignore
+
+
+@app.route('/api/process-batch', methods=['POST'])
+def process_batch():
+    """
+    批量处理多张精灵图：分发到进程池并行切割和去除背景
+    
+    JSON 模式：请求体为 {items: [{image: base64, rows, cols, tolerance, mode, ...}], ...}，
+    items 以外的字段作为每一项的默认参数。
+    multipart 模式：多个 image 文件字段，可选的 items 字段为与文件一一对应的参数 JSON 数组，
+    其余表单字段和查询参数作为默认参数。
+    返回按输入顺序排列的逐项结果或错误；流式响应（?stream=sse|ndjson）每项完成即发送
+    （ordered=true 时按输入顺序发送）。
+    """
+    if not load_image_processing():
+        return jsonify({
+            'error': '图像处理功能不可用',
+            'message': '请安装依赖: pip install Pillow numpy opencv-python'
+        }), 500
+    
+    try:
+        defaults, entries = read_batch_entries()
+    except ValueError as e:
+        return jsonify({
+            'error': '参数错误',
+            'message': str(e)
+        }), 400
+    
+    if not entries:
+        return jsonify({
+            'error': '缺少必要参数',
+            'message': '请提供至少一张图片'
+        }), 400
+    
+    if len(entries) > batch_processor.max_items:  # type: ignore
+        return jsonify({
+            'error': '批量过大',
+            'message': f'单次最多处理 {batch_processor.max_items} 张图片'  # type: ignore
+        }), 413
+    
+    try:
+        # 逐项校验，参数错误只影响该项
+        invalid: Dict[int, Dict[str, Any]] = {}
+        items = []
+        indices = []
+        for index, (image, overrides) in enumerate(entries):
+            try:
+                params = parse_batch_item(dict(defaults, **overrides))
+                if isinstance(image, str):
+                    with timed(g.timer, 'base64_decode'):
+                        image = ImageProcessor.decode_base64_payload(image)  # type: ignore
+                if not image:
+                    raise ValueError('请提供 image 参数')
+            except (TypeError, ValueError) as e:
+                invalid[index] = {
+                    'index': index,
+                    'success': False,
+                    'error': '参数错误',
+                    'message': str(e)
+                }
+                continue
+            items.append((image, params))
+            indices.append(index)
+        
+        stream = requested_stream_format()
+        if stream:
+            ordered = param_flag(request.args, 'ordered', False)
+            return stream_response(batch_events(
+                batch_results(invalid, items, indices, ordered, 'process_batch_stream'), len(entries)
+            ), stream)
+        
+        with timed(g.timer, 'process'):
+            results = sorted(batch_results(invalid, items, indices, True, request.endpoint),
+                             key=lambda result: result['index'])
+        failed = sum(not result['success'] for result in results)
+        
+        with timed(g.timer, 'json_serialize'):
+            return jsonify({
+                'success': failed == 0,
+                'results': results,
+                'count': len(results),
+                'failed': failed,
+                'message': f'成功处理 {len(results) - failed} / {len(results)} 张图片'
+            })
+    
+    except Exception as e:
+        record_error(e)
+        return jsonify({
+            'error': '批量处理失败',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/encode-animation', methods=['POST'])
+def encode_animation():
+    """
+    服务端编码动画：切割精灵图并去除背景后直接输出动画 GIF 或 WebP
+    
+    JSON 模式：请求体为 {image: base64, rows, cols, tolerance, mode, format, delay, loop, ...}
+    二进制模式：请求体为原始图像（同 /api/process-image），参数通过查询字符串传递
+    
+    动画参数：format（gif/webp，默认 gif）、delay（帧延迟毫秒，默认 100）、
+    loop（循环次数，0 表示无限循环）、colors/dither（GIF 共享调色板）、quality/lossless（WebP），
+    以及插帧参数（见 parse_interpolation），切割、去背景、插帧和编码在一次请求内完成
+    """
+    if not load_image_processing():
+        return jsonify({
+            'error': '图像处理功能不可用',
+            'message': '请安装依赖: pip install Pillow numpy opencv-python'
+        }), 500
+    
+    try:
+        if request.mimetype in BINARY_UPLOAD_MIMETYPES:
+            params: Dict[str, Any] = request.args.to_dict()
+            image_data = read_binary_upload()
+        else:
+            params = request.get_json(silent=True) or {}
+            base64_image = params.get('image')
+            with timed(g.timer, 'base64_decode'):
+                image_data = ImageProcessor.decode_base64_payload(base64_image) if base64_image else b''  # type: ignore
+        
+        rows = int(params.get('rows', 1))
+        cols = int(params.get('cols', 1))
+        tolerance = int(params.get('tolerance', 50))
+        mode = params.get('mode', 'green')
+        options = {
+            'format': str(params.get('format', 'gif')).lower(),
+            'delay': int(params.get('delay', 100)),
+            'loop': int(params.get('loop', 0)),
+            'quality': int(params.get('quality', 90)),
+            'lossless': param_flag(params, 'lossless', False),
+            'colors': int(params.get('colors', 255)),
+            'dither': param_flag(params, 'dither', False)
+        }
+        
+        try:
+            interpolation = parse_interpolation(params)
+        except ValueError as e:
+            return jsonify({
+                'error': '参数错误',
+                'message': str(e)
+            }), 400
+        
+        if not image_data:
+            return jsonify({
+                'error': '缺少必要参数',
+                'message': '请提供 image 参数'
+            }), 400
+        
+        if rows < 1 or cols < 1:
+            return jsonify({
+                'error': '参数错误',
+                'message': '行数和列数必须大于 0'
+            }), 400
+        
+        if options['format'] not in ANIMATION_MIMETYPES:
+            return jsonify({
+                'error': '参数错误',
+                'message': f"format 必须是 {', '.join(ANIMATION_MIMETYPES)} 之一"
+            }), 400
+        
+        if options['delay'] < 1 or options['loop'] < 0:
+            return jsonify({
+                'error': '参数错误',
+                'message': 'delay 必须大于 0，loop 不能为负数'
+            }), 400
+        
+        # 输出由图像内容、处理参数和动画参数唯一确定
+        result_key = ImageProcessor.result_key(  # type: ignore
+            image_data, rows, cols, tolerance, mode, interpolation
+        )
+        options_key = hashlib.blake2b(json.dumps(options, sort_keys=True).encode('utf-8'),
+                                      digest_size=8).hexdigest()
+        etag = f"{result_key}-{options['format']}-{options_key}"
+        cached_response = not_modified_response(etag)
+        if cached_response:
+            return cached_response
+        
+        keyed = ImageProcessor.key_image_bytes(  # type: ignore
+            image_data, rows=rows, cols=cols, tolerance=tolerance, mode=mode, timer=g.timer
+        )
+        del image_data
+        
+        with timed(g.timer, 'interpolate' if interpolation else 'slice'):
+            frames = ImageProcessor.sheet_frames(keyed, rows, cols, interpolation)  # type: ignore
+        with timed(g.timer, 'encode'):
+            animation, mimetype = AnimationEncoder.encode(frames, **options)  # type: ignore
+        metrics.inc('frameworker_frames_processed_total', len(frames), endpoint=request.endpoint)
+        
+        response = send_file(io.BytesIO(animation), mimetype=mimetype,
+                             download_name=f"animation.{options['format']}", etag=False)
+        response.set_etag(etag, weak=True)
+        return response
+        
+    except ImageTooLargeError as e:  # type: ignore
+        return jsonify({
+            'error': '图像过大',
+            'message': str(e)
+        }), 413
+    except Exception as e:
+        record_error(e)
+        return jsonify({
+            'error': '动画编码失败',
+            'message': str(e)
+        }), 500
+
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_frontend(path):
@@ -484,9 +2222,20 @@ def serve_frontend(path):
     return send_from_directory(static_folder, 'index.html')
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    """请求体超过 MAX_REQUEST_BYTES"""
+    limit = app.config.get('MAX_CONTENT_LENGTH')
+    return jsonify({
+        'error': '请求体过大',
+        'message': f'请求体不能超过 {limit} 字节（MAX_REQUEST_BYTES）'
+    }), 413
+
+
 @app.errorhandler(500)
 def internal_error(error):
     """错误处理"""
+    record_error(getattr(error, 'original_exception', None) or error)
     return jsonify({
         'error': '服务器内部错误',
         'message': str(error)
@@ -502,4 +2251,5 @@ if __name__ == '__main__':
         sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     
     print(f'✓ FrameWorker Python 后端启动在端口 {PORT}')
+    start_image_processing()
     app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
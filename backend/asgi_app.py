@@ -0,0 +1,503 @@
+"""
+异步服务模块（ASGI，start.py --mode async）
+AI 生成接口在事件循环中等待上游（httpx 连接池），去背景和编码在线程池中执行，等待上游的请求不占用线程；
+其余接口通过 WSGI 桥接交给 Flask 应用在线程池中处理，路由和响应格式与同步模式相同
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from flask import Flask, g, request
+
+from app import (
+    app, admission, job_manager, generation_cache, generation_flight, upstream, metrics,
+    PROXY_URL, GENERATION_JOB_ENDPOINT, STREAM_MIMETYPES, encode_stream_event,
+    generation_outcome, overloaded_payload, parse_dalle_image_url, parse_gemini_image,
+    process_generated_image, record_error, render_generation_prompt, report_generation_stage,
+    requested_stream_format, set_retry_after, start_image_processing, upstream_headers,
+    upstream_rate_limit, upstream_request, validate_generation_request
+)
+from admission import Overloaded, Permit
+from job_manager import Job, JobCancelled
+from generation_cache import GenerationCache
+from upstream_client import AsyncUpstreamClient
+from metrics import StageTimer, timed
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+def wsgi_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    """
+    由 ASGI 请求构造 WSGI environ
+    
+    Args:
+        scope: ASGI http 请求
+        body: 已读取的请求体
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ: Dict[str, Any] = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    
+    chunked = environ.pop('HTTP_TRANSFER_ENCODING', None) is not None
+    if chunked or 'CONTENT_LENGTH' not in environ:
+        # 分块传输的请求体已完整读取，按固定长度交给 Flask（否则 Werkzeug 视为空请求体）；
+        # 声明过长而未读取的请求保留声明的长度，由 Flask 返回 413
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def declared_length(scope: Scope) -> Optional[int]:
+    """请求头中声明的请求体长度"""
+    for name, value in scope['headers']:
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def read_body(receive: Receive, limit: Optional[int]) -> Optional[bytes]:
+    """
+    读取请求体，超过 limit 时多读一个分块后停止（由 Flask 返回 413）
+    
+    Returns:
+        请求体，客户端已断开时返回None
+    """
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        chunks.append(chunk)
+        size += len(chunk)
+        if not message.get('more_body') or (limit and size > limit):
+            return b''.join(chunks)
+
+
+async def wait_disconnect(receive: Receive) -> None:
+    """请求体读完后等待客户端断开"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def asgi_headers(headers: List[Tuple[str, str]]) -> List[Tuple[bytes, bytes]]:
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+class AsyncServer:
+    """ASGI 应用：原生处理 AI 生成接口，其余请求桥接到 Flask"""
+    
+    def __init__(self, wsgi_app: Flask, max_generations: int = 256,
+                 cpu_workers: Optional[int] = None, wsgi_threads: int = 4,
+                 upstream_pool: Optional[int] = None):
+        """
+        Args:
+            wsgi_app: Flask 应用
+            max_generations: 同时进行的 AI 生成请求上限（含任务接口提交的任务），超过时返回 503
+            cpu_workers: 去背景、编码和序列化的线程数，None 表示 CPU 核心数
+            wsgi_threads: 处理其他接口的线程数
+            upstream_pool: 上游连接池大小，None 时与 max_generations 相同
+        """
+        self.wsgi_app = wsgi_app
+        self.max_generations = max_generations
+        self.cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers or os.cpu_count() or 1,
+                                               thread_name_prefix='async-cpu')
+        self.wsgi_executor = ThreadPoolExecutor(max_workers=wsgi_threads,
+                                                thread_name_prefix='wsgi-bridge')
+        self.upstream = AsyncUpstreamClient(upstream, pool_size=upstream_pool or max_generations,
+                                            proxy_url=PROXY_URL)
+        # 进行中的生成任务（保留引用，避免被回收）
+        self._tasks: Set[asyncio.Future] = set()
+        # 已登记、尚未启动的任务占用的准入名额（任务ID -> 名额），启动后在任务结束时释放
+        self._permits: Dict[str, Permit] = {}
+        self.routes: Dict[Tuple[str, str], Callable[..., Awaitable[None]]] = {
+            ('POST', '/api/generate-sprite-animation'): self.generate_sprite_animation,
+            ('POST', '/api/jobs/generate-sprite-animation'): self.submit_generate_sprite_animation
+        }
+    
+    @classmethod
+    def from_env(cls, wsgi_app: Flask) -> 'AsyncServer':
+        """根据环境变量创建"""
+        upstream_pool = int(os.getenv('ASYNC_UPSTREAM_POOL_SIZE', 0))
+        return cls(
+            wsgi_app,
+            max_generations=int(os.getenv('ASYNC_MAX_GENERATIONS', 256)),
+            cpu_workers=int(os.getenv('ASYNC_CPU_WORKERS', 0)) or None,
+            wsgi_threads=int(os.getenv('SERVER_THREADS', 4)),
+            upstream_pool=upstream_pool or None
+        )
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        
+        handler = self.routes.get((scope['method'], scope['path']))
+        limit = self.wsgi_app.config.get('MAX_CONTENT_LENGTH')
+        length = declared_length(scope)
+        if limit and length and length > limit:
+            # 不读取请求体，由 Flask 直接返回 413
+            body = b''
+            handler = None
+        else:
+            body = await read_body(receive, limit)
+            if body is None:
+                return
+            if limit and len(body) > limit:
+                handler = None
+        
+        if handler is None:
+            await self.call_wsgi(scope, receive, send, body)
+        else:
+            await handler(scope, receive, send, body)
+    
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        """启动时按 IMAGE_PRELOAD 加载图像处理模块，关闭时释放连接池和线程池"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_image_processing()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.upstream.aclose()
+                self.cpu_executor.shutdown(wait=False)
+                self.wsgi_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    def run_cpu(self, func: Callable[..., Any], *args: Any) -> 'asyncio.Future[Any]':
+        """在线程池中执行同步函数（去背景、编码、序列化、磁盘读写），不阻塞事件循环"""
+        return asyncio.get_running_loop().run_in_executor(self.cpu_executor, func, *args)
+    
+    async def call_wsgi(self, scope: Scope, receive: Receive, send: Send, body: bytes) -> None:
+        """在线程池中执行 Flask 应用，响应逐块发送（流式响应在客户端断开时关闭）"""
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, body)
+        started: Dict[str, Any] = {}
+        
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+            return lambda data: None
+        
+        def begin():
+            result = self.wsgi_app(environ, start_response)
+            return result, iter(result)
+        
+        result, chunks = await loop.run_in_executor(self.wsgi_executor, begin)
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': asgi_headers(started['headers'])
+            })
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(self.wsgi_executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.wsgi_executor, result.close)
+    
+    def finish_response(self, environ: Dict[str, Any], started: float, timer: StageTimer,
+                        payload: Optional[Dict[str, Any]] = None, status: int = 200,
+                        stream: Optional[str] = None):
+        """
+        在请求上下文中生成 Flask 响应并执行 after_request（CORS、请求指标、Server-Timing）
+        
+        Args:
+            environ: 请求的 WSGI environ
+            started: 请求开始时间（perf_counter）
+            timer: 请求的阶段计时
+            payload: JSON 响应数据
+            status: 状态码
+            stream: 流式格式，提供时生成不含响应体的流式响应头
+        """
+        with self.wsgi_app.request_context(environ):
+            g.request_started = started
+            g.timer = timer
+            if stream:
+                response = self.wsgi_app.response_class(iter(()), mimetype=STREAM_MIMETYPES[stream])
+                response.headers['Cache-Control'] = 'no-cache'
+                response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+            else:
+                with timed(timer if status == 200 else None, 'json_serialize'):
+                    response = self.wsgi_app.json.response(payload)
+                response.status_code = status
+                set_retry_after(response, payload)
+            return self.wsgi_app.process_response(response)
+    
+    async def send_json(self, send: Send, environ: Dict[str, Any], started: float,
+                        timer: StageTimer, payload: Dict[str, Any], status: int = 200) -> None:
+        response = await self.run_cpu(self.finish_response, environ, started, timer, payload, status)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': asgi_headers(response.headers.to_wsgi_list())
+        })
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+    
+    def parse_request(self, environ: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        """读取 JSON 请求体和流式格式"""
+        with self.wsgi_app.request_context(environ):
+            data = request.get_json(silent=True)
+            return data if isinstance(data, dict) else {}, requested_stream_format()
+    
+    async def admit_generation(self, data: Dict[str, Any], endpoint: Optional[str] = None,
+                               timer: Optional[StageTimer] = None
+                               ) -> Tuple[Optional[Job], Optional[Tuple[Dict[str, Any], int]]]:
+        """
+        校验生成请求并登记任务
+        
+        Args:
+            data: 请求 JSON
+            endpoint: 对应的 Flask 端点名称，配置了准入限制（ADMISSION_<端点>_*）时先占用名额，
+                      名额在任务结束时释放
+            timer: 记录排队耗时（queue 阶段）
+        
+        Returns:
+            (任务, None)，或 (None, (错误信息, 状态码))；同时进行的生成请求已达上限，
+            或准入队列已满、排队超时时为 503
+        """
+        # 首次请求可能需要导入图像处理模块
+        invalid = await self.run_cpu(validate_generation_request, data)
+        if invalid:
+            return None, invalid
+        
+        limiter = admission.get(endpoint)
+        permit = None
+        try:
+            if limiter is not None:
+                # 在事件循环中排队，不占用线程；队列长度和排队期限与同步模式相同
+                with timed(timer, 'queue'):
+                    permit = await limiter.acquire_async()
+            job = job_manager.track('generate-sprite-animation', limit=self.max_generations)
+        except Overloaded as e:
+            if permit is not None:
+                permit.release()
+            return None, (overloaded_payload(e), e.status)
+        
+        if permit is not None:
+            self._permits[job.id] = permit
+        return job, None
+    
+    def launch(self, job: Job, data: Dict[str, Any],
+               emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+               timer: Optional[StageTimer] = None) -> 'asyncio.Future[None]':
+        """在事件循环中启动生成任务"""
+        task = asyncio.ensure_future(job_manager.run_async(job, self.run_generation_job,
+                                                           data, emit, timer))
+        self._tasks.add(task)
+        task.add_done_callback(self._generation_finished)
+        permit = self._permits.pop(job.id, None)
+        if permit is not None:
+            task.add_done_callback(lambda _: permit.release())
+        return task
+    
+    def _generation_finished(self, task: asyncio.Future) -> None:
+        self._tasks.discard(task)
+    
+    async def request_upstream_image(self, model: str, enhanced_prompt: str) -> Tuple[bytes, str]:
+        """request_upstream_image 的异步版本"""
+        target, url, payload = upstream_request(model, enhanced_prompt)
+        response = await self.upstream.post(target, url, rate_limit=upstream_rate_limit(target),
+                                            json=payload, headers=upstream_headers())
+        response.raise_for_status()
+        
+        if model == 'dalle':
+            # DALL-E 返回的是临时链接，下载原始图片
+            image_response = await self.upstream.get('dalle', parse_dalle_image_url(response.json()))
+            image_response.raise_for_status()
+            mime_type = image_response.headers.get('Content-Type', 'image/png').split(';')[0]
+            return image_response.content, mime_type
+        
+        # 响应 JSON 中是数 MB 的 base64 图片，解析和解码放到线程池
+        return await self.run_cpu(lambda: parse_gemini_image(response.json()))
+    
+    async def fetch_generated_image(self, model: str, enhanced_prompt: str,
+                                    use_cache: bool = True) -> Tuple[bytes, str, str]:
+        """fetch_generated_image 的异步版本（与同步模式共用磁盘缓存和请求合并）"""
+        if not use_cache:
+            image_data, mime_type = await self.request_upstream_image(model, enhanced_prompt)
+            return image_data, mime_type, 'bypass'
+        
+        key = GenerationCache.make_key(model, enhanced_prompt)
+        
+        async def load() -> Tuple[bytes, str, str]:
+            if generation_cache.enabled:
+                cached = await self.run_cpu(generation_cache.get, key)
+                if cached:
+                    return cached[0], cached[1], 'hit'
+            image_data, mime_type = await self.request_upstream_image(model, enhanced_prompt)
+            if generation_cache.enabled:
+                await self.run_cpu(generation_cache.put, key, image_data, mime_type)
+            return image_data, mime_type, 'miss'
+        
+        (image_data, mime_type, cache_status), shared = await generation_flight.do_async(key, load)
+        return image_data, mime_type, 'shared' if shared else cache_status
+    
+    async def run_generation_job(self, job: Job, data: Dict[str, Any],
+                                 emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+                                 timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+        """
+        run_generation_job 的异步版本：等待上游时不占用线程，去背景和编码在线程池中执行
+        
+        emit 可能在事件循环或线程池中调用，需要线程安全
+        """
+        own_timer = timer is None
+        timer = timer or StageTimer()
+        try:
+            enhanced_prompt = await self.run_cpu(render_generation_prompt, data)
+            report_generation_stage(job, emit, 'upstream')
+            with timed(timer, 'upstream'):
+                image_data, mime_type, cache_status = await self.fetch_generated_image(
+                    data.get('model', 'gemini-2.5-image'), enhanced_prompt,
+                    use_cache=not data.get('noCache', False)
+                )
+            result = await self.run_cpu(process_generated_image, job, data, enhanced_prompt,
+                                        image_data, mime_type, cache_status, emit, timer)
+        except (JobCancelled, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            record_error(e, GENERATION_JOB_ENDPOINT)
+            raise
+        finally:
+            if own_timer:
+                metrics.record_stages(GENERATION_JOB_ENDPOINT, timer)
+        
+        metrics.inc('frameworker_frames_processed_total', result['rows'] * result['cols'],
+                    endpoint=GENERATION_JOB_ENDPOINT)
+        return result
+    
+    async def generate_sprite_animation(self, scope: Scope, receive: Receive, send: Send,
+                                        body: bytes) -> None:
+        """POST /api/generate-sprite-animation（同步和流式），见 app.generate_sprite_animation"""
+        started = time.perf_counter()
+        timer = StageTimer()
+        environ = wsgi_environ(scope, body)
+        data, stream = self.parse_request(environ)
+        job, error = await self.admit_generation(data, 'generate_sprite_animation', timer)
+        if error:
+            await self.send_json(send, environ, started, timer, *error)
+            return
+        
+        if stream:
+            await self.stream_generation(receive, send, environ, started, job, data, stream)
+            return
+        
+        try:
+            await self.launch(job, data, timer=timer)
+            payload, status = generation_outcome(job)
+        finally:
+            # 同步调用方拿不到 jobId，结果不需要保留到 JOB_RESULT_TTL
+            job_manager.discard(job.id)
+        await self.send_json(send, environ, started, timer, payload, status)
+    
+    async def stream_generation(self, receive: Receive, send: Send, environ: Dict[str, Any],
+                                started: float, job: Job, data: Dict[str, Any],
+                                stream: str) -> None:
+        """流式发送生成任务的事件（与 app.generation_events 相同），客户端断开时取消任务"""
+        loop = asyncio.get_running_loop()
+        events: 'asyncio.Queue[Optional[Dict[str, Any]]]' = asyncio.Queue()
+        
+        def emit(event: Dict[str, Any]) -> None:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        
+        async def send_event(event: Dict[str, Any]) -> None:
+            chunk = encode_stream_event(event, stream).encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        # 登记后立即启动，发送响应头失败时任务也能在 finally 中取消并结束，不会一直占用名额
+        task = self.launch(job, data, emit)
+        # 线程池中的事件先于任务结束的回调入队，None 之前的事件都已送达
+        task.add_done_callback(lambda _: emit(None))  # type: ignore
+        try:
+            response = await self.run_cpu(self.finish_response, environ, started, StageTimer(),
+                                          None, 200, stream)
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': asgi_headers(response.headers.to_wsgi_list())
+            })
+            await send_event({'event': 'job', 'jobId': job.id})
+            while True:
+                get = asyncio.ensure_future(events.get())
+                await asyncio.wait({get, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    return
+                event = get.result()
+                if event is None:
+                    break
+                await send_event(event)
+            
+            payload, _ = generation_outcome(job)
+            await send_event(dict(payload, event='done' if job.state == Job.SUCCEEDED else 'error'))
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if not task.done():
+                job_manager.cancel(job.id)
+                task.cancel()
+            # 结果已通过流发送，任务接口不再需要它
+            job_manager.discard(job.id)
+    
+    async def submit_generate_sprite_animation(self, scope: Scope, receive: Receive, send: Send,
+                                               body: bytes) -> None:
+        """POST /api/jobs/generate-sprite-animation，任务在事件循环中执行"""
+        started = time.perf_counter()
+        timer = StageTimer()
+        environ = wsgi_environ(scope, body)
+        data, _ = self.parse_request(environ)
+        job, error = await self.admit_generation(data)
+        if error:
+            await self.send_json(send, environ, started, timer, *error)
+            return
+        
+        self.launch(job, data)
+        payload = job.to_dict()
+        payload['statusUrl'] = f'/api/jobs/{job.id}'
+        await self.send_json(send, environ, started, timer, payload, 202)
+
+
+application = AsyncServer.from_env(app)
@@ -0,0 +1,204 @@
+"""
+图集打包模块
+按 alpha 裁掉每帧四周的透明区域，再把裁剪后的帧装箱到一张紧凑的图集中，
+输出 TexturePacker JSON（Hash）格式的描述文件（Phaser、PixiJS、Cocos 等引擎可直接读取）
+"""
+import math
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# 帧之间的默认间距（像素），避免纹理过滤时采样到相邻帧
+DEFAULT_ATLAS_PADDING = 2
+MAX_ATLAS_PADDING = 16
+
+# 装箱时尝试的图集宽度（相对于总面积的平方根）
+PACK_WIDTH_FACTORS = (1.0, 1.25, 1.5, 2.0)
+
+
+class AtlasPacker:
+    """透明区域裁剪 + 货架式装箱"""
+    
+    @staticmethod
+    def _bounds_from_profiles(row_any: np.ndarray, col_any: np.ndarray) -> np.ndarray:
+        """
+        由每帧各行、各列是否有不透明像素计算包围盒
+        
+        Args:
+            row_any: (帧数, 帧高) 的布尔数组
+            col_any: (帧数, 帧宽) 的布尔数组
+        
+        Returns:
+            (帧数, 4) 的 [x, y, w, h]；全透明的帧为左上角 1×1
+        """
+        height, width = row_any.shape[1], col_any.shape[1]
+        top = row_any.argmax(axis=1)
+        bottom = height - row_any[:, ::-1].argmax(axis=1)
+        left = col_any.argmax(axis=1)
+        right = width - col_any[:, ::-1].argmax(axis=1)
+        
+        bounds = np.stack([left, top, right - left, bottom - top], axis=1)
+        bounds[~row_any.any(axis=1)] = (0, 0, 1, 1)
+        return bounds
+    
+    @classmethod
+    def trim_bounds(cls, frames: np.ndarray) -> np.ndarray:
+        """
+        计算每帧不透明像素的包围盒
+        
+        Args:
+            frames: 帧数组 (帧数, 高, 宽, 4)，BGRA格式
+        
+        Returns:
+            (帧数, 4) 的 [x, y, w, h]
+        """
+        opaque = frames[..., 3] > 0
+        return cls._bounds_from_profiles(opaque.any(axis=2), opaque.any(axis=1))
+    
+    @classmethod
+    def sheet_trim_bounds(cls, keyed: np.ndarray, rows: int, cols: int) -> np.ndarray:
+        """
+        直接在整图上计算每帧的包围盒（一次遍历全部像素，不切割、不复制帧）
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+        
+        Returns:
+            按帧顺序（先行后列）的 (帧数, 4) 的 [x, y, w, h]，坐标相对于所在格子
+        """
+        frame_height = keyed.shape[0] // rows
+        frame_width = keyed.shape[1] // cols
+        opaque = (keyed[..., 3] > 0).reshape(rows, frame_height, cols, frame_width)
+        row_any = opaque.any(axis=3).transpose(0, 2, 1).reshape(rows * cols, frame_height)
+        col_any = opaque.any(axis=1).reshape(rows * cols, frame_width)
+        return cls._bounds_from_profiles(row_any, col_any)
+    
+    @staticmethod
+    def _shelf_pack(sizes: np.ndarray, order: np.ndarray, width: int,
+                    padding: int) -> Tuple[np.ndarray, int, int]:
+        """按高度从大到小逐行摆放，一行放不下时另起一行"""
+        positions = np.zeros((len(sizes), 2), dtype=np.int64)
+        sizes = sizes.tolist()
+        x = y = shelf_height = used_width = 0
+        for index in order.tolist():
+            w, h = sizes[index]
+            if x > 0 and x + w > width:
+                y += shelf_height + padding
+                x = shelf_height = 0
+            positions[index] = (x, y)
+            used_width = max(used_width, x + w)
+            shelf_height = max(shelf_height, h)
+            x += w + padding
+        return positions, used_width, y + shelf_height
+    
+    @classmethod
+    def pack(cls, sizes: np.ndarray, padding: int = DEFAULT_ATLAS_PADDING,
+             power_of_two: bool = False) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        把矩形装箱到一张图集中（不旋转），在几种候选宽度中取面积最小的结果
+        
+        Args:
+            sizes: (数量, 2) 的 [w, h]
+            padding: 矩形之间的间距
+            power_of_two: 图集宽高是否取2的幂（部分旧 GPU 和引擎要求）
+        
+        Returns:
+            ((数量, 2) 的左上角坐标 [x, y], (图集宽, 图集高))
+        """
+        order = np.lexsort((-sizes[:, 0], -sizes[:, 1]))
+        area = int(((sizes[:, 0] + padding) * (sizes[:, 1] + padding)).sum())
+        widest = int(sizes[:, 0].max())
+        
+        best: Optional[Tuple[np.ndarray, int, int]] = None
+        for factor in PACK_WIDTH_FACTORS:
+            width = max(widest, math.ceil(math.sqrt(area) * factor))
+            positions, used_width, used_height = cls._shelf_pack(sizes, order, width, padding)
+            if power_of_two:
+                used_width = cls._next_power_of_two(used_width)
+                used_height = cls._next_power_of_two(used_height)
+            if best is None or used_width * used_height < best[1] * best[2]:
+                best = (positions, used_width, used_height)
+        
+        positions, width, height = best  # type: ignore
+        return positions, (width, height)
+    
+    @staticmethod
+    def _next_power_of_two(value: int) -> int:
+        return 1 << max(value - 1, 0).bit_length()
+    
+    @classmethod
+    def build(cls, frames: Sequence[np.ndarray], bounds: np.ndarray,
+              padding: int = DEFAULT_ATLAS_PADDING,
+              power_of_two: bool = False,
+              refs: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, Tuple[int, int]]:
+        """
+        裁剪各帧并拼成图集
+        
+        Args:
+            frames: 帧序列（BGRA格式，尺寸一致，可以是视图）
+            bounds: 每帧的包围盒 [x, y, w, h]（见 trim_bounds）
+            padding: 帧之间的间距
+            power_of_two: 图集宽高是否取2的幂
+            refs: 重复帧（见 FrameDeduplicator.find_duplicates），重复帧不再打包，与其代表帧共用同一区域
+        
+        Returns:
+            (图集（BGRA格式，空白处透明）, 每帧在图集中的左上角坐标, (图集宽, 图集高))
+        """
+        if refs is None:
+            refs = np.arange(len(bounds))
+        unique = np.flatnonzero(refs == np.arange(len(refs)))
+        
+        packed, (width, height) = cls.pack(bounds[unique, 2:], padding, power_of_two)
+        atlas = np.zeros((height, width, 4), dtype=np.uint8)
+        for index, (left, top) in zip(unique.tolist(), packed.tolist()):
+            x, y, w, h = bounds[index].tolist()
+            atlas[top:top + h, left:left + w] = frames[index][y:y + h, x:x + w]
+        
+        positions = np.zeros((len(bounds), 2), dtype=np.int64)
+        positions[unique] = packed
+        return atlas, positions[refs], (width, height)
+    
+    @staticmethod
+    def manifest(names: Sequence[str], bounds: np.ndarray, positions: np.ndarray,
+                 frame_size: Tuple[int, int], atlas_size: Tuple[int, int],
+                 image_name: str) -> Dict[str, Any]:
+        """
+        生成 TexturePacker JSON（Hash）格式的描述
+        
+        Args:
+            names: 帧名称（按播放顺序）
+            bounds: 每帧在原格子中的裁剪区域 [x, y, w, h]
+            positions: 每帧在图集中的左上角坐标
+            frame_size: 裁剪前的帧尺寸 (宽, 高)
+            atlas_size: 图集尺寸 (宽, 高)
+            image_name: 图集图片的文件名
+        
+        Returns:
+            {frames: {名称: {frame, rotated, trimmed, spriteSourceSize, sourceSize}}, animations, meta}
+        """
+        source_width, source_height = frame_size
+        frames: Dict[str, Any] = {}
+        for name, (x, y, w, h), (left, top) in zip(names, bounds.tolist(), positions.tolist()):
+            frames[name] = {
+                'frame': {'x': left, 'y': top, 'w': w, 'h': h},
+                'rotated': False,
+                'trimmed': (w, h) != (source_width, source_height),
+                'spriteSourceSize': {'x': x, 'y': y, 'w': w, 'h': h},
+                'sourceSize': {'w': source_width, 'h': source_height}
+            }
+        
+        return {
+            'frames': frames,
+            'animations': {'default': list(names)},
+            'meta': {
+                'app': 'FrameWorker',
+                'version': '1.0',
+                'image': image_name,
+                'format': 'RGBA8888',
+                'size': {'w': atlas_size[0], 'h': atlas_size[1]},
+                'scale': '1'
+            }
+        }
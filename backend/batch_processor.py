@@ -0,0 +1,235 @@
+"""
+批量处理模块
+把多张精灵图分发到进程池并行处理，图像数据通过共享内存在进程间传递
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+
+from image_processor import (DEFAULT_ENCODER, BufferLike, ImageProcessor, get_result_cache,
+                             resolve_workers)
+
+
+# 批量处理的单项：(原始图像字节, 处理参数)
+# 处理参数为 rows、cols、tolerance、mode、interpolation、encoder（同 process_sprite_sheet_png）
+BatchItem = Tuple[BufferLike, Dict[str, Any]]
+
+
+def _init_worker() -> None:
+    """子进程初始化：每个进程单线程处理，结果缓存只在主进程中使用"""
+    os.environ['IMAGE_CACHE_MAX_BYTES'] = '0'
+    os.environ['IMAGE_PROCESSING_WORKERS'] = '1'
+    cv2.setNumThreads(1)
+
+
+def _process_item(input_name: str, size: int,
+                  params: Dict[str, Any]) -> Tuple[Optional[str], List[int]]:
+    """
+    在子进程中处理一张精灵图
+    
+    Args:
+        input_name: 存放原始图像字节的共享内存名称
+        size: 原始图像字节数
+        params: 处理参数
+    
+    Returns:
+        (存放各帧编码结果的共享内存名称, 各帧字节数)，没有输出时名称为None
+    """
+    memory = shared_memory.SharedMemory(name=input_name)
+    try:
+        view = memory.buf[:size]
+        try:
+            frames = ImageProcessor.process_sprite_sheet_png(view, **params)
+        except Exception as e:
+            # 回溯中的栈帧引用着共享内存的缓冲区，去掉后才能释放
+            raise e.with_traceback(None)
+        finally:
+            view.release()
+    finally:
+        memory.close()
+    
+    sizes = [len(frame) for frame in frames]
+    if sum(sizes) == 0:
+        return None, sizes
+    
+    # 输出由主进程读取后释放
+    output = shared_memory.SharedMemory(create=True, size=sum(sizes))
+    try:
+        offset = 0
+        for frame in frames:
+            output.buf[offset:offset + len(frame)] = frame
+            offset += len(frame)
+    finally:
+        output.close()
+    return output.name, sizes
+
+
+def _read_output(name: Optional[str], sizes: List[int]) -> List[bytes]:
+    """读取子进程写入共享内存的各帧并释放共享内存"""
+    if name is None:
+        return [b''] * len(sizes)
+    
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        frames = []
+        offset = 0
+        for size in sizes:
+            frames.append(bytes(memory.buf[offset:offset + size]))
+            offset += size
+        return frames
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+class BatchProcessor:
+    """进程池批量处理（每张精灵图在一个子进程中完整处理，不受GIL限制）"""
+    
+    def __init__(self, workers: int = 0, max_items: int = 64):
+        """
+        Args:
+            workers: 进程数，0表示使用全部CPU核心
+            max_items: 单次批量请求的最大图片数
+        """
+        self.workers = resolve_workers(workers)
+        self.max_items = max_items
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls) -> 'BatchProcessor':
+        """根据环境变量创建批量处理器（进程池在首次使用时启动）"""
+        return cls(
+            workers=int(os.getenv('BATCH_WORKERS', 0)),
+            max_items=int(os.getenv('BATCH_MAX_ITEMS', 64))
+        )
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 服务进程是多线程的，fork 不安全，子进程使用 spawn 启动
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker
+                )
+            return self._pool
+    
+    def _discard_pool(self, pool: ProcessPoolExecutor) -> None:
+        """子进程异常退出后进程池不可再用，下次提交时重新创建"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def submit(self, image_data: BufferLike, params: Dict[str, Any]) -> 'Future[List[bytes]]':
+        """
+        提交一张精灵图
+        
+        Args:
+            image_data: 原始图像字节
+            params: 处理参数
+        
+        Returns:
+            结果为各帧编码后字节的 Future，取消它会取消尚未开始的处理
+        """
+        size = memoryview(image_data).nbytes
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        memory.buf[:size] = image_data
+        
+        result: 'Future[List[bytes]]' = Future()
+        try:
+            pool = self._get_pool()
+            try:
+                pool_future = pool.submit(_process_item, memory.name, size, params)
+            except BrokenProcessPool:
+                self._discard_pool(pool)
+                pool = self._get_pool()
+                pool_future = pool.submit(_process_item, memory.name, size, params)
+        except BaseException:
+            memory.close()
+            memory.unlink()
+            raise
+        
+        def on_done(done: Future) -> None:
+            memory.close()
+            memory.unlink()
+            error: Optional[BaseException] = None
+            try:
+                frames = _read_output(*done.result())
+            except CancelledError:
+                result.cancel()
+                return
+            except BrokenProcessPool as e:
+                self._discard_pool(pool)
+                error = e
+            except BaseException as e:
+                error = e
+            
+            # 调用方已放弃该结果时只释放共享内存
+            if not result.set_running_or_notify_cancel():
+                return
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(frames)
+        
+        # 结果在子进程结束后立即取回，调用方提前放弃时共享内存也不会泄漏
+        result.add_done_callback(lambda _: pool_future.cancel() if result.cancelled() else None)
+        pool_future.add_done_callback(on_done)
+        return result
+    
+    def map(self, items: Sequence[BatchItem],
+            ordered: bool = True) -> Iterator[Tuple[int, Optional[List[bytes]], Optional[BaseException]]]:
+        """
+        批量处理，命中结果缓存的项不再提交
+        
+        Args:
+            items: 批量处理项
+            ordered: True时按输入顺序产出，False时按完成顺序产出
+        
+        Yields:
+            (输入序号, 各帧编码后的字节, None) 或 (输入序号, None, 异常)
+        """
+        cache = get_result_cache()
+        futures: Dict[Future, int] = {}
+        keys: Dict[int, str] = {}
+        try:
+            for index, (image_data, params) in enumerate(items):
+                future: 'Future[List[bytes]]'
+                frames = None
+                if cache.enabled:
+                    keys[index] = ImageProcessor.result_key(
+                        image_data, params['rows'], params['cols'], params.get('tolerance', 50),
+                        params.get('mode', 'green'), params.get('interpolation'),
+                        params.get('encoder', DEFAULT_ENCODER)
+                    )
+                    frames = cache.get(keys[index])
+                
+                if frames is not None:
+                    future = Future()
+                    future.set_result(frames)
+                else:
+                    future = self.submit(image_data, params)
+                futures[future] = index
+            
+            for future in (futures if ordered else as_completed(futures)):
+                index = futures[future]
+                try:
+                    frames = future.result()
+                except Exception as e:
+                    yield index, None, e
+                    continue
+                if index in keys:
+                    cache.put(keys[index], frames)
+                yield index, frames, None
+        finally:
+            # 消费方提前停止（如客户端断开）时丢弃尚未开始的处理
+            for future in futures:
+                future.cancel()
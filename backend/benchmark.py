@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+ImageProcessor 性能基准
+用确定性生成的绿幕精灵图测试各处理阶段的耗时、吞吐量和内存峰值，并可与基线结果比较
+
+用法:
+    python benchmark.py                                  # 运行并打印结果
+    python benchmark.py --output results.json            # 保存结果（JSON）
+    python benchmark.py --save-baseline baseline.json    # 保存为基线
+    python benchmark.py --baseline                       # 与仓库中的基线（benchmark_baseline.json）比较，有回归时退出码为1
+    python benchmark.py --baseline baseline.json         # 与指定的基线比较
+    python benchmark.py --engines opencv,lut             # 同时测试绿幕查表引擎，并检查与 opencv 的一致性
+"""
+import os
+import sys
+import json
+import time
+import base64
+import platform
+import argparse
+import statistics
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 基准只测量处理本身，禁用结果缓存
+os.environ['IMAGE_CACHE_MAX_BYTES'] = '0'
+
+# 确保可以导入 image_processor 模块
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import cv2
+
+from image_processor import FRAME_ENCODERS, ImageProcessor, MemoryTracker, resolve_workers
+from key_lut import DEFAULT_KEY_ENGINE, KEY_ENGINES
+
+
+# 结果格式版本，字段变化时递增
+RESULT_VERSION = 1
+
+# 仓库中保存的基线（quick 预设，默认引擎），--baseline 不带路径时使用
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# 基线与本次运行的这些环境信息不同时，耗时不可直接比较
+COMPARABLE_ENVIRONMENT = ('machine', 'cpuCount', 'workers')
+
+# 测试用精灵图：(宽, 高, 行数, 列数)
+FIXTURES = {
+    'quick': [(512, 512, 4, 4), (1024, 512, 2, 4)],
+    'full': [(512, 512, 4, 4), (1024, 1024, 4, 4), (2048, 2048, 8, 8), (2048, 1024, 4, 8)]
+}
+
+# 处理模式：green=绿幕抠图, auto=按左上角颜色去背景, passthrough=不去背景
+MODES = ('green', 'auto', 'passthrough')
+
+# 引擎一致性检查：alpha 差值超过该值的像素计为不一致
+PARITY_ALPHA_TOLERANCE = 8
+
+# 各模式逐帧处理对应的阶段名
+FRAME_STAGES = {
+    'green': 'remove_green_background',
+    'auto': 'remove_background_by_color',
+    'passthrough': 'add_alpha'
+}
+
+
+def make_sprite_sheet(width: int, height: int, rows: int, cols: int, seed: int = 0) -> np.ndarray:
+    """
+    生成确定性的绿幕精灵图（BGR格式）
+    
+    背景为带轻微噪声的绿色，每个格子中有一个位置、大小和颜色随帧变化的角色轮廓，
+    边缘抗锯齿，用于覆盖绿幕边缘和溢色处理。
+    """
+    rng = np.random.default_rng(seed)
+    sheet = np.empty((height, width, 3), dtype=np.uint8)
+    sheet[:] = (40, 200, 60)
+    noise = rng.integers(-6, 7, size=sheet.shape, dtype=np.int16)
+    sheet = np.clip(sheet.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    
+    cell_h, cell_w = height // rows, width // cols
+    for index in range(rows * cols):
+        row, col = divmod(index, cols)
+        cx = col * cell_w + cell_w // 2 + int(rng.integers(-cell_w // 10, cell_w // 10 + 1))
+        cy = row * cell_h + cell_h // 2 + int(rng.integers(-cell_h // 10, cell_h // 10 + 1))
+        radius = max(2, min(cell_w, cell_h) // 4)
+        color = tuple(int(value) for value in rng.integers(0, 160, size=3))
+        cv2.ellipse(sheet, (cx, cy), (radius, int(radius * 1.4)), 0, 0, 360, color, -1, cv2.LINE_AA)
+        cv2.circle(sheet, (cx, cy - int(radius * 1.6)), max(1, radius // 2), (80, 120, 230), -1, cv2.LINE_AA)
+        cv2.rectangle(sheet, (cx - radius, cy + radius), (cx + radius, cy + radius + radius // 3),
+                      (30, 30, 30), -1, cv2.LINE_AA)
+    return sheet
+
+
+def make_fixture(width: int, height: int, rows: int, cols: int) -> Dict[str, Any]:
+    """生成测试用精灵图及其 base64 data URL"""
+    sheet = make_sprite_sheet(width, height, rows, cols, seed=width * 31 + height * 17 + rows * cols)
+    ok, encoded = cv2.imencode('.png', sheet)
+    if not ok:
+        raise RuntimeError('生成测试图片失败')
+    return {
+        'name': f'{width}x{height}-{rows}x{cols}',
+        'width': width,
+        'height': height,
+        'rows': rows,
+        'cols': cols,
+        'image': sheet,
+        'base64': 'data:image/png;base64,' + base64.b64encode(encoded.tobytes()).decode('ascii')
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Tuple[List[float], int]:
+    """
+    运行一个阶段
+    
+    Returns:
+        (每次的耗时列表, 内存峰值字节数)
+    """
+    func()  # 预热
+    
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    
+    # 内存峰值单独运行一次测量，避免 tracemalloc 影响耗时
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return timings, peak
+
+
+def benchmark_fixture(fixture: Dict[str, Any], modes: List[str], tolerance: int,
+                      repeat: int, engines: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+    """测试一张精灵图的所有阶段（engines 为额外测试的抠图引擎，模式列记为 模式/引擎）"""
+    rows, cols = fixture['rows'], fixture['cols']
+    frame_count = rows * cols
+    megapixels = fixture['width'] * fixture['height'] / 1e6
+    image = fixture['image']
+    frames = ImageProcessor.slice_image(image, rows, cols)
+    keyed_frames = [ImageProcessor.remove_green_background(frame, tolerance) for frame in frames]
+    keyed_sheet = ImageProcessor.key_sprite_sheet(image, rows, cols, tolerance, 'green')
+    
+    def mode_name(mode: str) -> str:
+        return 'none' if mode == 'passthrough' else mode
+    
+    # (阶段, 模式, 函数)
+    stages: List[Tuple[str, str, Callable[[], Any]]] = [
+        ('decode_base64_image', '-', lambda: ImageProcessor.decode_base64_image(fixture['base64'])),
+        ('slice_image', '-', lambda: ImageProcessor.slice_image(image, rows, cols)),
+        ('encode_image_to_base64', '-',
+         lambda: [ImageProcessor.encode_image_to_base64(frame) for frame in keyed_frames])
+    ]
+    # 各帧编码器（模式列为编码器名称）
+    for encoder in FRAME_ENCODERS:
+        stages.append(('encode_frame', encoder,
+                       lambda encoder=encoder: [ImageProcessor.encode_frame(frame, encoder)
+                                                for frame in keyed_frames]))
+    # 裁剪透明区域并打包为一张图集（与 encode_frame/png 的耗时和体积对比）
+    stages.append(('pack_atlas', 'png', lambda: ImageProcessor.pack_atlas(keyed_sheet, rows, cols)))
+    for mode in modes:
+        stages.append((FRAME_STAGES[mode], mode,
+                       lambda mode=mode: [ImageProcessor._key_frame(frame, tolerance, mode_name(mode))
+                                          for frame in frames]))
+        stages.append(('key_sprite_sheet', mode,
+                       lambda mode=mode: ImageProcessor.key_sprite_sheet(image, rows, cols, tolerance,
+                                                                         mode_name(mode))))
+        stages.append(('process_sprite_sheet', mode,
+                       lambda mode=mode: ImageProcessor.process_sprite_sheet(
+                           fixture['base64'], rows, cols, tolerance, mode_name(mode))))
+        # 查表引擎只用于绿幕模式
+        if mode != 'green':
+            continue
+        for engine in engines:
+            stages.append(('key_sprite_sheet', f'{mode}/{engine}',
+                           lambda mode=mode, engine=engine: ImageProcessor.key_sprite_sheet(
+                               image, rows, cols, tolerance, mode_name(mode), engine=engine)))
+    
+    results = []
+    for stage, mode, func in stages:
+        timings, peak = measure(func, repeat)
+        median = statistics.median(timings)
+        results.append({
+            'fixture': fixture['name'],
+            'stage': stage,
+            'mode': mode,
+            'frames': frame_count,
+            'megapixels': round(megapixels, 4),
+            'medianSeconds': median,
+            'minSeconds': min(timings),
+            'framesPerSecond': frame_count / median if median > 0 else None,
+            'megapixelsPerSecond': megapixels / median if median > 0 else None,
+            'peakBytes': peak
+        })
+    
+    # 编码器的输出体积
+    for result in results:
+        if result['stage'] == 'encode_frame':
+            result['outputBytes'] = sum(len(ImageProcessor.encode_frame(frame, result['mode']))
+                                        for frame in keyed_frames)
+        elif result['stage'] == 'pack_atlas':
+            result['outputBytes'] = len(ImageProcessor.pack_atlas(keyed_sheet, rows, cols)[0])
+    
+    # 各引擎与 opencv 引擎的 alpha 一致性
+    for result in results:
+        if result['stage'] == 'key_sprite_sheet' and '/' in result['mode']:
+            mode, engine = result['mode'].split('/')
+            expected = ImageProcessor.key_sprite_sheet(image, rows, cols, tolerance, mode_name(mode),
+                                                       engine=DEFAULT_KEY_ENGINE)[..., 3]
+            actual = ImageProcessor.key_sprite_sheet(image, rows, cols, tolerance, mode_name(mode),
+                                                     engine=engine)[..., 3]
+            diff = cv2.absdiff(expected, actual)
+            result['alphaMismatch'] = float(np.count_nonzero(diff > PARITY_ALPHA_TOLERANCE)) / diff.size
+            result['alphaMaxDiff'] = int(diff.max())
+    
+    # 流水线自身统计的内存峰值（不含 OpenCV 临时内存）
+    for mode in modes:
+        tracker = MemoryTracker()
+        ImageProcessor.process_sprite_sheet(fixture['base64'], rows, cols, tolerance,
+                                            mode_name(mode), tracker=tracker)
+        for result in results:
+            if result['stage'] == 'process_sprite_sheet' and result['mode'] == mode:
+                result['pipelinePeakBytes'] = tracker.peak
+    return results
+
+
+def result_id(result: Dict[str, Any]) -> str:
+    return f"{result['fixture']}/{result['mode']}/{result['stage']}"
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any],
+            threshold: float, min_delta: float = 0.001) -> List[Dict[str, Any]]:
+    """
+    与基线比较中位耗时
+    
+    Args:
+        results: 本次结果
+        baseline: 基线文件内容
+        threshold: 允许的变慢比例（0.25 表示慢 25% 以内不算回归）
+        min_delta: 绝对变慢不超过该秒数时不算回归（避免极短阶段的计时噪声）
+    
+    Returns:
+        比较结果列表，regression 为 True 表示回归
+    """
+    baseline_results = {result_id(result): result for result in baseline.get('results', [])}
+    comparisons = []
+    for result in results:
+        previous = baseline_results.get(result_id(result))
+        if previous is None or not previous.get('medianSeconds'):
+            continue
+        ratio = result['medianSeconds'] / previous['medianSeconds']
+        comparisons.append({
+            'id': result_id(result),
+            'baselineSeconds': previous['medianSeconds'],
+            'currentSeconds': result['medianSeconds'],
+            'ratio': ratio,
+            'regression': (ratio > 1 + threshold
+                           and result['medianSeconds'] - previous['medianSeconds'] > min_delta)
+        })
+    return comparisons
+
+
+def environment_info(workers: int) -> Dict[str, Any]:
+    """运行环境信息，便于判断不同结果是否可比"""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpuCount': os.cpu_count(),
+        'workers': workers
+    }
+
+
+def print_results(results: List[Dict[str, Any]], comparisons: Optional[List[Dict[str, Any]]]) -> None:
+    ratios = {item['id']: item for item in comparisons or []}
+    header = (f"{'fixture':<16} {'mode':<14} {'stage':<28} {'median ms':>10} {'frames/s':>10} "
+              f"{'MP/s':>9} {'peak MB':>8} {'out KB':>8}")
+    if comparisons is not None:
+        header += f" {'vs base':>8}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        output = f"{result['outputBytes'] / 1024:.1f}" if 'outputBytes' in result else '-'
+        line = (f"{result['fixture']:<16} {result['mode']:<14} {result['stage']:<28} "
+                f"{result['medianSeconds'] * 1000:>10.2f} {result['framesPerSecond'] or 0:>10.1f} "
+                f"{result['megapixelsPerSecond'] or 0:>9.1f} {result['peakBytes'] / 1024 / 1024:>8.1f} "
+                f"{output:>8}")
+        comparison = ratios.get(result_id(result))
+        if comparison is not None:
+            line += f" {comparison['ratio']:>7.2f}x"
+            if comparison['regression']:
+                line += '  ← 回归'
+        print(line)
+    
+    for result in results:
+        if 'alphaMismatch' in result:
+            print(f"一致性 {result['fixture']} {result['mode']}: "
+                  f"{result['alphaMismatch'] * 100:.3f}% 像素的 alpha 差值超过 {PARITY_ALPHA_TOLERANCE}"
+                  f"（最大差值 {result['alphaMaxDiff']}）")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='ImageProcessor 性能基准')
+    parser.add_argument('--preset', choices=sorted(FIXTURES), default='quick', help='测试图片规模')
+    parser.add_argument('--modes', default=','.join(MODES), help='逗号分隔的处理模式')
+    parser.add_argument('--repeat', type=int, default=5, help='每个阶段的重复次数（取中位数）')
+    parser.add_argument('--tolerance', type=int, default=50, help='去背景容差')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', nargs='?', const=DEFAULT_BASELINE,
+                        help='与该基线文件比较（不带路径时为 benchmark_baseline.json）')
+    parser.add_argument('--save-baseline', help='把结果保存为基线文件')
+    parser.add_argument('--threshold', type=float, default=0.25, help='判定回归的变慢比例')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help='绝对变慢小于该毫秒数时不算回归')
+    parser.add_argument('--engines', default=DEFAULT_KEY_ENGINE,
+                        help=f"逗号分隔的抠图引擎（可选 {', '.join(KEY_ENGINES)}），非默认引擎会与默认引擎比较一致性")
+    parser.add_argument('--max-mismatch', type=float, default=0.01,
+                        help='非默认引擎允许的 alpha 不一致像素比例，超过时退出码为1')
+    args = parser.parse_args(argv)
+    
+    baseline = None
+    if args.baseline:
+        # 先读基线，基线缺失或无效时不必运行完整测试
+        try:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            parser.error(f'基线文件不存在: {args.baseline}（先用 --save-baseline 生成）')
+        except json.JSONDecodeError as e:
+            parser.error(f'基线文件不是有效的 JSON: {args.baseline}: {e}')
+        if baseline.get('version') != RESULT_VERSION:
+            parser.error(f"基线文件的格式版本为 {baseline.get('version')}，"
+                         f'当前为 {RESULT_VERSION}，请重新生成基线')
+    
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"未知模式: {', '.join(unknown)}（可选 {', '.join(MODES)}）")
+    engines = tuple(engine.strip() for engine in args.engines.split(',') if engine.strip())
+    unknown = [engine for engine in engines if engine not in KEY_ENGINES]
+    if unknown:
+        parser.error(f"未知引擎: {', '.join(unknown)}（可选 {', '.join(KEY_ENGINES)}）")
+    engines = tuple(engine for engine in engines if engine != DEFAULT_KEY_ENGINE)
+    
+    results = []
+    for width, height, rows, cols in FIXTURES[args.preset]:
+        fixture = make_fixture(width, height, rows, cols)
+        print(f"测试 {fixture['name']} ...", file=sys.stderr)
+        results.extend(benchmark_fixture(fixture, modes, args.tolerance, args.repeat, engines))
+    
+    report = {
+        'version': RESULT_VERSION,
+        'preset': args.preset,
+        'repeat': args.repeat,
+        'tolerance': args.tolerance,
+        'timestamp': time.time(),
+        'environment': environment_info(resolve_workers()),
+        'results': results
+    }
+    
+    comparisons = None
+    if baseline is not None:
+        baseline_environment = baseline.get('environment', {})
+        differences = [f"{key}: {baseline_environment.get(key)} → {report['environment'][key]}"
+                       for key in COMPARABLE_ENVIRONMENT
+                       if baseline_environment.get(key) != report['environment'][key]]
+        if differences:
+            print(f"警告: 基线在不同的环境中生成（{'，'.join(differences)}），耗时仅供参考",
+                  file=sys.stderr)
+        comparisons = compare(results, baseline, args.threshold, args.min_delta_ms / 1000)
+        report['baseline'] = {
+            'path': args.baseline,
+            'threshold': args.threshold,
+            'minDeltaSeconds': args.min_delta_ms / 1000,
+            'comparisons': comparisons
+        }
+    
+    print_results(results, comparisons)
+    
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    
+    if any(result.get('alphaMismatch', 0) > args.max_mismatch for result in results):
+        print('抠图引擎结果不一致', file=sys.stderr)
+        return 1
+    if comparisons is not None and not comparisons:
+        print(f"基线中没有可比较的结果（基线预设 {baseline.get('preset')}，本次 {args.preset}）",
+              file=sys.stderr)
+        return 1
+    if comparisons and any(item['regression'] for item in comparisons):
+        print('检测到性能回归', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
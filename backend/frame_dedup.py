@@ -0,0 +1,137 @@
+"""
+重复帧检测模块
+按帧内容指纹（精确哈希 + 可选的感知哈希）找出重复和近似重复的帧，
+去背景、编码和传输只需对每个不同的帧进行一次
+"""
+import hashlib
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import cv2
+
+
+# 感知哈希（dHash）的边长，哈希位数为其平方
+PERCEPTUAL_HASH_SIZE = 8
+
+# 近似重复的最大汉明距离阈值（0 表示只合并完全相同的帧）
+MAX_DEDUPE_THRESHOLD = 16
+
+
+class FrameDeduplicator:
+    """重复帧检测：refs[i] 为与第 i 帧相同的第一帧的序号（不重复的帧 refs[i] == i）"""
+    
+    @staticmethod
+    def exact_hashes(frames: Sequence[np.ndarray]) -> List[bytes]:
+        """
+        每帧像素的精确哈希
+        
+        Args:
+            frames: 帧列表（可以是视图）
+        
+        Returns:
+            每帧的摘要，相同的摘要表示像素完全相同
+        """
+        return [hashlib.blake2b(np.ascontiguousarray(frame), digest_size=16).digest()
+                for frame in frames]
+    
+    @staticmethod
+    def perceptual_hashes(frames: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        每帧的差值哈希（dHash）：缩小为 (N+1)×N 的灰度图后比较水平相邻像素
+        
+        Args:
+            frames: 帧列表（BGR或BGRA格式）
+        
+        Returns:
+            (帧数, N*N/8) 的 uint8 数组，按位比较汉明距离
+        """
+        size = PERCEPTUAL_HASH_SIZE
+        bits = np.empty((len(frames), size, size), dtype=bool)
+        for index, frame in enumerate(frames):
+            code = cv2.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+            small = cv2.resize(cv2.cvtColor(frame, code), (size + 1, size),
+                               interpolation=cv2.INTER_AREA)
+            bits[index] = small[:, 1:] > small[:, :-1]
+        return np.packbits(bits.reshape(len(frames), -1), axis=1)
+    
+    @classmethod
+    def find_duplicates(cls, frames: Sequence[np.ndarray], threshold: int = 0) -> np.ndarray:
+        """
+        找出重复帧
+        
+        Args:
+            frames: 帧列表（尺寸一致，可以是视图）
+            threshold: 感知哈希的汉明距离阈值，0时只合并像素完全相同的帧；
+                       大于0时距离不超过阈值的帧视为近似重复，以先出现的帧代替（有损）
+        
+        Returns:
+            (帧数,) 的 refs 数组
+        """
+        refs = np.arange(len(frames))
+        first_seen = {}
+        for index, digest in enumerate(cls.exact_hashes(frames)):
+            refs[index] = first_seen.setdefault(digest, index)
+        if threshold <= 0:
+            return refs
+        
+        # 近似重复只与不同的帧比较，按出现顺序贪心归并
+        unique = np.flatnonzero(refs == np.arange(len(frames)))
+        hashes = cls.perceptual_hashes([frames[index] for index in unique])
+        representatives: List[int] = []
+        for position, index in enumerate(unique):
+            if representatives:
+                different = hashes[representatives] ^ hashes[position]
+                distances = np.unpackbits(different, axis=1).sum(axis=1)
+                closest = int(distances.argmin())
+                if distances[closest] <= threshold:
+                    refs[index] = unique[representatives[closest]]
+                    continue
+            representatives.append(position)
+        
+        # 精确重复的帧指向其代表帧最终归并到的帧
+        return refs[refs]
+    
+    @staticmethod
+    def interpolated_refs(refs: np.ndarray, count: int) -> np.ndarray:
+        """
+        插帧后序列的 refs：原始帧沿用原来的归并结果，两个中间帧的前后原始帧归并结果相同、
+        插入位置也相同时内容相同
+        
+        Args:
+            refs: 插帧前的 refs
+            count: 每两帧之间插入的帧数
+        
+        Returns:
+            插帧后序列的 refs（序号为插帧后的序号）
+        """
+        if len(refs) < 2 or count < 1:
+            return refs
+        
+        step = count + 1
+        total = len(refs) + (len(refs) - 1) * count
+        out = np.arange(total)
+        first_seen = {}
+        for index in range(total):
+            pair, offset = divmod(index, step)
+            if offset == 0:
+                key: Tuple[int, ...] = (int(refs[pair]),)
+            else:
+                key = (int(refs[pair]), int(refs[pair + 1]), offset)
+            out[index] = first_seen.setdefault(key, index)
+        return out
+    
+    @staticmethod
+    def compact(refs: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+        """
+        把 refs 转换为不同帧的列表和引用
+        
+        Args:
+            refs: 见 find_duplicates
+        
+        Returns:
+            (不同帧的序号, 每帧在不同帧列表中的位置)
+        """
+        unique = np.flatnonzero(refs == np.arange(len(refs)))
+        positions = np.empty(len(refs), dtype=np.int64)
+        positions[unique] = np.arange(len(unique))
+        return unique, positions[refs].tolist()
@@ -0,0 +1,156 @@
+"""
+帧插值模块
+在相邻帧之间批量生成过渡帧：线性混合（与前端 frameInterpolation.js 一致）或光流变形
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+import cv2
+
+from image_processor import parallel_map
+
+
+# 支持的插值模式
+INTERPOLATION_MODES = ('linear', 'flow')
+
+# 每两帧之间最多插入的帧数
+MAX_INTERPOLATION_COUNT = 8
+
+# 线性混合时每批中间结果（uint16）的内存上限（字节）
+LINEAR_BATCH_BYTES = 32 * 1024 * 1024
+
+
+class FrameInterpolator:
+    """帧插值器"""
+    
+    @staticmethod
+    def output_count(frame_count: int, count: int) -> int:
+        """插帧后的总帧数"""
+        if frame_count < 2 or count < 1:
+            return frame_count
+        return frame_count + (frame_count - 1) * count
+    
+    @staticmethod
+    def blend_weights(count: int, smooth: bool = False) -> np.ndarray:
+        """
+        每个中间帧的插值比例 t = j / (count + 1)
+        
+        Args:
+            count: 每两帧之间插入的帧数
+            smooth: 是否使用 ease-in-out cubic 缓动
+        
+        Returns:
+            形状为 (count,) 的比例数组
+        """
+        t = np.arange(1, count + 1, dtype=np.float64) / (count + 1)
+        if smooth:
+            t = np.where(t < 0.5, 4 * t ** 3, 1 - (2 - 2 * t) ** 3 / 2)
+        return t
+    
+    @classmethod
+    def interpolate(cls, frames: Sequence[np.ndarray], count: int, mode: str = 'linear',
+                    smooth: bool = False, workers: Optional[int] = None) -> np.ndarray:
+        """
+        在每对相邻帧之间插入中间帧
+        
+        Args:
+            frames: 帧列表（BGRA格式，尺寸一致）
+            count: 每两帧之间插入的帧数
+            mode: 'linear'=逐像素线性混合, 'flow'=稠密光流变形后混合
+            smooth: 是否使用 ease-in-out 缓动
+            workers: 光流模式下逐对处理的线程数
+        
+        Returns:
+            插帧后的帧数组，形状为 (总帧数, 高, 宽, 4)，原始帧位于 (count + 1) 的整数倍位置
+        """
+        if mode not in INTERPOLATION_MODES:
+            raise ValueError(f'不支持的插值模式: {mode}')
+        
+        source = np.stack(frames)
+        if len(source) < 2 or count < 1:
+            return source
+        
+        pairs = len(source) - 1
+        out = np.empty((cls.output_count(len(source), count),) + source.shape[1:], dtype=np.uint8)
+        out[::count + 1] = source
+        
+        # 除最后一帧外，按 (帧对, 原始帧 + 中间帧) 分组的视图；中间帧直接写入其中
+        grouped = out[:-1].reshape((pairs, count + 1) + source.shape[1:])
+        weights = cls.blend_weights(count, smooth)
+        
+        if mode == 'linear':
+            cls._blend_linear(source, grouped[:, 1:], weights)
+        else:
+            def warp_pair(index: int) -> None:
+                grouped[index, 1:] = cls._blend_flow(source[index], source[index + 1], weights)
+            
+            parallel_map(warp_pair, range(pairs), workers)
+        
+        return out
+    
+    @staticmethod
+    def _blend_linear(source: np.ndarray, target: np.ndarray, weights: np.ndarray) -> None:
+        """
+        批量线性混合（8位定点运算），结果写入 target
+        
+        Args:
+            source: 原始帧数组 (帧数, 高, 宽, 4)
+            target: 中间帧视图 (帧对数, count, 高, 宽, 4)
+            weights: 插值比例
+        """
+        pairs, count = target.shape[:2]
+        fixed = np.round(weights * 256).astype(np.uint16).reshape(1, count, 1, 1, 1)
+        inverse = 256 - fixed
+        
+        # 按内存上限分批：每批处理若干帧对的全部中间帧
+        pair_bytes = count * source[0].size * 2 * 3
+        batch = max(1, LINEAR_BATCH_BYTES // max(pair_bytes, 1))
+        for start in range(0, pairs, batch):
+            stop = min(start + batch, pairs)
+            first = source[start:stop, None].astype(np.uint16)
+            second = source[start + 1:stop + 1, None].astype(np.uint16)
+            blended = first * inverse
+            blended += second * fixed
+            blended += 128
+            blended >>= 8
+            target[start:stop] = blended
+    
+    @staticmethod
+    def _flow_input(frame: np.ndarray) -> np.ndarray:
+        """光流输入：按 alpha 预乘的灰度图，透明区域为黑色"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGRA2GRAY)
+        return cv2.multiply(gray, frame[:, :, 3], scale=1 / 255)
+    
+    @classmethod
+    def _blend_flow(cls, first: np.ndarray, second: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        用双向稠密光流（Farneback）变形两帧后混合
+        
+        中间时刻的光流按线性运动假设由双向光流近似：
+        F(t→0) = -(1-t)·t·F(0→1) + t²·F(1→0)，F(t→1) = (1-t)²·F(0→1) - t·(1-t)·F(1→0)
+        
+        Returns:
+            中间帧数组 (count, 高, 宽, 4)
+        """
+        gray_first = cls._flow_input(first)
+        gray_second = cls._flow_input(second)
+        flow_forward = cv2.calcOpticalFlowFarneback(gray_first, gray_second, None,
+                                                    0.5, 3, 15, 3, 5, 1.2, 0)
+        flow_backward = cv2.calcOpticalFlowFarneback(gray_second, gray_first, None,
+                                                     0.5, 3, 15, 3, 5, 1.2, 0)
+        
+        height, width = first.shape[:2]
+        grid = np.dstack(np.meshgrid(np.arange(width, dtype=np.float32),
+                                     np.arange(height, dtype=np.float32)))
+        
+        results = np.empty((len(weights),) + first.shape, dtype=np.uint8)
+        for index, t in enumerate(weights.astype(np.float32)):
+            flow_to_first = -(1 - t) * t * flow_forward + t * t * flow_backward
+            flow_to_second = (1 - t) ** 2 * flow_forward - t * (1 - t) * flow_backward
+            warped_first = cv2.remap(first, grid + flow_to_first, None, cv2.INTER_LINEAR,
+                                     borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+            warped_second = cv2.remap(second, grid + flow_to_second, None, cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+            cv2.addWeighted(warped_first, float(1 - t), warped_second, float(t), 0,
+                            dst=results[index])
+        return results
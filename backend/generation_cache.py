@@ -0,0 +1,262 @@
+"""
+AI 生成缓存模块
+按 (模型, 完整 prompt) 在磁盘上缓存上游返回的原始图片，并合并并发的相同请求（single-flight）
+"""
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class GenerationCache:
+    """磁盘缓存：按总大小和存活时间淘汰（线程安全）"""
+    
+    def __init__(self, cache_dir: Optional[str], max_bytes: int = 512 * 1024 * 1024,
+                 max_age: float = 7 * 24 * 3600):
+        """
+        Args:
+            cache_dir: 缓存目录，None表示禁用
+            max_bytes: 缓存总大小上限（字节）
+            max_age: 条目最长存活时间（秒）
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    @classmethod
+    def from_env(cls) -> 'GenerationCache':
+        """根据环境变量创建缓存"""
+        return cls(
+            cache_dir=os.getenv('GENERATION_CACHE_DIR') or None,
+            max_bytes=int(os.getenv('GENERATION_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+            max_age=float(os.getenv('GENERATION_CACHE_MAX_AGE', 7 * 24 * 3600))
+        )
+    
+    @property
+    def enabled(self) -> bool:
+        return self.cache_dir is not None
+    
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        """缓存键：模型 + 完整渲染后的 prompt"""
+        return hashlib.sha256(f'{model}\n{prompt}'.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """
+        查询缓存
+        
+        Returns:
+            (图片字节, MIME类型)，未命中或已过期时返回None
+        """
+        if not self.enabled:
+            return None
+        
+        path = self._find(key)
+        if path is not None and time.time() - path.stat().st_mtime > self.max_age:
+            self._remove(path)
+            path = None
+        
+        if path is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        try:
+            data = path.read_bytes()
+            # 更新修改时间，按最近使用顺序淘汰
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        with self._lock:
+            self.hits += 1
+        return data, f'image/{path.suffix.lstrip(".")}'
+    
+    def put(self, key: str, data: bytes, mime_type: str) -> None:
+        """写入缓存，超出总大小时淘汰最久未使用的条目"""
+        if not self.enabled:
+            return
+        
+        suffix = mime_type.split('/')[-1] if mime_type.startswith('image/') else 'png'
+        path = self.cache_dir / f'{key}.{suffix}'  # type: ignore
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'写入生成缓存失败: {e}')
+            return
+        
+        self._evict()
+    
+    def stats(self) -> Dict[str, Any]:
+        """导出命中统计和占用情况"""
+        entries = self._entries() if self.enabled else []
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(size for _, _, size in entries),
+                'maxBytes': self.max_bytes,
+                'maxAge': self.max_age
+            }
+    
+    def _find(self, key: str) -> Optional[Path]:
+        for path in self.cache_dir.glob(f'{key}.*'):  # type: ignore
+            if not path.name.endswith('.tmp'):
+                return path
+        return None
+    
+    def _entries(self):
+        """(路径, 修改时间, 大小) 列表，按修改时间从旧到新"""
+        entries = []
+        for path in self.cache_dir.iterdir():  # type: ignore
+            if path.name.endswith('.tmp'):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+    
+    def _remove(self, path: Path) -> None:
+        try:
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
+    
+    def _evict(self) -> None:
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        deadline = time.time() - self.max_age
+        for path, mtime, size in entries:
+            if total <= self.max_bytes and mtime >= deadline:
+                break
+            self._remove(path)
+            total -= size
+
+
+class SingleFlight:
+    """
+    合并并发的相同调用：同一个键同一时间只执行一次，其余调用方共享结果
+    
+    线程（do）和协程（do_async）共用同一张调用表，两种调用方可以互相等待
+    """
+    
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.exception: Optional[BaseException] = None
+            # 等待中的协程：(事件循环, Future)
+            self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+    
+    def __init__(self):
+        self._calls: Dict[str, 'SingleFlight._Call'] = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+    
+    def do(self, key: str, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行或等待同键调用
+        
+        Args:
+            key: 调用键
+            func: 实际执行的函数
+        
+        Returns:
+            (结果, 是否共享了其他调用方的结果)
+        """
+        with self._lock:
+            existing = self._calls.get(key)
+            if existing is None:
+                call = self._calls[key] = self._Call()
+            else:
+                call = existing
+                self.shared += 1
+        
+        if existing is not None:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+        
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            self._complete(key, call)
+        return call.result, False
+    
+    async def do_async(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        do 的协程版本：等待同键调用时不占用线程
+        
+        Args:
+            key: 调用键
+            func: 实际执行的协程函数
+        
+        Returns:
+            (结果, 是否共享了其他调用方的结果)
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            existing = self._calls.get(key)
+            if existing is None:
+                call = self._calls[key] = self._Call()
+            else:
+                call = existing
+                self.shared += 1
+                waiter = loop.create_future()
+                call.waiters.append((loop, waiter))
+        
+        if existing is not None:
+            await waiter
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+        
+        try:
+            call.result = await func()
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            self._complete(key, call)
+        return call.result, False
+    
+    def _complete(self, key: str, call: 'SingleFlight._Call') -> None:
+        """移除调用并唤醒等待的线程和协程"""
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+        for loop, waiter in call.waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    """唤醒等待的协程（已被取消的忽略）"""
+    if not waiter.done():
+        waiter.set_result(None)
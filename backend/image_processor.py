@@ -3,56 +3,426 @@
 提供专业的绿幕抠图和图像切割功能
 """
 import io
-import base64
-from typing import List, Tuple
+import os
+import json
+import hashlib
+import binascii
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple, TypeVar, Union)
 import numpy as np
 from PIL import Image
 import cv2
 
+from result_cache import ResultCache
+from key_lut import DEFAULT_KEY_ENGINE, get_key_luts, resolve_key_engine
+from atlas import DEFAULT_ATLAS_PADDING, AtlasPacker
+from frame_dedup import FrameDeduplicator
+from metrics import StageTimer, timed
+
+
+# 可直接解码的原始图像缓冲区类型
+BufferLike = Union[bytes, bytearray, memoryview]
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# 处理算法版本，改变输出结果时需要递增（参与缓存键和ETag计算）
+PIPELINE_VERSION = 1
+
+# 按线程数缓存的线程池（OpenCV和zlib在计算时会释放GIL）
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+_result_cache: Optional[ResultCache] = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """获取全局结果缓存（首次使用时根据环境变量创建）"""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache.from_env()
+    return _result_cache
+
+
+def resolve_workers(workers: Optional[int] = None) -> int:
+    """
+    确定逐帧处理使用的线程数
+    
+    Args:
+        workers: 显式指定的线程数，None时读取环境变量 IMAGE_PROCESSING_WORKERS
+                 （0表示使用全部CPU核心，默认1即串行）
+        
+    Returns:
+        线程数（至少为1）
+    """
+    if workers is None:
+        workers = int(os.getenv('IMAGE_PROCESSING_WORKERS', 1))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def parallel_map(func: Callable[[T], R], items: Iterable[T],
+                 workers: Optional[int] = None) -> List[R]:
+    """
+    并发执行并保持结果顺序
+    
+    Args:
+        func: 处理函数
+        items: 输入序列
+        workers: 线程数（见 resolve_workers）
+        
+    Returns:
+        与输入顺序一致的结果列表
+    """
+    workers = resolve_workers(workers)
+    items = list(items)
+    if workers == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    
+    return list(_get_executor(workers).map(func, items))
+
+
+def parallel_imap(func: Callable[[T], R], items: Iterable[T],
+                  workers: Optional[int] = None) -> Iterator[R]:
+    """
+    并发执行并按输入顺序逐个产出结果
+    
+    最多同时提交 2 * workers 个任务，已产出的结果不再被持有（用于流式响应）。
+    
+    Args:
+        func: 处理函数
+        items: 输入序列
+        workers: 线程数（见 resolve_workers）
+        
+    Yields:
+        与输入顺序一致的结果
+    """
+    workers = resolve_workers(workers)
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    executor = _get_executor(workers)
+    pending: Deque[Future] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # 消费方提前停止（如客户端断开）时丢弃尚未开始的任务
+        for future in pending:
+            future.cancel()
+
+
+def _get_executor(workers: int) -> ThreadPoolExecutor:
+    with _executors_lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers,
+                                          thread_name_prefix='image-worker')
+            _executors[workers] = executor
+    return executor
+
+
+class ImageTooLargeError(ValueError):
+    """图像像素数超过限制（IMAGE_MAX_PIXELS）"""
+
+
+def max_image_pixels() -> int:
+    """
+    单张图像允许的最大像素数（解码前检查）
+    
+    Returns:
+        环境变量 IMAGE_MAX_PIXELS 的值（默认 134217728，即 16384×8192），0表示不限制
+    """
+    return int(os.getenv('IMAGE_MAX_PIXELS', 16384 * 8192))
+
+
+class MemoryTracker:
+    """
+    记录单次请求中流水线持有的缓冲区大小及峰值
+    
+    只统计流水线自身持有的图像缓冲区（原始字节、解码图、抠图结果、编码输出等），
+    不包含OpenCV内部的临时内存。
+    """
+    
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._held: Dict[str, int] = {}
+    
+    def hold(self, name: str, nbytes: int) -> None:
+        """登记一块缓冲区（同名缓冲区会被替换）"""
+        self.release(name)
+        self._held[name] = nbytes
+        self.current += nbytes
+        self.peak = max(self.peak, self.current)
+    
+    def release(self, name: str) -> None:
+        """释放一块缓冲区"""
+        self.current -= self._held.pop(name, 0)
+    
+    def to_dict(self) -> Dict[str, int]:
+        """导出统计信息"""
+        return {'peakBytes': self.peak, 'currentBytes': self.current}
+
+
+class FrameEncoder:
+    """
+    帧编码器（OpenCV imencode）
+    
+    给出多组编码参数时分别编码，保留体积最小的结果（压缩效果与图像内容有关）。
+    """
+    
+    def __init__(self, format: str, *candidates: Sequence[int]):
+        """
+        Args:
+            format: 输出格式（png / webp）
+            candidates: 一组或多组 OpenCV 编码参数
+        """
+        self.format = format
+        self.mimetype = f'image/{format}'
+        self.candidates = [list(params) for params in candidates] or [[]]
+    
+    def encode(self, image: np.ndarray) -> np.ndarray:
+        """
+        编码单帧
+        
+        Args:
+            image: BGRA或BGR格式的图像（可以是视图）
+            
+        Returns:
+            编码后的字节（一维uint8数组，支持缓冲区协议）
+        """
+        best = None
+        for params in self.candidates:
+            ok, encoded = cv2.imencode(f'.{self.format}', image, params)
+            if not ok:
+                raise ValueError(f'图像编码失败: {self.format}')
+            if best is None or len(encoded) < len(best):
+                best = encoded
+        return best
+
+
+# 可选的帧编码器；png 为默认（zlib 级别6，与PIL默认一致），可在此注册新的编码器
+FRAME_ENCODERS: Dict[str, FrameEncoder] = {
+    'png': FrameEncoder('png', [cv2.IMWRITE_PNG_COMPRESSION, 6]),
+    # 最快的 deflate 级别，体积通常大 5%-40%
+    'png-fast': FrameEncoder('png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    # 最高压缩级别下分别尝试默认、过滤和 RLE 策略并取最小，耗时为默认的数倍
+    'png-max': FrameEncoder(
+        'png',
+        [cv2.IMWRITE_PNG_COMPRESSION, 9],
+        [cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_FILTERED],
+        [cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+    ),
+    # 质量大于100时为无损
+    'webp-lossless': FrameEncoder('webp', [cv2.IMWRITE_WEBP_QUALITY, 101])
+}
+
+# 编码预设：preview=交互预览（速度优先），export=最终导出（体积优先）
+ENCODER_PRESETS = {
+    'preview': 'png-fast',
+    'export': 'png-max'
+}
+
+DEFAULT_ENCODER = 'png'
+
+
+def resolve_encoder(name: Optional[str] = None) -> str:
+    """
+    把编码器或预设名称解析为编码器名称
+    
+    Args:
+        name: FRAME_ENCODERS 或 ENCODER_PRESETS 中的名称，None时使用默认编码器
+    
+    Returns:
+        FRAME_ENCODERS 中的名称
+    
+    Raises:
+        ValueError: 名称不存在
+    """
+    name = ENCODER_PRESETS.get(name or DEFAULT_ENCODER, name or DEFAULT_ENCODER)
+    if name not in FRAME_ENCODERS:
+        choices = ', '.join(list(FRAME_ENCODERS) + list(ENCODER_PRESETS))
+        raise ValueError(f'不支持的编码器: {name}（可选 {choices}）')
+    return name
+
 
 class ImageProcessor:
     """图像处理器类"""
     
     @staticmethod
-    def decode_base64_image(base64_str: str) -> np.ndarray:
+    def decode_base64_payload(base64_str: str) -> bytes:
         """
-        解码base64图像
+        解码base64字符串为原始字节（不复制data:image前缀后的子串）
         
         Args:
             base64_str: base64编码的图像字符串（可能包含data:image前缀）
             
         Returns:
-            numpy数组格式的图像（BGR格式）
+            原始图像字节
         """
+        payload = memoryview(base64_str.encode('ascii'))
+        
         # 移除data:image前缀
-        if ',' in base64_str:
-            base64_str = base64_str.split(',')[1]
-        
-        # 解码base64
-        image_data = base64.b64decode(base64_str)
-        
-        # 转换为PIL Image
-        pil_image = Image.open(io.BytesIO(image_data))
-        
-        # 转换为numpy数组
-        if pil_image.mode == 'RGBA':
-            image_array = np.array(pil_image)
-            # RGBA转BGR（OpenCV格式）
-            bgr_image = cv2.cvtColor(image_array, cv2.COLOR_RGBA2BGR)
-        elif pil_image.mode == 'RGB':
-            image_array = np.array(pil_image)
-            # RGB转BGR
-            bgr_image = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
-        else:
-            # 其他格式先转RGB再转BGR
+        comma = base64_str.find(',')
+        if comma >= 0:
+            payload = payload[comma + 1:]
+        
+        return binascii.a2b_base64(payload)
+    
+    @staticmethod
+    def image_size(data: BufferLike) -> Optional[Tuple[int, int]]:
+        """
+        只读取文件头获取图像尺寸（不解码像素）
+        
+        Args:
+            data: 原始图像字节
+            
+        Returns:
+            (宽, 高)，无法识别的格式返回None
+        """
+        # PNG 的宽高固定位于 IHDR 块开头
+        header = bytes(memoryview(data)[:24])
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+            return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+        
+        # 其他格式由PIL解析文件头（打开时不解码像素）
+        try:
+            with Image.open(io.BytesIO(data)) as pil_image:
+                return pil_image.size
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(f'图像过大: {e}') from None
+        except Exception:
+            return None
+    
+    @classmethod
+    def check_image_size(cls, data: BufferLike,
+                         max_pixels: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """
+        解码前检查图像像素数
+        
+        Args:
+            data: 原始图像字节
+            max_pixels: 最大像素数，None时读取环境变量（见 max_image_pixels），0表示不限制
+            
+        Returns:
+            (宽, 高)，无法识别的格式返回None（交给解码器报错）
+            
+        Raises:
+            ImageTooLargeError: 像素数超过限制
+        """
+        if max_pixels is None:
+            max_pixels = max_image_pixels()
+        size = cls.image_size(data)
+        if size is not None and max_pixels > 0 and size[0] * size[1] > max_pixels:
+            raise ImageTooLargeError(
+                f'图像尺寸 {size[0]}x{size[1]} 超过限制（最多 {max_pixels} 像素）'
+            )
+        return size
+    
+    @classmethod
+    def should_tile(cls, image_data: BufferLike, tiled: Optional[bool] = None) -> bool:
+        """
+        是否按行分块处理（见 iter_tiled_frames）
+        
+        Args:
+            image_data: 原始图像字节
+            tiled: 显式指定；None时像素数达到环境变量 IMAGE_TILED_MIN_PIXELS
+                   （默认 16777216，即 4096×4096，0表示不自动分块）的图像分块处理
+            
+        Returns:
+            是否分块处理
+        """
+        if tiled is not None:
+            return tiled
+        threshold = int(os.getenv('IMAGE_TILED_MIN_PIXELS', 4096 * 4096))
+        if threshold <= 0:
+            return False
+        size = cls.image_size(image_data)
+        return size is not None and size[0] * size[1] >= threshold
+    
+    @staticmethod
+    def decode_image_bytes(data: BufferLike) -> np.ndarray:
+        """
+        直接从原始缓冲区解码图像
+        
+        Args:
+            data: 原始图像字节（bytes / bytearray / memoryview，不会被复制）
+            
+        Returns:
+            numpy数组格式的图像（BGR格式）
+            
+        Raises:
+            ImageTooLargeError: 像素数超过 IMAGE_MAX_PIXELS（只读取文件头判断，不会先解码）
+        """
+        ImageProcessor.check_image_size(data)
+        
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is not None:
+            return image
+        
+        # OpenCV不支持的格式（如GIF）退回PIL
+        pil_image = Image.open(io.BytesIO(data))
+        if pil_image.mode != 'RGB':
             pil_image = pil_image.convert('RGB')
-            image_array = np.array(pil_image)
-            bgr_image = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+        return cv2.cvtColor(np.asarray(pil_image), cv2.COLOR_RGB2BGR)
+    
+    @classmethod
+    def decode_base64_image(cls, base64_str: str) -> np.ndarray:
+        """
+        解码base64图像
         
-        return bgr_image
+        Args:
+            base64_str: base64编码的图像字符串（可能包含data:image前缀）
+            
+        Returns:
+            numpy数组格式的图像（BGR格式）
+        """
+        return cls.decode_image_bytes(cls.decode_base64_payload(base64_str))
     
     @staticmethod
-    def encode_image_to_base64(image: np.ndarray, format: str = 'PNG') -> str:
+    def encode_image(image: np.ndarray, format: str = 'PNG') -> np.ndarray:
+        """
+        将图像编码为图片文件字节
+        
+        Args:
+            image: numpy数组格式的图像（BGRA或BGR格式，可以是视图）
+            format: 输出格式（PNG或JPEG）
+            
+        Returns:
+            编码后的字节（一维uint8数组，支持缓冲区协议）
+        """
+        if image.ndim != 3 or image.shape[2] not in (3, 4):
+            raise ValueError(f"不支持的图像通道数: {image.shape[2] if image.ndim == 3 else 1}")
+        
+        params = []
+        if format.upper() == 'PNG':
+            # 与PIL默认的zlib压缩级别保持一致
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
+        
+        ok, encoded = cv2.imencode(f'.{format.lower()}', image, params)
+        if not ok:
+            raise ValueError(f"图像编码失败: {format}")
+        return encoded
+    
+    @classmethod
+    def encode_image_to_base64(cls, image: np.ndarray, format: str = 'PNG') -> str:
         """
         将图像编码为base64字符串
         
@@ -63,26 +433,86 @@ class ImageProcessor:
         Returns:
             base64编码的图像字符串（包含data:image前缀）
         """
-        # 转换为PIL Image
-        if image.shape[2] == 4:  # BGRA
-            pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA))
-        elif image.shape[2] == 3:  # BGR
-            pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        else:
-            raise ValueError(f"不支持的图像通道数: {image.shape[2]}")
-        
-        # 保存到字节流
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format=format)
-        buffer.seek(0)
-        
-        # 编码为base64
-        base64_str = base64.b64encode(buffer.read()).decode('utf-8')
+        encoded = cls.encode_image(image, format)
+        base64_str = binascii.b2a_base64(encoded, newline=False).decode('ascii')
         
         # 添加data:image前缀
         mime_type = f'image/{format.lower()}'
         return f'data:{mime_type};base64,{base64_str}'
     
+    @staticmethod
+    def png_to_data_url(encoded: BufferLike) -> str:
+        """
+        将PNG字节包装为data URL
+        
+        Args:
+            encoded: PNG字节
+            
+        Returns:
+            base64编码的图像字符串（包含data:image前缀）
+        """
+        return ImageProcessor.data_url(encoded)
+    
+    @staticmethod
+    def data_url(encoded: BufferLike, mimetype: str = 'image/png') -> str:
+        """
+        将编码后的图片字节包装为data URL
+        
+        Args:
+            encoded: 图片字节
+            mimetype: 图片的 MIME 类型
+            
+        Returns:
+            base64编码的图像字符串（包含data:image前缀）
+        """
+        return f"data:{mimetype};base64,{binascii.b2a_base64(encoded, newline=False).decode('ascii')}"
+    
+    @staticmethod
+    def encode_frame(image: np.ndarray, encoder: str = DEFAULT_ENCODER) -> bytes:
+        """
+        用指定编码器编码单帧
+        
+        Args:
+            image: BGRA格式的帧（可以是视图）
+            encoder: FRAME_ENCODERS 中的名称
+            
+        Returns:
+            编码后的图片字节
+        """
+        return FRAME_ENCODERS[encoder].encode(image).tobytes()
+    
+    @staticmethod
+    def result_key(image_data: BufferLike, rows: int, cols: int,
+                   tolerance: int = 50, mode: str = 'green',
+                   interpolation: Optional[Dict[str, Any]] = None,
+                   encoder: str = DEFAULT_ENCODER) -> str:
+        """
+        计算处理结果的内容地址（原始图像字节 + 处理参数 + 抠图引擎）
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式
+            interpolation: 插帧参数（见 sheet_frames）
+            encoder: 帧编码器名称
+            
+        Returns:
+            十六进制摘要，可同时用作缓存键和ETag
+        """
+        digest = hashlib.blake2b(image_data, digest_size=20)
+        digest.update(f'|v{PIPELINE_VERSION}|{rows}x{cols}|{tolerance}|{mode}'.encode('utf-8'))
+        if interpolation and interpolation.get('count'):
+            digest.update((f"|interp:{interpolation['count']}:{interpolation.get('mode', 'linear')}"
+                           f":{bool(interpolation.get('smooth'))}").encode('utf-8'))
+        if encoder != DEFAULT_ENCODER:
+            digest.update(f'|enc:{encoder}'.encode('utf-8'))
+        engine = resolve_key_engine()
+        if engine != DEFAULT_KEY_ENGINE:
+            digest.update(f'|key:{engine}:{get_key_luts().bits}'.encode('utf-8'))
+        return digest.hexdigest()
+    
     @staticmethod
     def slice_image(image: np.ndarray, rows: int, cols: int) -> List[np.ndarray]:
         """
@@ -94,7 +524,7 @@ class ImageProcessor:
             cols: 列数
             
         Returns:
-            切割后的帧列表
+            切割后的帧列表（原图的视图，不复制像素）
         """
         height, width = image.shape[:2]
         frame_height = height // rows
@@ -108,26 +538,22 @@ class ImageProcessor:
                 x_start = col * frame_width
                 x_end = (col + 1) * frame_width
                 
-                frame = image[y_start:y_end, x_start:x_end].copy()
+                frame = image[y_start:y_end, x_start:x_end]
                 frames.append(frame)
         
         return frames
     
     @staticmethod
-    def remove_green_background(image: np.ndarray, tolerance: int = 50) -> np.ndarray:
+    def _green_hsv_bounds(tolerance: int) -> Tuple[np.ndarray, np.ndarray]:
         """
-        使用专业算法去除绿幕背景
+        根据容差计算绿幕的HSV上下界
         
         Args:
-            image: 输入图像（BGR格式）
-            tolerance: 容差值（0-255），值越大去除范围越广
+            tolerance: 容差值
             
         Returns:
-            带alpha通道的图像（BGRA格式）
+            (lower_green, upper_green)
         """
-        # 转换到HSV色彩空间（更适合颜色识别）
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
         # 定义绿色的HSV范围 - 更严格的绿色检测
         # 绿色在HSV中的色调(H)范围大约是35-85
         # 提高饱和度和明度的下限，只去除鲜艳的绿色背景
@@ -148,8 +574,31 @@ class ImageProcessor:
         upper_green[1] = 255
         upper_green[2] = 255
         
+        return lower_green, upper_green
+    
+    @staticmethod
+    def remove_green_background(image: np.ndarray, tolerance: int = 50,
+                                engine: Optional[str] = None) -> np.ndarray:
+        """
+        使用专业算法去除绿幕背景
+        
+        Args:
+            image: 输入图像（BGR格式）
+            tolerance: 容差值（0-255），值越大去除范围越广
+            engine: 抠图引擎（见 resolve_key_engine）
+            
+        Returns:
+            带alpha通道的图像（BGRA格式）
+        """
+        lower_green, upper_green = ImageProcessor._green_hsv_bounds(tolerance)
+        
         # 创建绿色掩码
-        mask = cv2.inRange(hsv, lower_green, upper_green)
+        if resolve_key_engine(engine) == 'lut':
+            mask = get_key_luts().green_mask(image, lower_green, upper_green)
+        else:
+            # 转换到HSV色彩空间（更适合颜色识别）
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            mask = cv2.inRange(hsv, lower_green, upper_green)
         
         # 更温和的形态学操作，保留细节
         kernel_small = np.ones((2, 2), np.uint8)
@@ -208,9 +657,290 @@ class ImageProcessor:
         
         return bgra
     
+    @staticmethod
+    def _key_frame(frame: np.ndarray, tolerance: int, mode: str,
+                   engine: Optional[str] = None) -> np.ndarray:
+        """
+        按模式处理单帧
+        
+        Args:
+            frame: 输入帧（BGR格式）
+            tolerance: 容差值
+            mode: 处理模式（'green' / 'auto' / 其他=只添加alpha通道）
+            engine: 绿幕模式的抠图引擎（见 resolve_key_engine）
+            
+        Returns:
+            带alpha通道的帧（BGRA格式）
+        """
+        if mode == 'green':
+            # 绿幕抠图
+            return ImageProcessor.remove_green_background(frame, tolerance, engine)
+        if mode == 'auto':
+            # 自动检测背景色（使用左上角像素）
+            bg_color = tuple(frame[0, 0].tolist())
+            return ImageProcessor.remove_background_by_color(frame, bg_color, tolerance)
+        # 不处理，只添加alpha通道
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+    
+    @staticmethod
+    def _fill_gutters(cells: np.ndarray, pad: int, value: Optional[int] = None) -> None:
+        """
+        填充格子四周的隔离带
+        
+        隔离带模拟OpenCV对单帧的边界处理，使整图运算时相邻格子互不渗透：
+        腐蚀/膨胀使用常量边界（value），高斯模糊使用BORDER_REFLECT_101（value=None）。
+        
+        Args:
+            cells: 形状为 (rows, fh + 2*pad, cols, fw + 2*pad) 的掩码视图
+            pad: 隔离带宽度
+            value: 常量填充值，None表示镜像填充
+        """
+        if value is not None:
+            cells[:, :pad] = value
+            cells[:, -pad:] = value
+            cells[:, :, :, :pad] = value
+            cells[:, :, :, -pad:] = value
+            return
+        
+        # 先水平镜像，再连同隔离带一起垂直镜像（角落也随之正确填充）
+        width = cells.shape[3] - 2 * pad
+        height = cells.shape[1] - 2 * pad
+        for i in range(pad):
+            cells[:, :, :, i] = cells[:, :, :, 2 * pad - i]
+            cells[:, :, :, pad + width + i] = cells[:, :, :, pad + width - 2 - i]
+        for i in range(pad):
+            cells[:, i] = cells[:, 2 * pad - i]
+            cells[:, pad + height + i] = cells[:, pad + height - 2 - i]
+    
+    @classmethod
+    def _refine_sheet_mask(cls, mask: np.ndarray, rows: int, cols: int,
+                           kernel_size: int, blur_size: int) -> np.ndarray:
+        """
+        对整张精灵图的掩码做开/闭运算和羽化，结果与逐帧处理一致
+        
+        Args:
+            mask: 整图掩码，形状为 (rows*fh, cols*fw)
+            rows: 行数
+            cols: 列数
+            kernel_size: 形态学核大小
+            blur_size: 高斯模糊核大小
+            
+        Returns:
+            形状为 (rows, fh, cols, fw) 的掩码
+        """
+        frame_height = mask.shape[0] // rows
+        frame_width = mask.shape[1] // cols
+        pad = max(kernel_size // 2, blur_size // 2, 1)
+        padded_shape = (rows, frame_height + 2 * pad, cols, frame_width + 2 * pad)
+        flat_shape = (padded_shape[0] * padded_shape[1], padded_shape[2] * padded_shape[3])
+        
+        cells = np.empty(padded_shape, dtype=np.uint8)
+        cells[:, pad:pad + frame_height, :, pad:pad + frame_width] = \
+            mask.reshape(rows, frame_height, cols, frame_width)
+        
+        kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        # 开运算 = 腐蚀 + 膨胀，闭运算 = 膨胀 + 腐蚀
+        for op, border in ((cv2.erode, 255), (cv2.dilate, 0), (cv2.dilate, 0), (cv2.erode, 255)):
+            cls._fill_gutters(cells, pad, border)
+            cells = op(cells.reshape(flat_shape), kernel).reshape(padded_shape)
+        
+        # 边缘羽化
+        cls._fill_gutters(cells, pad)
+        cells = cv2.GaussianBlur(cells.reshape(flat_shape), (blur_size, blur_size), 0)\
+            .reshape(padded_shape)
+        
+        return cells[:, pad:pad + frame_height, :, pad:pad + frame_width]
+    
+    @staticmethod
+    def spill_to_disk(image: np.ndarray, directory: Optional[str] = None) -> np.ndarray:
+        """
+        把图像复制到内存映射的临时文件
+        
+        返回的数组由文件支撑，未访问的页可以被操作系统换出；
+        临时文件没有文件名，数组释放后自动删除。
+        
+        Args:
+            image: 输入图像
+            directory: 临时文件目录，None时使用系统临时目录
+            
+        Returns:
+            内容相同的 np.memmap
+        """
+        with tempfile.TemporaryFile(dir=directory) as file:
+            # mmap 持有自己的文件描述符，关闭文件对象后映射仍然有效
+            spilled = np.memmap(file, dtype=image.dtype, mode='w+', shape=image.shape)
+        spilled[...] = image
+        return spilled
+    
+    @staticmethod
+    def crop_to_grid(image: np.ndarray, rows: int, cols: int) -> np.ndarray:
+        """
+        裁掉无法整除网格的右侧和底部余量（返回视图）
+        
+        Args:
+            image: 输入图像
+            rows: 行数
+            cols: 列数
+            
+        Returns:
+            尺寸为 rows*fh x cols*fw 的图像视图
+        """
+        height, width = image.shape[:2]
+        return image[:(height // rows) * rows, :(width // cols) * cols]
+    
+    @classmethod
+    def key_frames_into(cls, sheet: np.ndarray, rows: int, cols: int,
+                        tolerance: int = 50, mode: str = 'green',
+                        out: Optional[np.ndarray] = None,
+                        workers: Optional[int] = None,
+                        engine: Optional[str] = None) -> np.ndarray:
+        """
+        逐帧去除背景，结果写入预分配的整图缓冲区
+        
+        Args:
+            sheet: 已裁剪到网格尺寸的图像（BGR格式）
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式
+            out: 预分配的BGRA缓冲区，None时自动分配
+            workers: 线程数（见 resolve_workers）
+            engine: 抠图引擎（见 resolve_key_engine）
+            
+        Returns:
+            整图（BGRA格式）
+        """
+        if out is None:
+            out = np.empty((sheet.shape[0], sheet.shape[1], 4), dtype=np.uint8)
+        
+        # 每个线程写入互不重叠的视图
+        def key_cell(cell: Tuple[np.ndarray, np.ndarray]) -> None:
+            source, target = cell
+            target[...] = cls._key_frame(source, tolerance, mode, engine)
+        
+        cells = zip(cls.slice_image(sheet, rows, cols), cls.slice_image(out, rows, cols))
+        parallel_map(key_cell, cells, workers)
+        
+        return out
+    
+    @classmethod
+    def key_plane(cls, image: np.ndarray, rows: int, cols: int, mode: str) -> Optional[np.ndarray]:
+        """
+        计算去背景中与容差无关的中间结果（交互调整容差时可以缓存复用）
+        
+        Args:
+            image: 输入图像（BGR格式）
+            rows: 行数
+            cols: 列数
+            mode: 处理模式
+            
+        Returns:
+            green 为整图的HSV（与网格无关）；auto 为裁剪到网格后各像素与所在帧左上角颜色的逐通道差值；
+            其他模式为None
+        """
+        if mode == 'green':
+            return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        if mode != 'auto':
+            return None
+        
+        # 每帧以自己的左上角像素为背景色
+        sheet = cls.crop_to_grid(image, rows, cols)
+        frame_height = sheet.shape[0] // rows
+        frame_width = sheet.shape[1] // cols
+        bg_colors = sheet[::frame_height, ::frame_width][:rows, :cols]
+        bg_plane = np.repeat(np.repeat(bg_colors, frame_height, axis=0), frame_width, axis=1)
+        return cv2.absdiff(sheet, bg_plane)
+    
+    @classmethod
+    def key_sprite_sheet(cls, image: np.ndarray, rows: int, cols: int,
+                         tolerance: int = 50, mode: str = 'green',
+                         tracker: Optional[MemoryTracker] = None,
+                         engine: Optional[str] = None,
+                         plane: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        对整张精灵图一次性去除背景
+        
+        颜色转换和阈值在整图上完成，形态学和羽化在带隔离带的格子布局上完成，
+        因此每一帧的结果与先切割再逐帧处理完全相同。
+        
+        Args:
+            image: 输入图像（BGR格式）
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=按每帧左上角像素去除背景）
+            tracker: 内存统计（可选）
+            engine: 抠图引擎（见 resolve_key_engine，None时读取环境变量 IMAGE_KEY_ENGINE）
+            plane: 已计算好的 key_plane（须使用相同的 rows、cols 和 mode），提供时只运行阈值、
+                   形态学和羽化
+            
+        Returns:
+            裁剪到 rows*fh x cols*fw 的整图（BGRA格式）
+        """
+        tracker = tracker or MemoryTracker()
+        engine = resolve_key_engine(engine)
+        sheet = cls.crop_to_grid(image, rows, cols)
+        frame_height = sheet.shape[0] // rows
+        frame_width = sheet.shape[1] // cols
+        
+        bgra = cv2.cvtColor(sheet, cv2.COLOR_BGR2BGRA)
+        tracker.hold('keyed', bgra.nbytes)
+        if mode not in ('green', 'auto'):
+            return bgra
+        
+        # 帧太小时隔离带无法镜像，退回逐帧处理
+        if min(frame_height, frame_width) <= 2:
+            return cls.key_frames_into(sheet, rows, cols, tolerance, mode, out=bgra, workers=1,
+                                       engine=engine)
+        
+        if plane is not None:
+            plane = cls.crop_to_grid(plane, rows, cols)
+            if plane.shape[:2] != sheet.shape[:2]:
+                raise ValueError('中间结果与图像的网格尺寸不一致')
+        
+        if mode == 'green':
+            lower_green, upper_green = cls._green_hsv_bounds(tolerance)
+            if plane is not None:
+                mask = cv2.inRange(plane, lower_green, upper_green)
+            elif engine == 'lut':
+                mask = get_key_luts().green_mask(sheet, lower_green, upper_green)
+            else:
+                hsv = cls.key_plane(sheet, rows, cols, mode)
+                tracker.hold('key.work', hsv.nbytes)
+                mask = cv2.inRange(hsv, lower_green, upper_green)
+                del hsv
+            kernel_size, blur_size = 2, 3
+        else:
+            # [c - tolerance, c + tolerance] 与 [0, 255] 的交集等价于 |x - c| <= tolerance
+            diff = plane
+            if diff is None:
+                diff = cls.key_plane(sheet, rows, cols, mode)
+                # 背景色平面和差值同时存在
+                tracker.hold('key.work', diff.nbytes * 2)
+            mask = cv2.inRange(diff, (0, 0, 0), (tolerance, tolerance, tolerance))
+            del diff
+            kernel_size, blur_size = 3, 5
+        
+        # 掩码、带隔离带的格子布局及其运算输出同时存在
+        tracker.hold('key.work', mask.nbytes * 3)
+        mask = cls._refine_sheet_mask(mask, rows, cols, kernel_size, blur_size)
+        
+        # 创建alpha通道
+        alpha = bgra.reshape(rows, frame_height, cols, frame_width, 4)[..., 3]
+        np.subtract(255, mask, out=alpha)
+        tracker.release('key.work')
+        
+        return bgra
+    
     @classmethod
     def process_sprite_sheet(cls, base64_image: str, rows: int, cols: int, 
-                            tolerance: int = 50, mode: str = 'green') -> List[str]:
+                            tolerance: int = 50, mode: str = 'green',
+                            whole_sheet: bool = True,
+                            tracker: Optional[MemoryTracker] = None,
+                            workers: Optional[int] = None,
+                            timer: Optional[StageTimer] = None,
+                            encoder: str = DEFAULT_ENCODER,
+                            dedupe: Optional[int] = None) -> List[str]:
         """
         处理精灵图：切割并去除背景
         
@@ -220,32 +950,698 @@ class ImageProcessor:
             cols: 列数
             tolerance: 容差值
             mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            whole_sheet: 是否整图一次性去除背景（False时逐帧处理）
+            tracker: 内存统计（可选），处理结束后可读取峰值
+            workers: 逐帧处理和编码的线程数（None时读取环境变量，见 resolve_workers）
+            timer: 阶段计时（可选）
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            dedupe: 重复帧检测阈值（见 process_sprite_sheet_unique），None时不检测
             
         Returns:
             处理后的帧列表（base64格式）
         """
+        # 解码base64（不保留引用，解码后即可释放）
+        with timed(timer, 'base64_decode'):
+            image_data = cls.decode_base64_payload(base64_image)
+        return cls.process_sprite_sheet_bytes(image_data, rows, cols, tolerance, mode,
+                                              whole_sheet=whole_sheet, tracker=tracker,
+                                              workers=workers, timer=timer, encoder=encoder,
+                                              dedupe=dedupe)
+    
+    @classmethod
+    def key_image_bytes(cls, image_data: BufferLike, rows: int, cols: int,
+                        tolerance: int = 50, mode: str = 'green',
+                        whole_sheet: bool = True,
+                        tracker: Optional[MemoryTracker] = None,
+                        workers: Optional[int] = None,
+                        timer: Optional[StageTimer] = None) -> np.ndarray:
+        """
+        解码原始图像字节并去除背景
+        
+        解码直接读取传入的缓冲区，抠图结果写入同一块预分配的整图缓冲区。
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            whole_sheet: 是否整图一次性去除背景（False时逐帧处理）
+            tracker: 内存统计（可选）
+            workers: 逐帧处理的线程数
+            timer: 阶段计时（可选），记录 image_decode 和 key 阶段
+            
+        Returns:
+            裁剪到网格尺寸的整图（BGRA格式），可用 slice_image 切割为帧视图
+        """
+        tracker = tracker or MemoryTracker()
+        tracker.hold('payload', memoryview(image_data).nbytes)
+        
         # 解码图像
-        image = cls.decode_base64_image(base64_image)
-        
-        # 切割图像
-        frames = cls.slice_image(image, rows, cols)
-        
-        # 处理每一帧
-        processed_frames = []
-        for frame in frames:
-            if mode == 'green':
-                # 绿幕抠图
-                processed = cls.remove_green_background(frame, tolerance)
-            elif mode == 'auto':
-                # 自动检测背景色（使用左上角像素）
-                bg_color = tuple(frame[0, 0].tolist())
-                processed = cls.remove_background_by_color(frame, bg_color, tolerance)
+        with timed(timer, 'image_decode'):
+            image = cls.decode_image_bytes(image_data)
+        tracker.hold('image', image.nbytes)
+        
+        with timed(timer, 'key'):
+            if whole_sheet:
+                # 整图去除背景后再切割
+                keyed = cls.key_sprite_sheet(image, rows, cols, tolerance, mode, tracker=tracker)
             else:
-                # 不处理，只添加alpha通道
-                processed = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+                # 逐帧处理，结果写入预分配的整图
+                sheet = cls.crop_to_grid(image, rows, cols)
+                keyed = np.empty((sheet.shape[0], sheet.shape[1], 4), dtype=np.uint8)
+                tracker.hold('keyed', keyed.nbytes)
+                cls.key_frames_into(sheet, rows, cols, tolerance, mode, out=keyed, workers=workers)
+        
+        # 原图和原始字节不再需要
+        del image
+        tracker.release('image')
+        tracker.release('payload')
+        
+        return keyed
+    
+    @classmethod
+    def encode_frames_to_base64(cls, keyed: np.ndarray, rows: int, cols: int,
+                                workers: Optional[int] = None,
+                                progress: Optional[Callable[[int, int], None]] = None) -> List[str]:
+        """
+        将抠图后的整图切割并逐帧编码为base64
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+            workers: 编码线程数（结果顺序不变）
+            progress: 进度回调 progress(已完成帧数, 总帧数)，可能在工作线程中调用
+            
+        Returns:
+            每帧的base64字符串（包含data:image前缀）
+        """
+        frames = cls.slice_image(keyed, rows, cols)
+        if progress is None:
+            return parallel_map(cls.encode_image_to_base64, frames, workers)
+        
+        total = len(frames)
+        completed = [0]
+        lock = threading.Lock()
+        progress(0, total)
+        
+        def encode(frame: np.ndarray) -> str:
+            encoded = cls.encode_image_to_base64(frame)
+            with lock:
+                completed[0] += 1
+                done = completed[0]
+            progress(done, total)
+            return encoded
+        
+        return parallel_map(encode, frames, workers)
+    
+    @classmethod
+    def sheet_frames(cls, keyed: np.ndarray, rows: int, cols: int,
+                     interpolation: Optional[Dict[str, Any]] = None,
+                     workers: Optional[int] = None) -> Sequence[np.ndarray]:
+        """
+        将抠图后的整图切割为帧，可选在相邻帧之间插帧
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+            interpolation: 插帧参数 {count: 每两帧插入帧数, mode: 'linear'|'flow', smooth: 是否缓动}，
+                           None或count为0时不插帧
+            workers: 光流插帧的线程数
+            
+        Returns:
+            帧序列（不插帧时为整图的视图）
+        """
+        frames = cls.slice_image(keyed, rows, cols)
+        if not interpolation or not interpolation.get('count'):
+            return frames
+        return cls.interpolate_frames(frames, interpolation, workers)
+    
+    @staticmethod
+    def interpolate_frames(frames: Sequence[np.ndarray], interpolation: Dict[str, Any],
+                           workers: Optional[int] = None) -> np.ndarray:
+        """
+        按插帧参数在相邻帧之间插帧
+        
+        Args:
+            frames: 帧序列（BGRA格式）
+            interpolation: 插帧参数（见 sheet_frames）
+            workers: 光流插帧的线程数
+            
+        Returns:
+            插帧后的帧数组
+        """
+        # frame_interpolation 依赖本模块的 parallel_map，在此处导入以避免循环导入
+        from frame_interpolation import FrameInterpolator
+        return FrameInterpolator.interpolate(frames, interpolation['count'],
+                                             mode=interpolation.get('mode', 'linear'),
+                                             smooth=interpolation.get('smooth', False),
+                                             workers=workers)
+    
+    @classmethod
+    def iter_encoded_frames(cls, keyed: np.ndarray, rows: int, cols: int,
+                            workers: Optional[int] = None,
+                            interpolation: Optional[Dict[str, Any]] = None,
+                            encoder: str = DEFAULT_ENCODER) -> Iterator[bytes]:
+        """
+        将抠图后的整图切割并按顺序逐帧编码（流式输出用）
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+            workers: 编码线程数（产出顺序不变）
+            interpolation: 插帧参数（见 sheet_frames）
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            
+        Yields:
+            每帧编码后的字节，编码完成即产出
+        """
+        return parallel_imap(lambda frame: cls.encode_frame(frame, encoder),
+                             cls.sheet_frames(keyed, rows, cols, interpolation, workers), workers)
+    
+    @classmethod
+    def iter_unique_frames(cls, keyed: np.ndarray, rows: int, cols: int, threshold: int = 0,
+                           workers: Optional[int] = None,
+                           encoder: str = DEFAULT_ENCODER) -> Tuple[Iterator[bytes], List[int]]:
+        """
+        检测抠图后整图中的重复帧，只按顺序编码不同的帧（流式输出用）
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+            threshold: 重复帧检测阈值（见 FrameDeduplicator.find_duplicates）
+            workers: 编码线程数（产出顺序不变）
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            
+        Returns:
+            (不同帧编码后的字节（编码完成即产出）, 每帧在其中的位置)
+        """
+        frames = cls.slice_image(keyed, rows, cols)
+        unique, positions = FrameDeduplicator.compact(
+            FrameDeduplicator.find_duplicates(frames, threshold)
+        )
+        encoded = parallel_imap(lambda index: cls.encode_frame(frames[index], encoder),
+                                unique.tolist(), workers)
+        return encoded, positions
+    
+    @classmethod
+    def iter_tiled_frames(cls, image_data: BufferLike, rows: int, cols: int,
+                          tolerance: int = 50, mode: str = 'green',
+                          tracker: Optional[MemoryTracker] = None,
+                          workers: Optional[int] = None,
+                          interpolation: Optional[Dict[str, Any]] = None,
+                          timer: Optional[StageTimer] = None,
+                          encoder: str = DEFAULT_ENCODER,
+                          spill: Optional[bool] = None) -> Iterator[bytes]:
+        """
+        按行分块处理精灵图：每次只对一行格子去除背景、插帧和编码，一行编码完成即产出
+        
+        抠图、插帧和编码的中间结果只保留当前一行，内存峰值为解码后的原图加一行的中间结果，
+        不随行数增长；spill 时原图解码后立即转存到内存映射的临时文件，处理期间常驻内存
+        只有当前一行。每帧结果与 process_sprite_sheet_png 完全相同。
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            tracker: 内存统计（可选）
+            workers: 编码和光流插帧的线程数（产出顺序不变）
+            interpolation: 插帧参数（见 sheet_frames），跨行的相邻帧之间同样插帧
+            timer: 阶段计时（可选），记录 image_decode、spill、key、interpolate 和 encode 阶段
+                   （不含消费方处理产出结果的时间）
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            spill: 是否把原图转存到临时文件，None时读取环境变量 IMAGE_TILED_SPILL
+                   （临时文件目录为 IMAGE_SPILL_DIR，默认系统临时目录）
+            
+        Yields:
+            每帧编码后的字节
+        """
+        tracker = tracker or MemoryTracker()
+        if spill is None:
+            spill = os.getenv('IMAGE_TILED_SPILL', 'false').lower() == 'true'
+        interpolating = bool(interpolation and interpolation.get('count'))
+        
+        tracker.hold('payload', memoryview(image_data).nbytes)
+        with timed(timer, 'image_decode'):
+            image = cls.decode_image_bytes(image_data)
+        tracker.hold('image', image.nbytes)
+        del image_data
+        tracker.release('payload')
+        
+        sheet = cls.crop_to_grid(image, rows, cols)
+        if spill:
+            with timed(timer, 'spill'):
+                sheet = cls.spill_to_disk(sheet, os.getenv('IMAGE_SPILL_DIR') or None)
+            del image
+            tracker.release('image')
+        frame_height = sheet.shape[0] // rows
+        frame_width = sheet.shape[1] // cols
+        
+        # 上一行的最后一帧，与本行第一帧之间插帧
+        previous: Optional[np.ndarray] = None
+        for row in range(rows):
+            band = sheet[row * frame_height:(row + 1) * frame_height]
+            with timed(timer, 'key'):
+                keyed = cls.key_sprite_sheet(band, 1, cols, tolerance, mode, tracker=tracker)
+            frames: Sequence[np.ndarray] = cls.slice_image(keyed, 1, cols)
+            
+            if interpolating:
+                with timed(timer, 'interpolate'):
+                    if previous is not None:
+                        frames = [previous] + list(frames)
+                    frames = cls.interpolate_frames(frames, interpolation, workers)
+                    if previous is not None:
+                        frames = frames[1:]
+                    previous = keyed[:, -frame_width:].copy()
+                tracker.hold('interpolated', frames.nbytes)
+            
+            with timed(timer, 'encode'):
+                encoded_frames = parallel_map(lambda frame: cls.encode_frame(frame, encoder),
+                                              frames, workers)
+            del keyed, frames
+            tracker.release('keyed')
+            tracker.release('interpolated')
+            tracker.hold('encoded', sum(len(frame) for frame in encoded_frames))
+            
+            yield from encoded_frames
+            del encoded_frames
+            tracker.release('encoded')
+    
+    @classmethod
+    def process_sprite_sheet_bytes(cls, image_data: BufferLike, rows: int, cols: int,
+                                   tolerance: int = 50, mode: str = 'green',
+                                   whole_sheet: bool = True,
+                                   tracker: Optional[MemoryTracker] = None,
+                                   workers: Optional[int] = None,
+                                   cache_key: Optional[str] = None,
+                                   interpolation: Optional[Dict[str, Any]] = None,
+                                   timer: Optional[StageTimer] = None,
+                                   encoder: str = DEFAULT_ENCODER,
+                                   tiled: Optional[bool] = None,
+                                   dedupe: Optional[int] = None) -> List[str]:
+        """
+        处理精灵图（原始图像字节输入）
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            whole_sheet: 是否整图一次性去除背景（False时逐帧处理）
+            tracker: 内存统计（可选）
+            workers: 逐帧处理和编码的线程数（结果顺序不变）
+            cache_key: 已计算好的 result_key（可选，避免重复哈希）
+            interpolation: 插帧参数（见 sheet_frames）
+            timer: 阶段计时（可选）
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            tiled: 是否按行分块处理（见 should_tile）
+            dedupe: 重复帧检测阈值（见 process_sprite_sheet_unique），None时不检测
+            
+        Returns:
+            处理后的帧列表（base64格式）
+        """
+        tracker = tracker or MemoryTracker()
+        encoded_frames = cls.process_sprite_sheet_png(image_data, rows, cols, tolerance, mode,
+                                                      whole_sheet=whole_sheet, tracker=tracker,
+                                                      workers=workers, cache_key=cache_key,
+                                                      interpolation=interpolation, timer=timer,
+                                                      encoder=encoder, tiled=tiled, dedupe=dedupe)
+        
+        # 编码为base64
+        mimetype = FRAME_ENCODERS[encoder].mimetype
+        with timed(timer, 'encode'):
+            processed_frames = [cls.data_url(frame, mimetype) for frame in encoded_frames]
+        tracker.hold('base64', sum(len(frame) for frame in processed_frames))
+        return processed_frames
+    
+    @classmethod
+    def process_sprite_sheet_png(cls, image_data: BufferLike, rows: int, cols: int,
+                                 tolerance: int = 50, mode: str = 'green',
+                                 whole_sheet: bool = True,
+                                 tracker: Optional[MemoryTracker] = None,
+                                 workers: Optional[int] = None,
+                                 cache_key: Optional[str] = None,
+                                 interpolation: Optional[Dict[str, Any]] = None,
+                                 timer: Optional[StageTimer] = None,
+                                 encoder: str = DEFAULT_ENCODER,
+                                 tiled: Optional[bool] = None,
+                                 dedupe: Optional[int] = None) -> List[bytes]:
+        """
+        处理精灵图，输出未经base64编码的帧字节（默认PNG，用于二进制传输）
+        
+        结果按内容地址缓存，相同图像和参数的重复请求直接返回缓存。
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            whole_sheet: 是否整图一次性去除背景（False时逐帧处理）
+            tracker: 内存统计（可选）
+            workers: 逐帧处理和编码的线程数（结果顺序不变）
+            cache_key: 已计算好的 result_key（可选，避免重复哈希）
+            interpolation: 插帧参数（见 sheet_frames）
+            timer: 阶段计时（可选），记录 image_decode、key、slice（插帧时为 interpolate）和 encode 阶段
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            tiled: 是否按行分块处理（见 should_tile，结果相同，中间结果只保留一行）
+            dedupe: 重复帧检测阈值（见 process_sprite_sheet_unique），None时不检测；
+                    检测时不分块处理，重复帧的结果为同一个对象
+            
+        Returns:
+            每帧编码后的字节
+        """
+        tracker = tracker or MemoryTracker()
+        cache = get_result_cache()
+        if cache.enabled and cache_key is None:
+            cache_key = cls.result_key(image_data, rows, cols, tolerance, mode, interpolation, encoder)
+        
+        if dedupe is not None:
+            unique_frames, refs = cls.process_sprite_sheet_unique(
+                image_data, rows, cols, tolerance, mode, dedupe, tracker=tracker, workers=workers,
+                cache_key=cls.dedupe_key(cache_key, dedupe) if cache_key else None,
+                interpolation=interpolation, timer=timer, encoder=encoder
+            )
+            return [unique_frames[ref] for ref in refs]
+        
+        encoded_frames = cache.get(cache_key) if cache_key else None
+        if encoded_frames is None and cls.should_tile(image_data, tiled):
+            encoded_frames = list(cls.iter_tiled_frames(image_data, rows, cols, tolerance, mode,
+                                                        tracker=tracker, workers=workers,
+                                                        interpolation=interpolation, timer=timer,
+                                                        encoder=encoder))
+            if cache_key:
+                cache.put(cache_key, encoded_frames)
+        elif encoded_frames is None:
+            keyed = cls.key_image_bytes(image_data, rows, cols, tolerance, mode,
+                                        whole_sheet=whole_sheet, tracker=tracker, workers=workers,
+                                        timer=timer)
+            interpolating = bool(interpolation and interpolation.get('count'))
+            with timed(timer, 'interpolate' if interpolating else 'slice'):
+                frames = cls.sheet_frames(keyed, rows, cols, interpolation, workers)
+            if isinstance(frames, np.ndarray):
+                tracker.hold('interpolated', frames.nbytes)
+            with timed(timer, 'encode'):
+                encoded_frames = parallel_map(lambda frame: cls.encode_frame(frame, encoder),
+                                              frames, workers)
+            del keyed, frames
+            tracker.release('keyed')
+            tracker.release('interpolated')
+            if cache_key:
+                cache.put(cache_key, encoded_frames)
+        
+        tracker.hold('encoded', sum(len(frame) for frame in encoded_frames))
+        return encoded_frames
+    
+    @staticmethod
+    def dedupe_key(result_key: str, threshold: int = 0) -> str:
+        """
+        检测重复帧时结果的内容地址（在 result_key 的基础上加上检测阈值）
+        
+        Args:
+            result_key: 见 result_key
+            threshold: 重复帧检测阈值
+            
+        Returns:
+            可同时用作缓存键和ETag的字符串
+        """
+        return f'{result_key}-dedupe{threshold}'
+    
+    @classmethod
+    def key_unique_frames(cls, image: np.ndarray, rows: int, cols: int,
+                          tolerance: int = 50, mode: str = 'green', threshold: int = 0,
+                          tracker: Optional[MemoryTracker] = None,
+                          timer: Optional[StageTimer] = None) -> Tuple[List[np.ndarray], np.ndarray]:
+        """
+        检测重复帧，只对不同的帧去除背景
+        
+        不同的帧横向拼成一行后整图去除背景，隔离带保证每帧结果与在原图中处理时相同。
+        
+        Args:
+            image: 输入图像（BGR格式）
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式
+            threshold: 重复帧检测阈值（见 FrameDeduplicator.find_duplicates）
+            tracker: 内存统计（可选）
+            timer: 阶段计时（可选），记录 dedupe 和 key 阶段
+            
+        Returns:
+            (每帧去除背景后的结果（BGRA格式，重复帧与其代表帧为同一个视图）, refs)
+        """
+        tracker = tracker or MemoryTracker()
+        with timed(timer, 'dedupe'):
+            frames = cls.slice_image(cls.crop_to_grid(image, rows, cols), rows, cols)
+            refs = FrameDeduplicator.find_duplicates(frames, threshold)
+            unique, positions = FrameDeduplicator.compact(refs)
+        
+        with timed(timer, 'key'):
+            if len(unique) == len(frames):
+                keyed = cls.key_sprite_sheet(image, rows, cols, tolerance, mode, tracker=tracker)
+                return cls.slice_image(keyed, rows, cols), refs
             
-            # 编码为base64
-            base64_frame = cls.encode_image_to_base64(processed)
-            processed_frames.append(base64_frame)
+            strip = np.concatenate([frames[index] for index in unique.tolist()], axis=1)
+            tracker.hold('unique', strip.nbytes)
+            keyed = cls.key_sprite_sheet(strip, 1, len(unique), tolerance, mode, tracker=tracker)
+            del strip
+            tracker.release('unique')
         
-        return processed_frames
\ No newline at end of file
+        keyed_frames = cls.slice_image(keyed, 1, len(unique))
+        return [keyed_frames[position] for position in positions], refs
+    
+    @classmethod
+    def process_sprite_sheet_unique(cls, image_data: BufferLike, rows: int, cols: int,
+                                    tolerance: int = 50, mode: str = 'green', threshold: int = 0,
+                                    tracker: Optional[MemoryTracker] = None,
+                                    workers: Optional[int] = None,
+                                    cache_key: Optional[str] = None,
+                                    interpolation: Optional[Dict[str, Any]] = None,
+                                    timer: Optional[StageTimer] = None,
+                                    encoder: str = DEFAULT_ENCODER) -> Tuple[List[bytes], List[int]]:
+        """
+        处理精灵图，重复帧只去除背景和编码一次，结果按内容地址缓存
+        
+        threshold 为0时只合并像素完全相同的帧，结果与 process_sprite_sheet_png 相同；
+        大于0时按感知哈希合并近似重复的帧（有损，见 FrameDeduplicator.find_duplicates）。
+        插帧时前后帧相同的中间帧同样只编码一次。
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            threshold: 重复帧检测阈值（感知哈希的汉明距离）
+            tracker: 内存统计（可选）
+            workers: 编码的线程数（结果顺序不变）
+            cache_key: 已计算好的 dedupe_key（可选，避免重复哈希）
+            interpolation: 插帧参数（见 sheet_frames）
+            timer: 阶段计时（可选），记录 image_decode、dedupe、key、interpolate 和 encode 阶段
+            encoder: 帧编码器名称（见 FRAME_ENCODERS）
+            
+        Returns:
+            (不同帧编码后的字节, 每帧在其中的位置)
+        """
+        tracker = tracker or MemoryTracker()
+        cache = get_result_cache()
+        if cache.enabled and cache_key is None:
+            cache_key = cls.dedupe_key(
+                cls.result_key(image_data, rows, cols, tolerance, mode, interpolation, encoder),
+                threshold
+            )
+        
+        # 缓存项为 [不同帧..., 引用位置的JSON]
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            return cached[:-1], json.loads(cached[-1])
+        
+        tracker.hold('payload', memoryview(image_data).nbytes)
+        with timed(timer, 'image_decode'):
+            image = cls.decode_image_bytes(image_data)
+        tracker.hold('image', image.nbytes)
+        frames, refs = cls.key_unique_frames(image, rows, cols, tolerance, mode, threshold,
+                                             tracker=tracker, timer=timer)
+        del image
+        tracker.release('image')
+        tracker.release('payload')
+        
+        if interpolation and interpolation.get('count'):
+            with timed(timer, 'interpolate'):
+                frames = cls.interpolate_frames(frames, interpolation, workers)
+            tracker.hold('interpolated', frames.nbytes)
+            refs = FrameDeduplicator.interpolated_refs(refs, interpolation['count'])
+        
+        unique, positions = FrameDeduplicator.compact(refs)
+        with timed(timer, 'encode'):
+            encoded_frames = parallel_map(lambda index: cls.encode_frame(frames[index], encoder),
+                                          unique.tolist(), workers)
+        del frames
+        tracker.release('keyed')
+        tracker.release('interpolated')
+        
+        if cache_key:
+            cache.put(cache_key, encoded_frames + [json.dumps(positions).encode('utf-8')])
+        tracker.hold('encoded', sum(len(frame) for frame in encoded_frames))
+        return encoded_frames, positions
+    
+    @staticmethod
+    def atlas_key(result_key: str, padding: int = DEFAULT_ATLAS_PADDING,
+                  power_of_two: bool = False, dedupe: Optional[int] = None) -> str:
+        """
+        图集结果的内容地址（在 result_key 的基础上加上图集参数）
+        
+        Args:
+            result_key: 见 result_key（interpolation、encoder 等参数已包含在内）
+            padding: 帧之间的间距
+            power_of_two: 图集宽高是否取2的幂
+            dedupe: 重复帧检测阈值，None时不检测
+            
+        Returns:
+            可同时用作缓存键和ETag的字符串
+        """
+        key = f"{result_key}-atlas{padding}{'-pot' if power_of_two else ''}"
+        return key if dedupe is None else f'{key}-dedupe{dedupe}'
+    
+    @classmethod
+    def pack_atlas(cls, keyed: np.ndarray, rows: int, cols: int,
+                   padding: int = DEFAULT_ATLAS_PADDING, power_of_two: bool = False,
+                   interpolation: Optional[Dict[str, Any]] = None,
+                   encoder: str = DEFAULT_ENCODER,
+                   tracker: Optional[MemoryTracker] = None,
+                   timer: Optional[StageTimer] = None,
+                   dedupe: Optional[int] = None) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        把抠图后的整图打包为图集：裁掉每帧四周的透明区域，装箱后编码为一张图
+        
+        Args:
+            keyed: 裁剪到网格尺寸的整图（BGRA格式）
+            rows: 行数
+            cols: 列数
+            padding: 帧之间的间距
+            power_of_two: 图集宽高是否取2的幂
+            interpolation: 插帧参数（见 sheet_frames），插入的帧同样打包进图集
+            encoder: 图集编码器名称（见 FRAME_ENCODERS）
+            tracker: 内存统计（可选）
+            timer: 阶段计时（可选），记录 interpolate、trim、dedupe、pack 和 encode 阶段
+            dedupe: 重复帧检测阈值（见 FrameDeduplicator.find_duplicates），重复帧在图集中共用同一区域；
+                    None时不检测
+            
+        Returns:
+            (编码后的图集, TexturePacker JSON（Hash）格式的描述)
+        """
+        tracker = tracker or MemoryTracker()
+        frame_height = keyed.shape[0] // rows
+        frame_width = keyed.shape[1] // cols
+        
+        if interpolation and interpolation.get('count'):
+            with timed(timer, 'interpolate'):
+                frames = cls.sheet_frames(keyed, rows, cols, interpolation)
+            tracker.hold('interpolated', frames.nbytes)
+            with timed(timer, 'trim'):
+                bounds = AtlasPacker.trim_bounds(frames)
+        else:
+            # 不插帧时直接在整图上计算包围盒，帧为整图的视图
+            frames = cls.slice_image(keyed, rows, cols)
+            with timed(timer, 'trim'):
+                bounds = AtlasPacker.sheet_trim_bounds(keyed, rows, cols)
+        
+        refs = None
+        if dedupe is not None:
+            with timed(timer, 'dedupe'):
+                refs = FrameDeduplicator.find_duplicates(frames, dedupe)
+            bounds = bounds[refs]
+        
+        with timed(timer, 'pack'):
+            atlas, positions, size = AtlasPacker.build(frames, bounds, padding, power_of_two, refs)
+        del frames
+        tracker.release('interpolated')
+        tracker.hold('atlas', atlas.nbytes)
+        
+        with timed(timer, 'encode'):
+            encoded = cls.encode_frame(atlas, encoder)
+        tracker.release('atlas')
+        
+        frame_format = FRAME_ENCODERS[encoder].format
+        names = [f'frame_{index:03d}' for index in range(len(bounds))]
+        manifest = AtlasPacker.manifest(names, bounds, positions, (frame_width, frame_height),
+                                        size, f'atlas.{frame_format}')
+        return encoded, manifest
+    
+    @classmethod
+    def process_sprite_sheet_atlas(cls, image_data: BufferLike, rows: int, cols: int,
+                                   tolerance: int = 50, mode: str = 'green',
+                                   padding: int = DEFAULT_ATLAS_PADDING,
+                                   power_of_two: bool = False,
+                                   tracker: Optional[MemoryTracker] = None,
+                                   cache_key: Optional[str] = None,
+                                   interpolation: Optional[Dict[str, Any]] = None,
+                                   timer: Optional[StageTimer] = None,
+                                   encoder: str = DEFAULT_ENCODER,
+                                   dedupe: Optional[int] = None) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        处理精灵图并输出图集（见 pack_atlas），结果按内容地址缓存
+        
+        Args:
+            image_data: 原始图像字节
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式（'green'=绿幕抠图, 'auto'=自动检测背景色）
+            padding: 帧之间的间距
+            power_of_two: 图集宽高是否取2的幂
+            tracker: 内存统计（可选）
+            cache_key: 已计算好的 atlas_key（可选，避免重复哈希）
+            interpolation: 插帧参数（见 sheet_frames）
+            timer: 阶段计时（可选）
+            encoder: 图集编码器名称（见 FRAME_ENCODERS）
+            dedupe: 重复帧检测阈值，重复帧在图集中共用同一区域；None时不检测
+            
+        Returns:
+            (编码后的图集, TexturePacker JSON（Hash）格式的描述)
+        """
+        tracker = tracker or MemoryTracker()
+        cache = get_result_cache()
+        if cache.enabled and cache_key is None:
+            cache_key = cls.atlas_key(
+                cls.result_key(image_data, rows, cols, tolerance, mode, interpolation, encoder),
+                padding, power_of_two, dedupe
+            )
+        
+        # 缓存项为 [图集, 描述的JSON]
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            return cached[0], json.loads(cached[1])
+        
+        keyed = cls.key_image_bytes(image_data, rows, cols, tolerance, mode, tracker=tracker,
+                                    timer=timer)
+        encoded, manifest = cls.pack_atlas(keyed, rows, cols, padding, power_of_two,
+                                           interpolation, encoder, tracker, timer, dedupe)
+        del keyed
+        tracker.release('keyed')
+        tracker.hold('encoded', len(encoded))
+        if cache_key:
+            cache.put(cache_key, [encoded, json.dumps(manifest).encode('utf-8')])
+        return encoded, manifest
+    
+    @classmethod
+    def warmup(cls) -> None:
+        """
+        用一张很小的精灵图（2×2帧）走一遍完整处理流程
+        
+        首次调用 OpenCV 的颜色转换、形态学运算和 PNG 编解码时有一次性的初始化开销，
+        服务启动时预先触发，避免落在第一个请求上。
+        """
+        sheet = np.empty((64, 64, 3), dtype=np.uint8)
+        sheet[:] = (40, 200, 60)
+        sheet[8:24, 8:24] = (30, 30, 200)
+        sample = cls.encode_image_to_base64(sheet)
+        for mode in ('green', 'auto'):
+            cls.process_sprite_sheet(sample, rows=2, cols=2, mode=mode, workers=1)
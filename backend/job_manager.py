@@ -0,0 +1,327 @@
+"""
+后台任务模块
+有界线程池执行耗时任务（如 AI 精灵图生成），支持任务状态、进度、取消和结果保留期限；
+队列已满或排队超过期限的任务被拒绝（JobQueueFull / JobQueueTimeout，附带建议的重试等待时间）；
+异步服务模式下任务以协程在事件循环中执行（见 track / run_async），同样可以查询和取消
+"""
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from admission import Overloaded, ServiceTime
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+class JobQueueFull(Overloaded):
+    """等待中的任务数已达上限"""
+
+
+class JobQueueTimeout(Overloaded):
+    """任务排队超过期限，未执行"""
+
+
+class Job:
+    """单个后台任务"""
+    
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    
+    FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+    
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = self.QUEUED
+        self.progress: Dict[str, Any] = {'stage': 'queued'}
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+        # False 时结束后不保留结果（见 JobManager.discard）
+        self.retain = True
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+        self._lock = threading.Lock()
+    
+    @property
+    def finished(self) -> bool:
+        return self.state in self.FINISHED_STATES
+    
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_event.is_set()
+    
+    def check_cancelled(self) -> None:
+        """在阶段之间调用，任务被取消时抛出 JobCancelled"""
+        if self._cancel_event.is_set():
+            raise JobCancelled('任务已取消')
+    
+    def set_progress(self, stage: str, completed: Optional[int] = None,
+                     total: Optional[int] = None) -> None:
+        """
+        更新任务进度
+        
+        Args:
+            stage: 当前阶段名称
+            completed: 当前阶段已完成数量（可选）
+            total: 当前阶段总数量（可选）
+        """
+        progress: Dict[str, Any] = {'stage': stage}
+        if total is not None:
+            progress['completed'] = completed or 0
+            progress['total'] = total
+        with self._lock:
+            self.progress = progress
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待任务结束，返回是否已结束"""
+        return self._done_event.wait(timeout)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """导出任务状态（不含结果）"""
+        with self._lock:
+            progress = dict(self.progress)
+        return {
+            'jobId': self.id,
+            'kind': self.kind,
+            'status': self.state,
+            'progress': progress,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+    
+    def _finish(self, state: str, result: Any = None,
+                exception: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self.state = state
+            self.result = result
+            self.exception = exception
+            self.finished_at = time.time()
+            self.progress = {'stage': state}
+        self._done_event.set()
+
+
+class JobManager:
+    """有界线程池 + 任务表"""
+    
+    def __init__(self, workers: int = 4, max_pending: int = 32, result_ttl: float = 600,
+                 queue_timeout: float = 0):
+        """
+        Args:
+            workers: 同时执行的任务数
+            max_pending: 排队 + 执行中的任务上限
+            result_ttl: 任务结束后结果保留的秒数
+            queue_timeout: 任务排队超过该秒数时不再执行（以 JobQueueTimeout 失败），0 表示不限
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.queue_timeout = queue_timeout
+        self.service_time = ServiceTime()
+        self.rejected = {'queue_full': 0, 'queue_timeout': 0}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls) -> 'JobManager':
+        """根据环境变量创建任务管理器"""
+        return cls(
+            workers=int(os.getenv('JOB_WORKERS', 4)),
+            max_pending=int(os.getenv('JOB_MAX_PENDING', 32)),
+            result_ttl=float(os.getenv('JOB_RESULT_TTL', 600)),
+            queue_timeout=float(os.getenv('JOB_QUEUE_TIMEOUT', 120))
+        )
+    
+    def submit(self, kind: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Job:
+        """
+        提交任务
+        
+        Args:
+            kind: 任务类型
+            func: 任务函数，第一个参数为 Job（用于更新进度和检查取消）
+        
+        Returns:
+            新建的任务
+        
+        Raises:
+            JobQueueFull: 未结束的任务数已达上限
+        """
+        self._purge_expired()
+        job = Job(kind)
+        with self._lock:
+            pending = sum(1 for existing in self._jobs.values() if not existing.finished)
+            if pending >= self.max_pending:
+                self.rejected['queue_full'] += 1
+                retry_after = self.service_time.retry_after(max(pending - self.workers, 0), self.workers)
+                raise JobQueueFull(f'任务队列已满（{self.max_pending}）', retry_after)
+            self._jobs[job.id] = job
+        
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+    
+    def track(self, kind: str, limit: Optional[int] = None) -> Job:
+        """
+        登记在线程池之外执行的任务（由 run_async 执行），不受 max_pending 限制
+        
+        Args:
+            kind: 任务类型
+            limit: 未结束的此类任务（线程池之外）上限，None 表示不限
+        
+        Returns:
+            新建的任务
+        
+        Raises:
+            JobQueueFull: 未结束的任务数已达 limit
+        """
+        self._purge_expired()
+        job = Job(kind)
+        with self._lock:
+            if limit is not None:
+                running = sum(1 for existing in self._jobs.values()
+                              if existing.future is None and not existing.finished)
+                if running >= limit:
+                    self.rejected['queue_full'] += 1
+                    raise JobQueueFull(f'同时进行的任务已达上限（{limit}）',
+                                       self.service_time.retry_after(0, limit))
+            self._jobs[job.id] = job
+        return job
+    
+    async def run_async(self, job: Job, func: Callable[..., Awaitable[Any]],
+                        *args: Any, **kwargs: Any) -> None:
+        """
+        在当前事件循环中执行 track 登记的任务，结束状态与线程池中的任务相同
+        
+        Args:
+            job: track 返回的任务
+            func: 任务协程函数，第一个参数为 Job
+        """
+        if not self._start(job):
+            return
+        
+        try:
+            result = await func(job, *args, **kwargs)
+        except (JobCancelled, asyncio.CancelledError):
+            job._finish(Job.CANCELLED)
+        except Exception as e:
+            job._finish(Job.FAILED, exception=e)
+        else:
+            job._finish(Job.SUCCEEDED, result=result)
+        finally:
+            self._observe(job)
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        """查询任务（过期任务会被清理）"""
+        self._purge_expired()
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        取消任务：排队中的任务直接取消，执行中的任务在下一个阶段检查点停止
+        
+        Returns:
+            被取消的任务，不存在时返回None
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        
+        job._cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job._finish(Job.CANCELLED)
+        return job
+    
+    def discard(self, job_id: str) -> None:
+        """
+        不保留任务结果（同步和流式接口已把结果直接返回给调用方，不会再查询）：
+        已结束的任务立即移除，未结束的任务在结束后的下一次清理时移除
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if job.finished:
+                del self._jobs[job_id]
+            else:
+                job.retain = False
+    
+    def stats(self) -> Dict[str, Any]:
+        """各状态任务数和被拒绝的任务数"""
+        with self._lock:
+            counts: Dict[str, Any] = {
+                state: 0 for state in (Job.QUEUED, Job.RUNNING) + Job.FINISHED_STATES
+            }
+            for job in self._jobs.values():
+                counts[job.state] += 1
+            counts['rejected'] = dict(self.rejected)
+        counts['workers'] = self.workers
+        counts['maxPending'] = self.max_pending
+        counts['queueTimeout'] = self.queue_timeout
+        return counts
+    
+    def _start(self, job: Job) -> bool:
+        """标记任务开始执行，已被取消时直接结束并返回 False"""
+        if job.cancel_requested:
+            job._finish(Job.CANCELLED)
+            return False
+        
+        with job._lock:
+            job.state = Job.RUNNING
+            job.started_at = time.time()
+        return True
+    
+    def _run(self, job: Job, func: Callable[..., Any], args: tuple, kwargs: dict) -> None:
+        waited = time.time() - job.created_at
+        if self.queue_timeout > 0 and waited > self.queue_timeout and not job.cancel_requested:
+            # 排队太久的任务不再执行（客户端多半已经放弃），避免积压的上游请求集中超时
+            with self._lock:
+                self.rejected['queue_timeout'] += 1
+                queued = sum(1 for existing in self._jobs.values() if existing.state == Job.QUEUED)
+            job._finish(Job.FAILED, exception=JobQueueTimeout(
+                f'任务排队 {waited:.0f} 秒，超过 {self.queue_timeout:g} 秒',
+                self.service_time.retry_after(queued, self.workers),
+                reason='queue_timeout'
+            ))
+            return
+        
+        if not self._start(job):
+            return
+        
+        try:
+            result = func(job, *args, **kwargs)
+        except JobCancelled:
+            job._finish(Job.CANCELLED)
+        except Exception as e:
+            job._finish(Job.FAILED, exception=e)
+        else:
+            job._finish(Job.SUCCEEDED, result=result)
+        finally:
+            self._observe(job)
+    
+    def _observe(self, job: Job) -> None:
+        """记录执行耗时，用于估算 Retry-After"""
+        if job.started_at is not None and job.finished_at is not None:
+            self.service_time.observe(job.finished_at - job.started_at)
+    
+    def _purge_expired(self) -> None:
+        """清理超过保留期限（或不保留结果）的已结束任务"""
+        deadline = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and (not job.retain or (job.finished_at or 0) < deadline)]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -0,0 +1,177 @@
+"""
+查找表抠图模块
+按绿幕容差（HSV 上下界）预先计算 BGR→掩码 的查找表，抠图时只做一次查表，不再做颜色空间转换；
+按颜色去背景（auto 模式）本身只是一次 inRange，查表并不更快，两种引擎都直接计算
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import cv2
+
+
+# 绿幕抠图引擎：opencv=逐次 cvtColor + inRange，lut=预先计算的查找表（可选，并不比 opencv 快）
+KEY_ENGINES = ('opencv', 'lut')
+DEFAULT_KEY_ENGINE = 'opencv'
+
+# 绿幕查表时每次处理的行数（临时缓冲区留在CPU缓存中）
+GREEN_CHUNK_ROWS = 128
+
+
+def resolve_key_engine(name: Optional[str] = None) -> str:
+    """
+    确定抠图引擎
+    
+    Args:
+        name: 引擎名称，None时读取环境变量 IMAGE_KEY_ENGINE（默认 opencv）
+        
+    Returns:
+        KEY_ENGINES 中的名称
+        
+    Raises:
+        ValueError: 未知的引擎
+    """
+    name = name or os.getenv('IMAGE_KEY_ENGINE', DEFAULT_KEY_ENGINE)
+    if name not in KEY_ENGINES:
+        raise ValueError(f"不支持的抠图引擎: {name}（可选 {', '.join(KEY_ENGINES)}）")
+    return name
+
+
+class KeyLUTCache:
+    """
+    绿幕抠图查找表的LRU缓存（线程安全）
+    
+    表以 B | G<<8 | R<<16 为下标（2^24 项，每项1字节），相同的HSV上下界共用一张表。
+    """
+    
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, bits: int = 8):
+        """
+        Args:
+            max_bytes: 查找表占用的内存上限（至少保留最近使用的一张表）
+            bits: 绿幕表每个通道的量化位数（5-8），8为精确结果，位数越少建表越快、误差越大
+        """
+        if not 5 <= bits <= 8:
+            raise ValueError('查找表量化位数必须在 5 到 8 之间')
+        self.max_bytes = max_bytes
+        self.bits = bits
+        self._tables: 'OrderedDict[Tuple, np.ndarray]' = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @classmethod
+    def from_env(cls) -> 'KeyLUTCache':
+        """根据环境变量创建查找表缓存"""
+        return cls(
+            max_bytes=int(os.getenv('IMAGE_KEY_LUT_MAX_BYTES', 64 * 1024 * 1024)),
+            bits=int(os.getenv('IMAGE_KEY_LUT_BITS', 8))
+        )
+    
+    def _get(self, key: Tuple, build: Callable[[], np.ndarray]) -> np.ndarray:
+        """查询查找表，未命中时建表并按LRU淘汰"""
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+        
+        # 建表在锁外进行，并发的相同请求可能重复建表，结果相同
+        table = build()
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = table
+                self._current_bytes += table.nbytes
+            while self._current_bytes > self.max_bytes and len(self._tables) > 1:
+                _, evicted = self._tables.popitem(last=False)
+                self._current_bytes -= evicted.nbytes
+                self.evictions += 1
+        return table
+    
+    def green_table(self, lower: Sequence[int], upper: Sequence[int]) -> np.ndarray:
+        """
+        获取绿幕查找表
+        
+        Args:
+            lower: HSV下界
+            upper: HSV上界
+            
+        Returns:
+            以 B | G<<8 | R<<16 为下标的掩码表（0/255）
+        """
+        key = ('green', tuple(int(v) for v in lower), tuple(int(v) for v in upper), self.bits)
+        return self._get(key, lambda: self._build_green_table(lower, upper))
+    
+    def _build_green_table(self, lower: Sequence[int], upper: Sequence[int]) -> np.ndarray:
+        """按量化后各区间的中心颜色计算 HSV inRange，再展开为 2^24 项"""
+        shift = 8 - self.bits
+        levels = (np.arange(1 << self.bits) << shift) + ((1 << shift) >> 1)
+        count = len(levels)
+        
+        # 下标顺序为 [R][G][B]
+        grid = np.empty((count, count, count, 3), dtype=np.uint8)
+        grid[..., 0] = levels[None, None, :]
+        grid[..., 1] = levels[None, :, None]
+        grid[..., 2] = levels[:, None, None]
+        hsv = cv2.cvtColor(grid.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV)
+        table = cv2.inRange(hsv, np.asarray(lower), np.asarray(upper)).reshape(count, count, count)
+        
+        if shift:
+            bins = np.arange(256) >> shift
+            table = table[np.ix_(bins, bins, bins)]
+        return np.ascontiguousarray(table).reshape(-1)
+    
+    def green_mask(self, image: np.ndarray, lower: Sequence[int], upper: Sequence[int]) -> np.ndarray:
+        """
+        查表计算绿幕掩码，bits=8 时与 inRange(cvtColor(image, BGR2HSV), lower, upper) 相同
+        
+        Args:
+            image: 输入图像（BGR格式，可以是视图）
+            lower: HSV下界
+            upper: HSV上界
+            
+        Returns:
+            掩码（背景为255）
+        """
+        table = self.green_table(lower, upper)
+        mask = np.empty(image.shape[:2], dtype=np.uint8)
+        for start in range(0, image.shape[0], GREEN_CHUNK_ROWS):
+            # 补一个字节凑成 uint32 后按小端解释，低24位即 B | G<<8 | R<<16
+            bgra = cv2.cvtColor(image[start:start + GREEN_CHUNK_ROWS], cv2.COLOR_BGR2BGRA)
+            keys = bgra.view('<u4')[..., 0]
+            np.bitwise_and(keys, 0xFFFFFF, out=keys)
+            np.take(table, keys, out=mask[start:start + GREEN_CHUNK_ROWS])
+        return mask
+    
+    def stats(self) -> Dict[str, int]:
+        """导出命中/未命中/淘汰计数和占用情况"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._tables),
+                'bytes': self._current_bytes,
+                'maxBytes': self.max_bytes,
+                'bits': self.bits
+            }
+
+
+_key_luts: Optional[KeyLUTCache] = None
+_key_luts_lock = threading.Lock()
+
+
+def get_key_luts() -> KeyLUTCache:
+    """获取全局查找表缓存（首次使用时根据环境变量创建）"""
+    global _key_luts
+    if _key_luts is None:
+        with _key_luts_lock:
+            if _key_luts is None:
+                _key_luts = KeyLUTCache.from_env()
+    return _key_luts
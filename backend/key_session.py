@@ -0,0 +1,218 @@
+"""
+抠图会话模块
+上传一次精灵图后保留解码结果和与容差无关的中间结果，调整容差等参数时只重新运行阈值及之后的步骤
+"""
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from image_processor import ImageProcessor, ImageTooLargeError, MemoryTracker
+
+
+class KeySession:
+    """单个抠图会话：解码后的整图 + 按 (模式, 网格) 缓存的中间结果"""
+    
+    def __init__(self, image: np.ndarray):
+        """
+        Args:
+            image: 解码后的精灵图（BGR格式）
+        """
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.keyed_count = 0
+        # green 的中间结果与网格无关，auto 只保留最近一次网格的结果
+        self._planes: Dict[Tuple, np.ndarray] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def nbytes(self) -> int:
+        """整图和中间结果占用的字节数"""
+        return self.image.nbytes + sum(plane.nbytes for plane in self._planes.values())
+    
+    def touch(self) -> None:
+        self.last_used = time.time()
+    
+    def plane(self, rows: int, cols: int, mode: str) -> Optional[np.ndarray]:
+        """
+        获取（必要时计算）中间结果
+        
+        Args:
+            rows: 行数
+            cols: 列数
+            mode: 处理模式
+        
+        Returns:
+            见 ImageProcessor.key_plane，不需要中间结果的模式返回None
+        """
+        if mode not in ('green', 'auto'):
+            return None
+        
+        key = ('green',) if mode == 'green' else ('auto', rows, cols)
+        with self._lock:
+            plane = self._planes.get(key)
+            if plane is None:
+                plane = ImageProcessor.key_plane(self.image, rows, cols, mode)
+                if mode == 'auto':
+                    for stale in [k for k in self._planes if k[0] == 'auto']:
+                        del self._planes[stale]
+                self._planes[key] = plane
+            return plane
+    
+    def key(self, rows: int, cols: int, tolerance: int = 50, mode: str = 'green',
+            tracker: Optional[MemoryTracker] = None) -> np.ndarray:
+        """
+        用缓存的中间结果去除背景
+        
+        Args:
+            rows: 行数
+            cols: 列数
+            tolerance: 容差值
+            mode: 处理模式
+            tracker: 内存统计（可选）
+        
+        Returns:
+            裁剪到网格尺寸的整图（BGRA格式），见 ImageProcessor.key_sprite_sheet
+        """
+        plane = self.plane(rows, cols, mode)
+        keyed = ImageProcessor.key_sprite_sheet(self.image, rows, cols, tolerance, mode,
+                                                tracker=tracker, plane=plane)
+        self.keyed_count += 1
+        self.touch()
+        return keyed
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """导出会话信息"""
+        height, width = self.image.shape[:2]
+        return {
+            'sessionId': self.id,
+            'width': width,
+            'height': height,
+            'bytes': self.nbytes,
+            'keyedCount': self.keyed_count,
+            'createdAt': self.created_at,
+            'lastUsedAt': self.last_used
+        }
+
+
+class KeySessionStore:
+    """抠图会话表（线程安全），超过空闲期限或内存上限时淘汰最久未使用的会话"""
+    
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl: float = 600):
+        """
+        Args:
+            max_bytes: 所有会话占用的内存上限
+            ttl: 会话空闲多少秒后过期
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions: 'OrderedDict[str, KeySession]' = OrderedDict()
+        self._lock = threading.Lock()
+        
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+    
+    @classmethod
+    def from_env(cls) -> 'KeySessionStore':
+        """根据环境变量创建会话表"""
+        return cls(
+            max_bytes=int(os.getenv('KEY_SESSION_MAX_BYTES', 256 * 1024 * 1024)),
+            ttl=float(os.getenv('KEY_SESSION_TTL', 600))
+        )
+    
+    def create(self, image: np.ndarray) -> KeySession:
+        """
+        新建会话
+        
+        Args:
+            image: 解码后的精灵图（BGR格式）
+        
+        Returns:
+            新建的会话
+        
+        Raises:
+            ImageTooLargeError: 整图加中间结果超过会话内存上限
+        """
+        # 中间结果与整图大小相同
+        if image.nbytes * 2 > self.max_bytes:
+            raise ImageTooLargeError(
+                f'图像加中间结果约 {image.nbytes * 2} 字节，超过会话内存上限 {self.max_bytes}'
+            )
+        
+        self._purge_expired()
+        session = KeySession(image)
+        with self._lock:
+            self._sessions[session.id] = session
+            self.created += 1
+        self._trim(keep=session.id)
+        return session
+    
+    def get(self, session_id: str) -> Optional[KeySession]:
+        """查询会话（过期会话会被清理），存在时刷新最近使用时间"""
+        self._purge_expired()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.touch()
+            return session
+    
+    def delete(self, session_id: str) -> bool:
+        """删除会话，返回会话是否存在"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+    
+    def key(self, session: KeySession, rows: int, cols: int, tolerance: int = 50,
+            mode: str = 'green', tracker: Optional[MemoryTracker] = None) -> np.ndarray:
+        """
+        在会话上去除背景（见 KeySession.key），中间结果增加的内存计入上限
+        
+        Returns:
+            裁剪到网格尺寸的整图（BGRA格式）
+        """
+        keyed = session.key(rows, cols, tolerance, mode, tracker)
+        self._trim(keep=session.id)
+        return keyed
+    
+    def stats(self) -> Dict[str, Any]:
+        """导出会话数和占用情况"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            return {
+                'sessions': len(sessions),
+                'bytes': sum(session.nbytes for session in sessions),
+                'maxBytes': self.max_bytes,
+                'ttlSeconds': self.ttl,
+                'created': self.created,
+                'expired': self.expired,
+                'evictions': self.evictions
+            }
+    
+    def _trim(self, keep: str) -> None:
+        """超过内存上限时按最久未使用淘汰其他会话"""
+        with self._lock:
+            total = sum(session.nbytes for session in self._sessions.values())
+            for session_id in list(self._sessions):
+                if total <= self.max_bytes:
+                    break
+                if session_id == keep:
+                    continue
+                total -= self._sessions.pop(session_id).nbytes
+                self.evictions += 1
+    
+    def _purge_expired(self) -> None:
+        """清理超过空闲期限的会话"""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items()
+                       if session.last_used < deadline]
+            for session_id in expired:
+                del self._sessions[session_id]
+            self.expired += len(expired)
@@ -0,0 +1,157 @@
+"""
+指标模块
+按阶段计时，记录延迟直方图、计数器和当前值，并以 Prometheus 文本格式导出
+"""
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional, Tuple
+
+
+# 延迟直方图的桶上界（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 指标名称 -> (类型, 说明)
+METRIC_HELP = {
+    'frameworker_requests_total': ('counter', 'HTTP 请求数（按端点和状态码）'),
+    'frameworker_request_duration_seconds': ('histogram', 'HTTP 请求处理耗时（流式响应只计到开始发送）'),
+    'frameworker_stage_duration_seconds': ('histogram', '各处理阶段耗时'),
+    'frameworker_errors_total': ('counter', '处理失败次数（按异常类型）'),
+    'frameworker_bytes_in_total': ('counter', '请求体字节数'),
+    'frameworker_bytes_out_total': ('counter', '响应体字节数（不含流式响应）'),
+    'frameworker_frames_processed_total': ('counter', '处理的帧数'),
+    'frameworker_admission_active': ('gauge', '正在处理的请求数（生成任务为执行中的任务数）'),
+    'frameworker_admission_queue_depth': ('gauge', '排队等待的请求数'),
+    'frameworker_admission_rejected_total': ('counter', '因过载被拒绝的请求数（按原因）'),
+    'frameworker_upstream_rate_limit_total': ('counter', '上游限速结果（按模型、密钥指纹和结果）')
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class StageTimer:
+    """记录单次请求各阶段的耗时（同名阶段累加，线程安全）"""
+    
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """计时上下文：with timer.stage('key'): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+    
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def server_timing(self) -> str:
+        """Server-Timing 响应头的值（毫秒）"""
+        with self._lock:
+            return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items())
+    
+    def to_dict(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.stages)
+
+
+def timed(timer: Optional[StageTimer], name: str) -> ContextManager:
+    """timer 为None时不计时"""
+    return timer.stage(name) if timer is not None else nullcontext()
+
+
+class MetricsRegistry:
+    """进程内的计数器、当前值和直方图（线程安全）"""
+    
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._values: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, List[float]]] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _label_key(labels: Dict[str, str]) -> LabelKey:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+    
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """计数器加 value"""
+        key = self._label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+    
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """设置当前值（仪表值，或导出时从其他组件的统计中读取的累计值）"""
+        key = self._label_key(labels)
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+    
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """直方图记录一个观测值"""
+        key = self._label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # 各桶计数 + 总和 + 总数
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0.0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+    
+    def record_stages(self, endpoint: str, timer: StageTimer) -> None:
+        """把一次请求的阶段耗时计入 frameworker_stage_duration_seconds"""
+        for stage, seconds in timer.to_dict().items():
+            self.observe('frameworker_stage_duration_seconds', seconds, endpoint=endpoint, stage=stage)
+    
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines: List[str] = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            for name, series in self._values.items():
+                counters.setdefault(name, {}).update(series)
+            histograms = {name: {key: list(values) for key, values in series.items()}
+                          for name, series in self._histograms.items()}
+        
+        for name in sorted(set(counters) | set(histograms)):
+            metric_type, description = METRIC_HELP.get(
+                name, ('histogram' if name in histograms else 'counter', name)
+            )
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            
+            for key, value in sorted(counters.get(name, {}).items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+            
+            for key, values in sorted(histograms.get(name, {}).items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f'{name}_bucket{_format_labels(key, le=_format_value(bound))} '
+                                 f'{_format_value(count)}')
+                lines.append(f'{name}_bucket{_format_labels(key, le="+Inf")} {_format_value(values[-1])}')
+                lines.append(f'{name}_sum{_format_labels(key)} {values[-2]!r}')
+                lines.append(f'{name}_count{_format_labels(key)} {_format_value(values[-1])}')
+        
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(key: LabelKey, **extra: str) -> str:
+    labels = list(key) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,215 @@
+"""
+处理结果缓存模块
+按内容寻址的LRU缓存，保存每帧编码后的图片字节，支持字节预算、磁盘溢出和命中统计
+"""
+import os
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class ResultCache:
+    """按字节预算淘汰的LRU结果缓存（线程安全）"""
+    
+    SPILL_SUFFIX = '.frames'
+    
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None,
+                 spill_max_bytes: int = 0):
+        """
+        Args:
+            max_bytes: 内存预算（字节），0表示禁用缓存
+            spill_dir: 磁盘溢出目录，None表示不溢出
+            spill_max_bytes: 磁盘溢出预算（字节）
+        """
+        self.max_bytes = max_bytes
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir and spill_max_bytes > 0 else None
+        
+        self._entries: 'OrderedDict[str, List[bytes]]' = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._current_bytes = 0
+        self._spilled: 'OrderedDict[str, int]' = OrderedDict()
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.disk_hits = 0
+        
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            # 接管上次运行留下的溢出文件，按修改时间从旧到新
+            files = sorted(self.spill_dir.glob(f'*{self.SPILL_SUFFIX}'),
+                           key=lambda path: path.stat().st_mtime)
+            for path in files:
+                size = path.stat().st_size
+                self._spilled[path.stem] = size
+                self._spilled_bytes += size
+    
+    @classmethod
+    def from_env(cls) -> 'ResultCache':
+        """根据环境变量创建缓存"""
+        return cls(
+            max_bytes=int(os.getenv('IMAGE_CACHE_MAX_BYTES', 128 * 1024 * 1024)),
+            spill_dir=os.getenv('IMAGE_CACHE_SPILL_DIR') or None,
+            spill_max_bytes=int(os.getenv('IMAGE_CACHE_SPILL_MAX_BYTES', 1024 * 1024 * 1024))
+        )
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    def get(self, key: str) -> Optional[List[bytes]]:
+        """
+        查询缓存
+        
+        Args:
+            key: 内容地址
+        
+        Returns:
+            每帧编码后的字节，未命中时返回None
+        """
+        if not self.enabled:
+            return None
+        
+        with self._lock:
+            frames = self._entries.get(key)
+            if frames is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return frames
+            spilled = key in self._spilled
+        
+        if spilled:
+            frames = self._read_spill(key)
+            if frames is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self.put(key, frames)
+                return frames
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key: str, frames: List[bytes]) -> None:
+        """
+        写入缓存，超出预算时淘汰最久未使用的条目
+        
+        Args:
+            key: 内容地址
+            frames: 每帧编码后的字节
+        """
+        if not self.enabled:
+            return
+        
+        size = sum(len(frame) for frame in frames)
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            
+            if size > self.max_bytes:
+                evicted.append((key, frames))
+            else:
+                self._entries[key] = frames
+                self._sizes[key] = size
+                self._current_bytes += size
+                while self._current_bytes > self.max_bytes:
+                    old_key, old_frames = self._entries.popitem(last=False)
+                    self._current_bytes -= self._sizes.pop(old_key)
+                    self.evictions += 1
+                    evicted.append((old_key, old_frames))
+        
+        # 磁盘IO不占用锁
+        for old_key, old_frames in evicted:
+            self._write_spill(old_key, old_frames)
+    
+    def stats(self) -> Dict[str, int]:
+        """导出命中/未命中/淘汰计数和占用情况"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spills': self.spills,
+                'diskHits': self.disk_hits,
+                'entries': len(self._entries),
+                'bytes': self._current_bytes,
+                'maxBytes': self.max_bytes,
+                'spilledEntries': len(self._spilled),
+                'spilledBytes': self._spilled_bytes
+            }
+    
+    def clear(self) -> None:
+        """清空内存中的缓存条目"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._current_bytes = 0
+    
+    def _spill_path(self, key: str) -> Path:
+        return self.spill_dir / f'{key}{self.SPILL_SUFFIX}'  # type: ignore
+    
+    def _write_spill(self, key: str, frames: List[bytes]) -> None:
+        """把淘汰的条目写入磁盘（帧数 + 每帧长度 + 帧数据）"""
+        if not self.spill_dir:
+            return
+        
+        header = struct.pack(f'<I{len(frames)}I', len(frames), *(len(frame) for frame in frames))
+        size = len(header) + sum(len(frame) for frame in frames)
+        if size > self.spill_max_bytes:
+            return
+        
+        path = self._spill_path(key)
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                for frame in frames:
+                    f.write(frame)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'写入缓存溢出文件失败: {e}')
+            return
+        
+        expired = []
+        with self._lock:
+            self._spilled_bytes -= self._spilled.pop(key, 0)
+            self._spilled[key] = size
+            self._spilled_bytes += size
+            self.spills += 1
+            while self._spilled_bytes > self.spill_max_bytes:
+                old_key, old_size = self._spilled.popitem(last=False)
+                self._spilled_bytes -= old_size
+                expired.append(old_key)
+        
+        for old_key in expired:
+            try:
+                self._spill_path(old_key).unlink()
+            except OSError:
+                pass
+    
+    def _read_spill(self, key: str) -> Optional[List[bytes]]:
+        """从磁盘读取溢出的条目"""
+        try:
+            data = self._spill_path(key).read_bytes()
+            (count,) = struct.unpack_from('<I', data)
+            lengths = struct.unpack_from(f'<{count}I', data, 4)
+        except (OSError, struct.error):
+            with self._lock:
+                self._spilled_bytes -= self._spilled.pop(key, 0)
+            return None
+        
+        frames = []
+        offset = 4 + 4 * count
+        for length in lengths:
+            frames.append(data[offset:offset + length])
+            offset += length
+        return frames
@@ -1,16 +1,129 @@
 #!/usr/bin/env python3
 """
 FrameWorker Python 后端启动脚本
+
+开发模式使用 Flask 内置服务器；生产模式（SERVER_MODE=production 或 --mode production）
+使用 gunicorn 多进程服务器（仅支持 Linux/Mac）；异步模式（SERVER_MODE=async 或 --mode async）
+使用 uvicorn 运行 ASGI 应用（asgi_app），AI 生成请求等待上游时不占用线程
 """
 import sys
 import os
+import argparse
+import importlib.util
+from typing import Any, Dict
 
 # 确保可以导入 app 模块
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app import app, PORT
+from app import app, PORT, load_image_processing, start_image_processing
 
-if __name__ == '__main__':
+SERVER_MODES = ('development', 'production', 'async')
+
+
+def server_options() -> Dict[str, Any]:
+    """生产模式的 gunicorn 配置（读取环境变量）"""
+    workers = int(os.getenv('SERVER_WORKERS', 0))
+    return {
+        'bind': f"{os.getenv('SERVER_HOST', '0.0.0.0')}:{PORT}",
+        'workers': workers if workers > 0 else (os.cpu_count() or 1),
+        'worker_class': 'gthread',
+        'threads': int(os.getenv('SERVER_THREADS', 4)),
+        'preload_app': True,
+        # 每个 worker 处理一定请求数后重启，限制内存增长；加抖动避免同时重启
+        'max_requests': int(os.getenv('SERVER_MAX_REQUESTS', 1000)),
+        'max_requests_jitter': int(os.getenv('SERVER_MAX_REQUESTS_JITTER', 100)),
+        # worker 心跳超时（gthread 下长请求不会触发）和收到 SIGTERM 后等待请求完成的时间
+        'timeout': int(os.getenv('SERVER_TIMEOUT', 60)),
+        'graceful_timeout': int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(os.getenv('SERVER_KEEPALIVE', 5)),
+        'accesslog': os.getenv('SERVER_ACCESS_LOG') or None
+    }
+
+
+def run_development() -> None:
+    """Flask 内置服务器（单进程，仅用于开发）"""
     print(f'✓ FrameWorker Python 后端启动在端口 {PORT}')
     print(f'✓ 访问 http://localhost:{PORT}')
-    app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
+    start_image_processing()
+    app.run(host='0.0.0.0', port=PORT, debug=False)
+
+
+def run_production() -> None:
+    """gunicorn 多进程服务器（预先导入应用后 fork worker）"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print('警告: 未安装 gunicorn（Windows 不支持），改用开发服务器')
+        print('请安装依赖: pip install gunicorn')
+        run_development()
+        return
+    
+    class ProductionServer(BaseApplication):
+        def __init__(self, options: Dict[str, Any]):
+            self.options = options
+            super().__init__()
+        
+        def load_config(self) -> None:
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+        
+        def load(self):
+            return app
+    
+    # 在主进程中导入 image_processor / cv2 / numpy，fork 出的 worker 以写时复制方式共享；
+    # 预热（实际调用 OpenCV）在各 worker 中进行
+    if os.getenv('IMAGE_PRELOAD', 'background') != 'lazy':
+        load_image_processing()
+    
+    options = server_options()
+    options['post_worker_init'] = lambda worker: start_image_processing()
+    print(f"✓ FrameWorker Python 后端（生产模式）启动在端口 {PORT}："
+          f"{options['workers']} 个进程 × {options['threads']} 个线程")
+    ProductionServer(options).run()
+
+
+def run_async() -> None:
+    """uvicorn 异步服务器（ASGI）：AI 生成接口在事件循环中处理，其余接口桥接到 Flask"""
+    # httpx 是异步上游客户端，由 asgi_app 在 worker 中导入，这里只检查是否已安装
+    if any(importlib.util.find_spec(name) is None for name in ('uvicorn', 'httpx')):
+        print('警告: 未安装 uvicorn 或 httpx，改用生产模式服务器')
+        print('请安装依赖: pip install uvicorn httpx')
+        run_production()
+        return
+    
+    import uvicorn
+    
+    options = server_options()
+    host, _ = options['bind'].rsplit(':', 1)
+    print(f"✓ FrameWorker Python 后端（异步模式）启动在端口 {PORT}：{options['workers']} 个进程")
+    # 多进程时各 worker 重新导入 asgi_app（不共享主进程导入的模块），图像处理模块在各 worker 的启动阶段加载
+    uvicorn.run(
+        'asgi_app:application',
+        host=host,
+        port=PORT,
+        workers=options['workers'],
+        timeout_keep_alive=options['keepalive'],
+        timeout_graceful_shutdown=options['graceful_timeout'],
+        access_log=bool(options['accesslog']),
+        lifespan='on'
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='FrameWorker Python 后端')
+    parser.add_argument('--mode', choices=SERVER_MODES,
+                        default=os.getenv('SERVER_MODE', 'development'),
+                        help='development=Flask 内置服务器, production=gunicorn 多进程, '
+                             'async=uvicorn 异步服务器（默认读取 SERVER_MODE）')
+    args = parser.parse_args()
+    
+    if args.mode == 'production':
+        run_production()
+    elif args.mode == 'async':
+        run_async()
+    else:
+        run_development()
+
+
+if __name__ == '__main__':
+    main()
@@ -33,4 +33,4 @@ fi
 # 启动服务器
 echo "[3/3] 启动服务器..."
 echo ""
-python3 app.py
\ No newline at end of file
+python3 start.py
\ No newline at end of file
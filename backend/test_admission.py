@@ -0,0 +1,183 @@
+"""
+准入控制（admission）测试：并发上限、有界等待队列、排队期限、异步排队和上游令牌桶
+"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+from admission import ConcurrencyLimiter, Overloaded, RateLimiter
+
+
+def test_acquire_rejects_when_queue_full():
+    limiter = ConcurrencyLimiter('test', 1, max_queue=0)
+    permit = limiter.acquire()
+    with pytest.raises(Overloaded) as excinfo:
+        limiter.acquire()
+    assert excinfo.value.status == 503
+    assert excinfo.value.reason == 'queue_full'
+    assert excinfo.value.retry_after >= 1
+    permit.release()
+    limiter.acquire().release()
+    assert limiter.stats()['rejected'] == {'queue_full': 1, 'queue_timeout': 0}
+
+
+def test_acquire_times_out_in_queue():
+    limiter = ConcurrencyLimiter('test', 1, max_queue=1, queue_timeout=0.1)
+    permit = limiter.acquire()
+    started = time.monotonic()
+    with pytest.raises(Overloaded) as excinfo:
+        limiter.acquire()
+    assert excinfo.value.reason == 'queue_timeout'
+    assert time.monotonic() - started >= 0.1
+    permit.release()
+    assert limiter.stats()['queued'] == 0
+    assert limiter.stats()['active'] == 0
+
+
+def test_release_is_idempotent():
+    limiter = ConcurrencyLimiter('test', 2)
+    permit = limiter.acquire()
+    permit.release()
+    permit.release()
+    assert limiter.stats()['active'] == 0
+
+
+def test_threads_admitted_in_arrival_order():
+    limiter = ConcurrencyLimiter('test', 1, max_queue=10, queue_timeout=5)
+    first = limiter.acquire()
+    order = []
+    
+    def worker(index):
+        permit = limiter.acquire()
+        order.append(index)
+        permit.release()
+    
+    threads = []
+    for index in range(5):
+        thread = threading.Thread(target=worker, args=(index,))
+        thread.start()
+        threads.append(thread)
+        while limiter.stats()['queued'] < index + 1:
+            time.sleep(0.001)
+    first.release()
+    for thread in threads:
+        thread.join()
+    assert order == list(range(5))
+
+
+def test_async_waiters_do_not_use_threads():
+    """数百个异步等待者只在事件循环中排队，按到达顺序获得名额"""
+    limiter = ConcurrencyLimiter('test', 2, max_queue=500, queue_timeout=10)
+    order = []
+    
+    async def worker(index):
+        permit = await limiter.acquire_async()
+        order.append(index)
+        await asyncio.sleep(0)
+        permit.release()
+    
+    async def main():
+        blockers = [limiter.acquire(), limiter.acquire()]
+        threads = threading.active_count()
+        tasks = []
+        for index in range(300):
+            tasks.append(asyncio.ensure_future(worker(index)))
+            await asyncio.sleep(0)
+        assert limiter.stats()['queued'] == 300
+        assert threading.active_count() == threads
+        for permit in blockers:
+            permit.release()
+        await asyncio.gather(*tasks)
+    
+    asyncio.run(main())
+    assert order == list(range(300))
+    assert limiter.stats()['active'] == 0
+
+
+def test_async_acquire_rejects_and_times_out():
+    limiter = ConcurrencyLimiter('test', 1, max_queue=1, queue_timeout=0.1)
+    
+    async def main():
+        permit = await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as full:
+            await limiter.acquire_async()
+        with pytest.raises(Overloaded) as expired:
+            await waiting
+        permit.release()
+        return full.value.reason, expired.value.reason
+    
+    assert asyncio.run(main()) == ('queue_full', 'queue_timeout')
+    stats = limiter.stats()
+    assert stats['rejected'] == {'queue_full': 1, 'queue_timeout': 1}
+    assert (stats['active'], stats['queued']) == (0, 0)
+
+
+def test_async_waiter_gets_permit_released_by_thread():
+    """线程释放的名额转交给事件循环中的等待者"""
+    limiter = ConcurrencyLimiter('test', 1, max_queue=1, queue_timeout=5)
+    permit = limiter.acquire()
+    
+    async def main():
+        threading.Timer(0.05, permit.release).start()
+        return await limiter.acquire_async()
+    
+    granted = asyncio.run(main())
+    assert limiter.stats()['active'] == 1
+    granted.release()
+    assert limiter.stats()['active'] == 0
+
+
+def test_cancelled_async_waiter_does_not_leak_permit():
+    limiter = ConcurrencyLimiter('test', 1, max_queue=2, queue_timeout=5)
+    
+    async def main():
+        permit = await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert limiter.stats()['queued'] == 0
+        
+        # 取消后、等待者恢复运行前名额已转交给它，名额同样归还
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        permit.release()
+        assert limiter.stats()['active'] == 1
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    
+    asyncio.run(main())
+    stats = limiter.stats()
+    assert (stats['active'], stats['queued']) == (0, 0)
+
+
+def test_rate_limiter_allows_burst_then_rejects():
+    limiter = RateLimiter({'model': 60, 'free': 0}, burst=2, max_wait=0.5)
+    assert limiter.reserve('key', 'model') == 0
+    assert limiter.reserve('key', 'model') == 0
+    with pytest.raises(Overloaded) as excinfo:
+        limiter.reserve('key', 'model')
+    assert excinfo.value.status == 429
+    assert excinfo.value.reason == 'rate_limited'
+    assert excinfo.value.retry_after == 1
+    # 密钥和模型分别计数，未配置速率的模型不限制
+    assert limiter.reserve('other', 'model') == 0
+    assert limiter.reserve('key', 'free') == 0
+    assert limiter.reserve('key', 'unknown') == 0
+
+
+def test_rate_limiter_delays_within_max_wait():
+    limiter = RateLimiter({'model': 60}, burst=1, max_wait=1.5)
+    assert limiter.reserve('key', 'model') == 0
+    assert limiter.reserve('key', 'model') == pytest.approx(1.0, abs=0.05)
+    with pytest.raises(Overloaded):
+        limiter.reserve('key', 'model')
+    bucket, = limiter.stats()['buckets']
+    assert (bucket['allowed'], bucket['delayed'], bucket['rejected']) == (1, 1, 1)
+    assert bucket['key'] == RateLimiter.key_id('key')
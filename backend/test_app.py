@@ -0,0 +1,181 @@
+"""
+Flask 应用（app）的接口冒烟测试：每个路由的主要用法都能成功返回，AI 生成使用本地模拟的上游
+"""
+import io
+import json
+import base64
+import zipfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+import app as app_module  # noqa: E402
+
+
+def sprite_sheet_png() -> bytes:
+    """2x4 的绿幕精灵图，最后一帧与第一帧相同"""
+    image = np.zeros((128, 256, 3), np.uint8)
+    image[:] = (40, 200, 60)
+    for index in range(8):
+        row, col = divmod(index, 4)
+        image[row * 64 + 10:row * 64 + 40, col * 64 + 10:col * 64 + 30 + index] = (30, 30, 200)
+    image[64:128, 192:256] = image[0:64, 0:64]
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+PNG = sprite_sheet_png()
+DATA_URL = 'data:image/png;base64,' + base64.b64encode(PNG).decode()
+SHEET = {'image': DATA_URL, 'rows': 2, 'cols': 4}
+
+
+@pytest.fixture(scope='module')
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """返回固定精灵图的 Gemini 接口"""
+    body = json.dumps({'candidates': [{'content': {'parts': [{'inlineData': {
+        'data': base64.b64encode(PNG).decode(), 'mimeType': 'image/png'
+    }}]}}]}).encode()
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app_module, 'AI_IMAGE_API_KEY', 'test-key')
+    monkeypatch.setattr(app_module, 'GEMINI_IMAGE_GEN_URL',
+                        f'http://127.0.0.1:{server.server_address[1]}/generate')
+    yield
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('path, content_type', [
+    ('/api/health', 'application/json'),
+    ('/api/info', 'application/json'),
+    ('/api/cache/stats', 'application/json'),
+    ('/api/admission/stats', 'application/json'),
+    ('/api/metrics', 'text/plain'),
+    ('/', 'text/html'),
+])
+def test_get_routes(client, path, content_type):
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.content_type.startswith(content_type)
+
+
+@pytest.mark.parametrize('query, params, content_type', [
+    ('', {}, 'application/json'),
+    ('?stream=ndjson', {}, 'application/x-ndjson'),
+    ('?stream=sse', {'dedupe': True}, 'text/event-stream'),
+    ('', {'output': 'atlas'}, 'application/json'),
+    ('', {'dedupe': True}, 'application/json'),
+    ('', {'interpolate': 2}, 'application/json'),
+    ('', {'interpolate': 1, 'interpolationMode': 'flow'}, 'application/json'),
+    ('', {'tiled': True}, 'application/json'),
+])
+def test_process_image_json(client, query, params, content_type):
+    response = client.post('/api/process-image' + query, json=dict(SHEET, **params))
+    assert response.status_code == 200, response.get_data()[:200]
+    assert response.content_type.startswith(content_type)
+
+
+def test_process_image_frames_and_etag(client):
+    response = client.post('/api/process-image', json=SHEET)
+    assert response.status_code == 200
+    assert len(response.get_json()['frames']) == 8
+    cached = client.post('/api/process-image', json=SHEET,
+                         headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+    
+    deduped = client.post('/api/process-image', json=dict(SHEET, dedupe=True)).get_json()
+    assert deduped['frameRefs'][7] == deduped['frameRefs'][0]
+
+
+@pytest.mark.parametrize('tiled', ['false', 'true'])
+def test_process_image_binary(client, tiled):
+    response = client.post(f'/api/process-image?rows=2&cols=4&tiled={tiled}', data=PNG,
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.content_type == 'application/zip'
+    names = zipfile.ZipFile(io.BytesIO(response.get_data())).namelist()
+    assert len([name for name in names if name.endswith('.png')]) == 8
+
+
+@pytest.mark.parametrize('animation_format, content_type', [('gif', 'image/gif'),
+                                                            ('webp', 'image/webp')])
+def test_encode_animation(client, animation_format, content_type):
+    response = client.post('/api/encode-animation', json=dict(SHEET, format=animation_format))
+    assert response.status_code == 200
+    assert response.content_type == content_type
+
+
+def test_process_batch(client):
+    response = client.post('/api/process-batch', json={'items': [SHEET, {'image': 'xx'}]})
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert (payload['count'], payload['failed']) == (2, 1)
+
+
+def test_key_session_lifecycle(client):
+    response = client.post('/api/key-sessions', json={'image': DATA_URL})
+    assert response.status_code == 201
+    session = response.get_json()
+    session_url = f"/api/key-sessions/{session['sessionId']}"
+    assert client.get(session_url).status_code == 200
+    for output in ('frames', 'alpha'):
+        keyed = client.post(session['keyUrl'], json={'rows': 2, 'cols': 4, 'tolerance': 30,
+                                                     'output': output})
+        assert keyed.status_code == 200
+    assert client.delete(session_url).status_code == 200
+    assert client.get(session_url).status_code == 404
+
+
+def test_ai_image_key(client, fake_gemini):
+    response = client.get('/api/ai-image-key')
+    assert response.status_code == 200
+    assert response.get_json()['configured'] is True
+
+
+def test_generate_sprite_animation(client, fake_gemini):
+    response = client.post('/api/generate-sprite-animation',
+                           json={'prompt': 'walk cycle', 'frameCount': 4, 'noCache': True})
+    assert response.status_code == 200, response.get_data()[:200]
+    assert len(response.get_json()['frames']) == 4
+
+
+def test_generate_sprite_animation_stream(client, fake_gemini):
+    response = client.post('/api/generate-sprite-animation?stream=ndjson',
+                           json={'prompt': 'walk cycle', 'frameCount': 4, 'noCache': True})
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+    assert events[-1]['event'] == 'done'
+    assert len([event for event in events if event['event'] == 'frame']) == 4
+
+
+def test_generation_job(client, fake_gemini):
+    response = client.post('/api/jobs/generate-sprite-animation',
+                           json={'prompt': 'walk cycle', 'frameCount': 4, 'noCache': True})
+    assert response.status_code == 202
+    status_url = response.get_json()['statusUrl']
+    job = client.get(status_url + '?wait=30')
+    assert job.status_code == 200
+    assert job.get_json()['status'] == 'succeeded'
+    assert client.delete(status_url).status_code == 200
+    assert client.get('/api/jobs/missing').status_code == 404
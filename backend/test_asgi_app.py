@@ -0,0 +1,106 @@
+"""
+异步服务模式（asgi_app）的 WSGI 桥接测试
+"""
+import io
+import asyncio
+import zipfile
+
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('httpx')
+
+from asgi_app import AsyncServer  # noqa: E402
+from app import app  # noqa: E402
+
+
+def sprite_sheet_png() -> bytes:
+    """2x2 的绿幕精灵图"""
+    image = np.zeros((64, 64, 3), np.uint8)
+    image[:] = (0, 255, 0)
+    image[8:24, 8:24] = (0, 0, 200)
+    image[40:56, 40:56] = (200, 0, 0)
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def call_asgi(server: AsyncServer, method: str, path: str, query: bytes,
+              headers, chunks):
+    """以 ASGI 方式调用，请求体按 chunks 分块送达，返回 (状态码, 响应头, 响应体)"""
+    async def run():
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+                    for index, chunk in enumerate(chunks)]
+        disconnected = asyncio.Event()
+        sent = []
+        
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+        
+        async def send(message):
+            sent.append(message)
+        
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'query_string': query, 'headers': headers,
+            'server': ('127.0.0.1', 3000), 'client': ('127.0.0.1', 50000)
+        }
+        await server(scope, receive, send)
+        disconnected.set()
+        return sent
+    
+    sent = asyncio.run(run())
+    start = next(message for message in sent if message['type'] == 'http.response.start')
+    body = b''.join(message.get('body', b'') for message in sent
+                    if message['type'] == 'http.response.body')
+    return start['status'], dict(start['headers']), body
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = AsyncServer(app, cpu_workers=2, wsgi_threads=2)
+    yield server
+    server.cpu_executor.shutdown(wait=False)
+    server.wsgi_executor.shutdown(wait=False)
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_bridge_reads_body_with_or_without_content_length(server, chunked):
+    """分块传输（没有 Content-Length）的请求体与声明长度的请求体结果相同"""
+    png = sprite_sheet_png()
+    headers = [(b'content-type', b'application/octet-stream')]
+    if chunked:
+        headers.append((b'transfer-encoding', b'chunked'))
+        chunks = [png[:100], png[100:]]
+    else:
+        headers.append((b'content-length', str(len(png)).encode()))
+        chunks = [png]
+    
+    status, response_headers, body = call_asgi(server, 'POST', '/api/process-image',
+                                               b'rows=2&cols=2', headers, chunks)
+    assert status == 200, body
+    assert response_headers[b'content-type'] == b'application/zip'
+    names = zipfile.ZipFile(io.BytesIO(body)).namelist()
+    assert names[0] == 'manifest.json'
+    assert len([name for name in names if name.endswith('.png')]) == 4
+
+
+def test_bridge_rejects_declared_oversized_body(server, monkeypatch):
+    """声明的长度超过 MAX_CONTENT_LENGTH 时不读取请求体，由 Flask 返回 413"""
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    headers = [(b'content-type', b'application/octet-stream'), (b'content-length', b'4096')]
+    status, _, _ = call_asgi(server, 'POST', '/api/process-image', b'rows=2&cols=2',
+                             headers, [b'x' * 4096])
+    assert status == 413
+
+
+def test_bridge_rejects_oversized_chunked_body(server, monkeypatch):
+    """分块传输的请求体超过 MAX_CONTENT_LENGTH 时返回 413"""
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    headers = [(b'content-type', b'application/octet-stream'),
+               (b'transfer-encoding', b'chunked')]
+    status, _, _ = call_asgi(server, 'POST', '/api/process-image', b'rows=2&cols=2',
+                             headers, [b'x' * 800, b'x' * 800])
+    assert status == 413
@@ -0,0 +1,96 @@
+"""
+图集打包（atlas）测试：透明区域裁剪、装箱不重叠，以及按描述文件能从图集还原每帧
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from atlas import AtlasPacker  # noqa: E402
+
+
+ROWS, COLS, FRAME_HEIGHT, FRAME_WIDTH = 3, 4, 40, 56
+
+
+@pytest.fixture(scope='module')
+def keyed():
+    """BGRA 整图：每帧一块随机位置和大小的不透明区域，帧 5 全透明，帧 11 与帧 0 相同"""
+    rng = np.random.default_rng(22)
+    sheet = np.zeros((ROWS * FRAME_HEIGHT, COLS * FRAME_WIDTH, 4), np.uint8)
+    sheet[..., :3] = rng.integers(0, 256, sheet.shape[:2] + (3,), dtype=np.uint8)
+    for index in range(ROWS * COLS):
+        if index == 5:
+            continue
+        row, col = divmod(index, COLS)
+        top, left = rng.integers(0, FRAME_HEIGHT - 4), rng.integers(0, FRAME_WIDTH - 4)
+        bottom = rng.integers(top + 1, FRAME_HEIGHT + 1)
+        right = rng.integers(left + 1, FRAME_WIDTH + 1)
+        sheet[row * FRAME_HEIGHT + top:row * FRAME_HEIGHT + bottom,
+              col * FRAME_WIDTH + left:col * FRAME_WIDTH + right, 3] = 255
+    sheet[-FRAME_HEIGHT:, -FRAME_WIDTH:] = sheet[:FRAME_HEIGHT, :FRAME_WIDTH]
+    return sheet
+
+
+def frames_of(sheet):
+    return (sheet.reshape(ROWS, FRAME_HEIGHT, COLS, FRAME_WIDTH, 4)
+            .transpose(0, 2, 1, 3, 4).reshape(ROWS * COLS, FRAME_HEIGHT, FRAME_WIDTH, 4))
+
+
+def test_sheet_trim_bounds_match_per_frame(keyed):
+    frames = frames_of(keyed)
+    bounds = AtlasPacker.sheet_trim_bounds(keyed, ROWS, COLS)
+    assert np.array_equal(bounds, AtlasPacker.trim_bounds(frames))
+    assert bounds[5].tolist() == [0, 0, 1, 1]
+    for frame, (x, y, w, h) in zip(frames, bounds.tolist()):
+        # 包围盒外没有不透明像素，包围盒的每条边上都有
+        alpha = frame[..., 3].copy()
+        inside = alpha[y:y + h, x:x + w].copy()
+        alpha[y:y + h, x:x + w] = 0
+        assert not alpha.any()
+        if inside.any():
+            assert inside[0].any() and inside[-1].any()
+            assert inside[:, 0].any() and inside[:, -1].any()
+
+
+@pytest.mark.parametrize('padding', [0, 2, 5])
+@pytest.mark.parametrize('power_of_two', [False, True])
+def test_pack_without_overlap(padding, power_of_two):
+    rng = np.random.default_rng(padding)
+    sizes = rng.integers(1, 60, (30, 2))
+    positions, (width, height) = AtlasPacker.pack(sizes, padding, power_of_two)
+    rects = np.concatenate([positions, positions + sizes], axis=1)
+    assert (rects[:, 2] <= width).all() and (rects[:, 3] <= height).all()
+    for i in range(len(rects)):
+        for j in range(i + 1, len(rects)):
+            a, b = rects[i], rects[j]
+            separated = (a[2] + padding <= b[0] or b[2] + padding <= a[0] or
+                         a[3] + padding <= b[1] or b[3] + padding <= a[1])
+            assert separated, (a, b)
+    if power_of_two:
+        assert width & (width - 1) == 0 and height & (height - 1) == 0
+
+
+def test_build_and_manifest_restore_frames(keyed):
+    frames = frames_of(keyed)
+    bounds = AtlasPacker.sheet_trim_bounds(keyed, ROWS, COLS)
+    refs = np.arange(len(frames))
+    refs[11] = 0
+    atlas, positions, size = AtlasPacker.build(frames, bounds, padding=2, refs=refs)
+    assert atlas.shape[:2] == (size[1], size[0])
+    assert positions[11].tolist() == positions[0].tolist()
+    
+    names = [f'frame_{index:03d}' for index in range(len(frames))]
+    manifest = AtlasPacker.manifest(names, bounds, positions, (FRAME_WIDTH, FRAME_HEIGHT),
+                                    size, 'atlas.png')
+    assert manifest['meta']['size'] == {'w': size[0], 'h': size[1]}
+    assert manifest['animations']['default'] == names
+    for name, frame in zip(names, frames):
+        entry = manifest['frames'][name]
+        rect, source = entry['frame'], entry['spriteSourceSize']
+        assert entry['sourceSize'] == {'w': FRAME_WIDTH, 'h': FRAME_HEIGHT}
+        # 从图集取出裁剪区域放回原位置，不透明像素与原帧一致
+        restored = np.zeros_like(frame)
+        restored[source['y']:source['y'] + source['h'], source['x']:source['x'] + source['w']] = \
+            atlas[rect['y']:rect['y'] + rect['h'], rect['x']:rect['x'] + rect['w']]
+        opaque = frame[..., 3] > 0
+        assert np.array_equal(restored[..., 3] > 0, opaque)
+        assert np.array_equal(restored[opaque], frame[opaque])
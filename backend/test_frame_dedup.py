@@ -0,0 +1,109 @@
+"""
+重复帧检测（frame_dedup）测试：精确和近似重复的归并，以及去重处理与逐帧处理的结果一致
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+from frame_dedup import FrameDeduplicator  # noqa: E402
+from image_processor import ImageProcessor  # noqa: E402
+
+
+FRAME_SIZE = 48
+
+# 3x4 精灵图中每帧的内容编号：帧 0 在 4、8 重复，帧 1 在 5 重复，帧 2 在 11 重复
+LAYOUT = [0, 1, 2, 3,
+          0, 1, 4, 5,
+          0, 6, 7, 2]
+
+
+def distinct_frame(seed: int) -> np.ndarray:
+    """绿幕上的随机前景块，不同 seed 的帧差异明显"""
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((FRAME_SIZE, FRAME_SIZE, 3), np.uint8)
+    frame[:] = (0, 255, 0)
+    top, left = rng.integers(0, FRAME_SIZE // 2, 2)
+    frame[top:top + FRAME_SIZE // 2, left:left + FRAME_SIZE // 2] = \
+        rng.integers(0, 256, (FRAME_SIZE // 2, FRAME_SIZE // 2, 3), dtype=np.uint8)
+    return frame
+
+
+def sprite_sheet(layout, cols: int = 4) -> np.ndarray:
+    frames = [distinct_frame(index) for index in layout]
+    return np.vstack([np.hstack(frames[start:start + cols])
+                      for start in range(0, len(frames), cols)])
+
+
+def png_bytes(image: np.ndarray) -> bytes:
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def test_exact_duplicates_refer_to_first_occurrence():
+    frames = ImageProcessor.slice_image(sprite_sheet(LAYOUT), 3, 4)
+    refs = FrameDeduplicator.find_duplicates(frames)
+    assert refs.tolist() == [0, 1, 2, 3, 0, 1, 6, 7, 0, 9, 10, 2]
+    unique, positions = FrameDeduplicator.compact(refs)
+    assert unique.tolist() == [0, 1, 2, 3, 6, 7, 9, 10]
+    assert positions == [0, 1, 2, 3, 0, 1, 4, 5, 0, 6, 7, 2]
+
+
+def test_near_duplicates_merge_only_above_zero_threshold():
+    frames = [distinct_frame(0), distinct_frame(0), distinct_frame(1)]
+    # 改动一个像素：精确哈希不同，感知哈希几乎不变
+    frames[1][0, 0] = (0, 250, 0)
+    assert FrameDeduplicator.find_duplicates(frames, 0).tolist() == [0, 1, 2]
+    assert FrameDeduplicator.find_duplicates(frames, 4).tolist() == [0, 0, 2]
+
+
+def test_exact_duplicates_follow_merged_representative():
+    """精确重复的帧随其代表帧一起归并到更早的近似重复帧"""
+    near = distinct_frame(0)
+    near[0, 0] = (0, 250, 0)
+    frames = [distinct_frame(0), near, distinct_frame(1), near.copy()]
+    assert FrameDeduplicator.find_duplicates(frames, 4).tolist() == [0, 0, 2, 0]
+
+
+def test_interpolated_refs():
+    refs = np.array([0, 1, 0, 1])
+    # 插入 1 帧：0, (0,1), 1, (1,0), 0, (0,1), 1
+    assert FrameDeduplicator.interpolated_refs(refs, 1).tolist() == [0, 1, 2, 3, 0, 1, 2]
+    assert FrameDeduplicator.interpolated_refs(refs, 0).tolist() == [0, 1, 0, 1]
+
+
+@pytest.mark.parametrize('mode', ['green', 'auto'])
+def test_key_unique_frames_matches_whole_sheet(mode):
+    """只对不同的帧去背景，每帧结果与整图处理相同，重复帧共用同一个结果"""
+    image = sprite_sheet(LAYOUT)
+    expected = ImageProcessor.slice_image(
+        ImageProcessor.key_sprite_sheet(image, 3, 4, 40, mode), 3, 4)
+    frames, refs = ImageProcessor.key_unique_frames(image, 3, 4, 40, mode)
+    assert len(frames) == len(LAYOUT)
+    for actual, wanted in zip(frames, expected):
+        assert np.array_equal(actual, wanted)
+    assert all(frames[index] is frames[ref] for index, ref in enumerate(refs))
+
+
+@pytest.mark.parametrize('interpolation', [None, {'count': 2, 'mode': 'linear'}])
+def test_dedupe_output_matches_plain_processing(interpolation):
+    """阈值为 0 时去重处理的输出与不去重完全相同，只编码不同的帧"""
+    data = png_bytes(sprite_sheet(LAYOUT))
+    expected = ImageProcessor.process_sprite_sheet_png(data, 3, 4, 40, 'green',
+                                                       interpolation=interpolation)
+    actual = ImageProcessor.process_sprite_sheet_png(data, 3, 4, 40, 'green',
+                                                     interpolation=interpolation, dedupe=0)
+    assert actual == expected
+    encoded, positions = ImageProcessor.process_sprite_sheet_unique(
+        data, 3, 4, 40, 'green', 0, interpolation=interpolation)
+    assert len(positions) == len(expected)
+    assert len(encoded) < len(expected)
+    assert [encoded[position] for position in positions] == expected
+
+
+def test_sheet_without_duplicates_keys_whole_sheet():
+    image = sprite_sheet(range(12))
+    frames, refs = ImageProcessor.key_unique_frames(image, 3, 4, 40, 'green')
+    assert refs.tolist() == list(range(12))
+    expected = ImageProcessor.key_sprite_sheet(image, 3, 4, 40, 'green')
+    assert np.array_equal(np.vstack([np.hstack(frames[row * 4:(row + 1) * 4]) for row in range(3)]),
+                          expected)
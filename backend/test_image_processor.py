@@ -0,0 +1,80 @@
+"""
+图像处理（image_processor）测试：整图去背景与先切割再逐帧处理的结果一致
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+from image_processor import ImageProcessor  # noqa: E402
+
+
+# (高, 宽, 行, 列)：包含无法整除网格的尺寸和很小的帧
+GRIDS = [(256, 256, 4, 4), (250, 390, 3, 5), (512, 256, 8, 2), (64, 96, 1, 1), (6, 8, 3, 4)]
+
+
+def sprite_sheet(height: int, width: int, rows: int, cols: int, seed: int = 1) -> np.ndarray:
+    """
+    绿幕上的随机前景块，帧边缘附近有噪声（检验相邻帧互不渗透），
+    每帧左上角的颜色不同（auto 模式）
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((height, width, 3), np.uint8)
+    image[:] = (0, 255, 0)
+    noise = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    keep = rng.random((height, width)) < 0.3
+    image[keep] = noise[keep]
+    frame_height, frame_width = height // rows, width // cols
+    for row in range(rows):
+        for col in range(cols):
+            top, left = row * frame_height, col * frame_width
+            image[top:top + max(frame_height // 4, 1), left:left + max(frame_width // 4, 1)] = \
+                rng.integers(0, 256, 3, dtype=np.uint8)
+            image[top + frame_height // 3:top + 2 * frame_height // 3,
+                  left + frame_width // 3:left + 2 * frame_width // 3] = \
+                rng.integers(0, 256, 3, dtype=np.uint8)
+    return image
+
+
+def key_per_frame(image: np.ndarray, rows: int, cols: int, tolerance: int, mode: str) -> np.ndarray:
+    """先切割、再逐帧处理，拼回整图"""
+    sheet = ImageProcessor.crop_to_grid(image, rows, cols)
+    frames = [ImageProcessor._key_frame(frame, tolerance, mode, engine='opencv')
+              for frame in ImageProcessor.slice_image(sheet, rows, cols)]
+    return np.vstack([np.hstack(frames[row * cols:(row + 1) * cols]) for row in range(rows)])
+
+
+@pytest.mark.parametrize('height, width, rows, cols', GRIDS)
+@pytest.mark.parametrize('mode', ['green', 'auto', 'none'])
+@pytest.mark.parametrize('tolerance', [0, 30, 50, 100])
+def test_whole_sheet_keying_matches_per_frame(height, width, rows, cols, mode, tolerance):
+    image = sprite_sheet(height, width, rows, cols)
+    expected = key_per_frame(image, rows, cols, tolerance, mode)
+    actual = ImageProcessor.key_sprite_sheet(image, rows, cols, tolerance, mode, engine='opencv')
+    assert actual.shape == expected.shape
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('mode', ['green', 'auto'])
+def test_whole_sheet_keying_with_cached_plane(mode):
+    """使用缓存的 key_plane 调整容差，结果与直接处理相同"""
+    image = sprite_sheet(250, 390, 3, 5)
+    plane = ImageProcessor.key_plane(image, 3, 5, mode)
+    for tolerance in (20, 60):
+        expected = key_per_frame(image, 3, 5, tolerance, mode)
+        actual = ImageProcessor.key_sprite_sheet(image, 3, 5, tolerance, mode, plane=plane)
+        assert np.array_equal(actual, expected)
+
+
+def test_key_frames_into_matches_per_frame():
+    image = sprite_sheet(256, 256, 4, 4)
+    sheet = ImageProcessor.crop_to_grid(image, 4, 4)
+    actual = ImageProcessor.key_frames_into(sheet, 4, 4, 50, 'green', workers=2, engine='opencv')
+    assert np.array_equal(actual, key_per_frame(image, 4, 4, 50, 'green'))
+
+
+def test_plane_with_different_grid_is_rejected():
+    image = sprite_sheet(250, 390, 3, 5)
+    plane = ImageProcessor.key_plane(image, 4, 4, 'auto')
+    with pytest.raises(ValueError):
+        ImageProcessor.key_sprite_sheet(image, 3, 5, 50, 'auto', plane=plane)
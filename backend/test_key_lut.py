@@ -0,0 +1,117 @@
+"""
+查表抠图引擎（key_lut）测试：掩码与 opencv 引擎（cvtColor + inRange）一致
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+from key_lut import KeyLUTCache, resolve_key_engine  # noqa: E402
+from image_processor import ImageProcessor  # noqa: E402
+
+
+TOLERANCES = [0, 20, 50, 100, 255]
+
+
+@pytest.fixture(scope='module')
+def luts():
+    return KeyLUTCache(max_bytes=256 * 1024 * 1024)
+
+
+@pytest.fixture(scope='module')
+def image():
+    """绿幕背景 + 随机颜色的前景，再加一段覆盖绿色附近色相和饱和度的渐变"""
+    rng = np.random.default_rng(20)
+    image = np.zeros((256, 384, 3), np.uint8)
+    image[:] = (0, 255, 0)
+    image[32:224, 32:224] = rng.integers(0, 256, (192, 192, 3), dtype=np.uint8)
+    hsv = np.zeros((256, 128, 3), np.uint8)
+    hsv[..., 0] = np.linspace(20, 100, 128, dtype=np.uint8)[None, :]
+    hsv[..., 1] = np.linspace(0, 255, 256, dtype=np.uint8)[:, None]
+    hsv[..., 2] = rng.integers(0, 256, (256, 128), dtype=np.uint8)
+    image[:, 256:] = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    return image
+
+
+@pytest.fixture(scope='module')
+def sheet(image):
+    """4x4 的精灵图，每帧的背景色不同（auto 模式）"""
+    rng = np.random.default_rng(7)
+    sheet = np.tile(image[:64, 240:336], (4, 4, 1))
+    for row in range(4):
+        for col in range(4):
+            cell = sheet[row * 64:(row + 1) * 64, col * 96:(col + 1) * 96]
+            cell[:8] = rng.integers(0, 256, 3, dtype=np.uint8)
+    return sheet
+
+
+def opencv_green_mask(image, tolerance):
+    lower, upper = ImageProcessor._green_hsv_bounds(tolerance)
+    return cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), lower, upper)
+
+
+@pytest.mark.parametrize('tolerance', TOLERANCES)
+def test_green_mask_matches_opencv(luts, image, tolerance):
+    lower, upper = ImageProcessor._green_hsv_bounds(tolerance)
+    mask = luts.green_mask(image, lower, upper)
+    assert np.array_equal(mask, opencv_green_mask(image, tolerance))
+
+
+def test_green_mask_accepts_views(luts, image):
+    """切片得到的帧视图（不连续内存）与连续副本结果相同"""
+    lower, upper = ImageProcessor._green_hsv_bounds(50)
+    view = image[10:200, 20:300]
+    assert not view.flags['C_CONTIGUOUS']
+    assert np.array_equal(luts.green_mask(view, lower, upper), opencv_green_mask(view, 50))
+
+
+@pytest.mark.parametrize('tolerance', [20, 50, 100])
+def test_quantized_green_mask_within_tolerance(image, tolerance):
+    """量化位数小于 8 时只有少量边缘像素不同"""
+    luts = KeyLUTCache(bits=6)
+    lower, upper = ImageProcessor._green_hsv_bounds(tolerance)
+    mask = luts.green_mask(image, lower, upper)
+    mismatch = np.count_nonzero(mask != opencv_green_mask(image, tolerance)) / mask.size
+    assert mismatch < 0.01
+
+
+@pytest.mark.parametrize('tolerance', TOLERANCES)
+def test_remove_green_background_engines_match(image, tolerance):
+    expected = ImageProcessor.remove_green_background(image, tolerance, engine='opencv')
+    actual = ImageProcessor.remove_green_background(image, tolerance, engine='lut')
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('mode', ['green', 'auto'])
+@pytest.mark.parametrize('tolerance', [10, 50, 100])
+def test_key_sprite_sheet_engines_match(sheet, mode, tolerance):
+    expected = ImageProcessor.key_sprite_sheet(sheet, 4, 4, tolerance, mode, engine='opencv')
+    actual = ImageProcessor.key_sprite_sheet(sheet, 4, 4, tolerance, mode, engine='lut')
+    assert np.array_equal(actual, expected)
+
+
+def test_tables_are_cached_and_evicted():
+    table_bytes = 1 << 24
+    luts = KeyLUTCache(max_bytes=table_bytes * 2)
+    bounds = [ImageProcessor._green_hsv_bounds(tolerance) for tolerance in (10, 20, 30)]
+    first = luts.green_table(*bounds[0])
+    assert luts.green_table(*bounds[0]) is first
+    for lower, upper in bounds[1:]:
+        luts.green_table(lower, upper)
+    stats = luts.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1)
+    assert (stats['entries'], stats['bytes']) == (2, table_bytes * 2)
+    # 最早使用的表已被淘汰，重新建表
+    assert luts.green_table(*bounds[0]) is not first
+
+
+def test_resolve_key_engine(monkeypatch):
+    monkeypatch.delenv('IMAGE_KEY_ENGINE', raising=False)
+    assert resolve_key_engine() == 'opencv'
+    monkeypatch.setenv('IMAGE_KEY_ENGINE', 'lut')
+    assert resolve_key_engine() == 'lut'
+    assert resolve_key_engine('opencv') == 'opencv'
+    with pytest.raises(ValueError):
+        resolve_key_engine('simd')
+    with pytest.raises(ValueError):
+        KeyLUTCache(bits=4)
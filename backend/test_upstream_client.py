@@ -0,0 +1,227 @@
+"""
+上游客户端（upstream_client）测试：重试、对冲和上游速率限制，使用本地 HTTP 服务模拟上游
+"""
+import json
+import time
+import asyncio
+import functools
+import threading
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from admission import Overloaded, RateLimiter
+import upstream_client
+from upstream_client import AsyncUpstreamClient, UpstreamClient
+
+
+class FakeUpstream:
+    """按顺序返回预设响应的本地 HTTP 服务，每个响应为 (状态码, 延迟秒数)"""
+    
+    def __init__(self):
+        self.responses = []
+        self.requests = 0
+        self._lock = threading.Lock()
+        upstream = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with upstream._lock:
+                    upstream.requests += 1
+                    status, delay = (upstream.responses.pop(0) if upstream.responses
+                                     else (200, 0))
+                time.sleep(delay)
+                body = json.dumps({'status': status}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/generate'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_upstream():
+    upstream = FakeUpstream()
+    yield upstream
+    upstream.close()
+
+
+def make_client(**kwargs):
+    options = dict(max_retries=3, backoff_base=0.01, timeouts={'model': (1, 5)})
+    options.update(kwargs)
+    return UpstreamClient(**options)
+
+
+def rate_limit(burst):
+    """每分钟 1 次、可突发 burst 次的令牌桶（测试期间不会补充令牌）"""
+    limiter = RateLimiter({'model': 1}, burst=burst, max_wait=0)
+    return limiter, functools.partial(limiter.reserve, 'key', 'model')
+
+
+def hedging_client():
+    """已有耗时样本、阈值很短的对冲客户端"""
+    client = make_client(hedge_enabled=True, hedge_min_delay=0.1, hedge_min_samples=1)
+    client.latency.record('model', 0.01)
+    return client
+
+
+def run_async(client, call):
+    async def main():
+        async_client = AsyncUpstreamClient(client, pool_size=4)
+        try:
+            return await call(async_client)
+        finally:
+            await async_client.aclose()
+    return asyncio.run(main())
+
+
+def test_retries_until_success(fake_upstream):
+    fake_upstream.responses = [(503, 0), (502, 0)]
+    client = make_client()
+    response = client.post('model', fake_upstream.url, json={})
+    assert response.status_code == 200
+    assert fake_upstream.requests == 3
+    assert client.stats()['retries'] == 2
+
+
+def test_each_retry_takes_a_token(fake_upstream):
+    """重试同样消耗令牌，令牌用完后不再重试，返回最后一次的响应"""
+    fake_upstream.responses = [(503, 0)] * 4
+    limiter, limit = rate_limit(burst=2)
+    response = make_client().post('model', fake_upstream.url, rate_limit=limit, json={})
+    assert response.status_code == 503
+    assert fake_upstream.requests == 2
+    bucket, = limiter.stats()['buckets']
+    assert (bucket['allowed'], bucket['rejected']) == (2, 1)
+
+
+def test_first_request_without_token_is_rejected(fake_upstream):
+    _, limit = rate_limit(burst=1)
+    client = make_client()
+    assert client.post('model', fake_upstream.url, rate_limit=limit, json={}).ok
+    with pytest.raises(Overloaded) as excinfo:
+        client.post('model', fake_upstream.url, rate_limit=limit, json={})
+    assert excinfo.value.status == 429
+    assert fake_upstream.requests == 1
+
+
+@pytest.mark.parametrize('burst, expected_requests', [(1, 1), (2, 2)])
+def test_hedge_takes_a_token(fake_upstream, burst, expected_requests):
+    """令牌不足时不发出对冲请求，只等待主请求"""
+    fake_upstream.responses = [(200, 0.4), (200, 0)]
+    _, limit = rate_limit(burst)
+    client = hedging_client()
+    response = client.post('model', fake_upstream.url, rate_limit=limit, json={})
+    assert response.ok
+    assert fake_upstream.requests == expected_requests
+    assert client.stats()['hedges'] == expected_requests - 1
+
+
+def test_async_each_retry_takes_a_token(fake_upstream):
+    pytest.importorskip('httpx')
+    fake_upstream.responses = [(503, 0)] * 4
+    _, limit = rate_limit(burst=2)
+    response = run_async(make_client(), lambda client: client.post(
+        'model', fake_upstream.url, rate_limit=limit, json={}))
+    assert response.status_code == 503
+    assert fake_upstream.requests == 2
+
+
+@pytest.mark.parametrize('burst, expected_requests', [(1, 1), (2, 2)])
+def test_async_hedge_takes_a_token(fake_upstream, burst, expected_requests):
+    pytest.importorskip('httpx')
+    fake_upstream.responses = [(200, 0.4), (200, 0)]
+    _, limit = rate_limit(burst)
+    client = hedging_client()
+    response = run_async(client, lambda async_client: async_client.post(
+        'model', fake_upstream.url, rate_limit=limit, json={}))
+    assert response.is_success
+    assert fake_upstream.requests == expected_requests
+    assert client.stats()['hedges'] == expected_requests - 1
+
+
+class StubResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+
+def stub_attempts(client, statuses, delays):
+    """让主请求和对冲请求依次返回 statuses 中的状态码（各自延迟 delays 秒）"""
+    responses = []
+    calls = iter(range(len(statuses)))
+    
+    def attempt(*args, **kwargs):
+        index = next(calls)
+        time.sleep(delays[index])
+        responses.append(StubResponse(statuses[index]))
+        return responses[-1]
+    
+    client._with_retries = attempt
+    return responses
+
+
+@pytest.mark.parametrize('statuses', [(503, 200), (200, 503)])
+def test_hedge_prefers_success_when_both_finish_together(monkeypatch, statuses):
+    """主请求和对冲请求在同一轮结束时返回成功的响应，失败的响应被关闭"""
+    # 等所有请求都结束后才返回，两个请求总在同一轮
+    monkeypatch.setattr(upstream_client, 'wait', lambda futures, timeout=None, return_when=None:
+                        concurrent.futures.wait(futures, timeout=timeout))
+    client = hedging_client()
+    responses = stub_attempts(client, statuses, delays=(0.3, 0))
+    response = client.post('model', 'http://upstream.invalid/generate', json={})
+    assert response.status_code == 200
+    assert [r.closed for r in responses if r is not response] == [True]
+    assert client.stats()['hedgeWins'] == (1 if statuses == (503, 200) else 0)
+
+
+def test_hedge_returns_failure_only_when_both_fail():
+    client = hedging_client()
+    responses = stub_attempts(client, (503, 500), delays=(0.3, 0))
+    response = client.post('model', 'http://upstream.invalid/generate', json={})
+    assert response.status_code in (503, 500)
+    assert not response.closed
+    assert sum(r.closed for r in responses) == 1
+
+
+@pytest.mark.parametrize('statuses', [(503, 200), (200, 503)])
+def test_async_hedge_prefers_success_when_both_finish_together(monkeypatch, statuses):
+    httpx = pytest.importorskip('httpx')
+    original_wait = asyncio.wait
+    
+    async def wait_all(futures, timeout=None, return_when=None):
+        return await original_wait(futures, timeout=timeout)
+    
+    monkeypatch.setattr(asyncio, 'wait', wait_all)
+    client = hedging_client()
+    calls = iter([(statuses[0], 0.3), (statuses[1], 0)])
+    
+    async def attempt(*args, **kwargs):
+        status, delay = next(calls)
+        await asyncio.sleep(delay)
+        return httpx.Response(status)
+    
+    async def call(async_client):
+        async_client._with_retries = attempt
+        return await async_client.post('model', 'http://upstream.invalid/generate', json={})
+    
+    response = run_async(client, call)
+    assert response.status_code == 200
@@ -0,0 +1,486 @@
+"""
+上游 HTTP 客户端模块
+连接池大小、按模型区分的连接/读取超时、429/5xx 抖动退避重试，以及可选的对冲请求；
+异步服务模式下使用基于 httpx 的 AsyncUpstreamClient，策略与同步客户端相同
+"""
+import os
+import re
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, Optional, Set, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+try:
+    import httpx
+except ImportError:  # 只有异步服务模式需要
+    httpx = None  # type: ignore
+
+from admission import Overloaded
+
+
+# 各模型默认的 (连接超时, 读取超时)，单位秒
+DEFAULT_TIMEOUTS: Dict[str, Tuple[float, float]] = {
+    'dalle': (5, 120),
+    'gemini-2.5-image': (5, 90),
+    'gemini-2.5-image-preview': (5, 90),
+    'gemini-3-pro-image-preview': (5, 180)
+}
+FALLBACK_TIMEOUT: Tuple[float, float] = (5, 120)
+
+# 需要重试的状态码
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 读取超时和连接中断后可以重发的方法；生成请求（POST）不幂等且按次计费，只在请求未发出时重试
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# 上游速率限制回调：参数为最长等待秒数（None 表示限速器的默认值），返回发出请求前需要等待的秒数，
+# 令牌不足时抛出 Overloaded（见 admission.RateLimiter.reserve）
+RateLimit = Callable[[Optional[float]], float]
+
+# 上游请求异常（同步和异步客户端）
+UPSTREAM_ERRORS: Tuple[type, ...] = (requests.exceptions.RequestException,)
+if httpx is not None:
+    UPSTREAM_ERRORS += (httpx.HTTPError,)
+
+
+def _request_not_sent(e: Exception) -> bool:
+    """连接阶段就失败（连接超时、连接被拒绝、等不到连接池连接），请求没有到达上游"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        # requests 把连接被拒绝包装为 ConnectionError(MaxRetryError(reason=NewConnectionError))
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    if httpx is not None:
+        return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+    return False
+
+
+def _env_name(model: str) -> str:
+    """模型名转为环境变量后缀，如 gemini-2.5-image -> GEMINI_2_5_IMAGE"""
+    return re.sub(r'[^A-Z0-9]+', '_', model.upper()).strip('_')
+
+
+class LatencyTracker:
+    """按模型记录最近的请求耗时，用于计算对冲阈值"""
+    
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+    
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=self.window))
+            samples.append(seconds)
+    
+    def percentile(self, model: str, percentile: float, min_samples: int) -> Optional[float]:
+        """样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(int(len(samples) * percentile / 100), len(samples) - 1)
+        return samples[index]
+
+
+class UpstreamClient:
+    """带重试和对冲的上游 HTTP 客户端（线程安全）"""
+    
+    def __init__(self, pool_size: int = 8, proxy_url: Optional[str] = None,
+                 max_retries: int = 2, backoff_base: float = 1.0, backoff_max: float = 20.0,
+                 hedge_enabled: bool = False, hedge_percentile: float = 95,
+                 hedge_min_delay: float = 10.0, hedge_min_samples: int = 20,
+                 timeouts: Optional[Dict[str, Tuple[float, float]]] = None):
+        """
+        Args:
+            pool_size: 每个主机的连接池大小（应不小于并发生成任务数）
+            proxy_url: 代理地址
+            max_retries: 最大重试次数；429/5xx 总是重试，POST 只在请求未发出（连接失败）时重试，
+                         读取超时不重试（生成请求按次计费且耗时长），GET 还会重试读取超时和连接中断
+            backoff_base: 退避基数（秒），第 n 次重试等待 [0, base * 2^n] 内的随机时间
+            backoff_max: 单次退避上限（秒）
+            hedge_enabled: 是否启用对冲请求
+            hedge_percentile: 耗时超过该模型最近请求的此百分位时发出对冲请求
+            hedge_min_delay: 对冲前至少等待的秒数
+            hedge_min_samples: 样本数不足时不对冲
+            timeouts: 各模型的 (连接超时, 读取超时)
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.latency = LatencyTracker()
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if proxy_url:
+            self.session.proxies = {
+                'http': proxy_url,
+                'https': proxy_url
+            }
+        
+        self._hedge_executor = ThreadPoolExecutor(max_workers=pool_size,
+                                                  thread_name_prefix='upstream-hedge')
+        self._lock = threading.Lock()
+        self.stats_counters = {'requests': 0, 'retries': 0, 'hedges': 0, 'hedgeWins': 0}
+    
+    @classmethod
+    def from_env(cls, proxy_url: Optional[str] = None, workers: int = 4) -> 'UpstreamClient':
+        """
+        根据环境变量创建客户端
+        
+        Args:
+            proxy_url: 代理地址
+            workers: 并发生成任务数，用于确定默认连接池大小
+        """
+        hedge_enabled = os.getenv('UPSTREAM_HEDGE_ENABLED', 'false').lower() == 'true'
+        default_pool = workers * (2 if hedge_enabled else 1)
+        
+        connect_timeout = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', FALLBACK_TIMEOUT[0]))
+        timeouts = {}
+        for model, (_, read_timeout) in DEFAULT_TIMEOUTS.items():
+            read_timeout = float(os.getenv(f'UPSTREAM_READ_TIMEOUT_{_env_name(model)}', read_timeout))
+            timeouts[model] = (connect_timeout, read_timeout)
+        
+        return cls(
+            pool_size=int(os.getenv('UPSTREAM_POOL_SIZE', default_pool)),
+            proxy_url=proxy_url,
+            max_retries=int(os.getenv('UPSTREAM_MAX_RETRIES', 2)),
+            backoff_base=float(os.getenv('UPSTREAM_BACKOFF_BASE', 1.0)),
+            backoff_max=float(os.getenv('UPSTREAM_BACKOFF_MAX', 20.0)),
+            hedge_enabled=hedge_enabled,
+            hedge_percentile=float(os.getenv('UPSTREAM_HEDGE_PERCENTILE', 95)),
+            hedge_min_delay=float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY', 10.0)),
+            hedge_min_samples=int(os.getenv('UPSTREAM_HEDGE_MIN_SAMPLES', 20)),
+            timeouts=timeouts
+        )
+    
+    def timeout_for(self, model: str) -> Tuple[float, float]:
+        """模型的 (连接超时, 读取超时)"""
+        return self.timeouts.get(model, FALLBACK_TIMEOUT)
+    
+    def post(self, model: str, url: str, rate_limit: Optional[RateLimit] = None,
+             **kwargs: Any) -> requests.Response:
+        """
+        发送 POST 请求（重试 + 可选对冲）
+        
+        Args:
+            model: 模型名称，决定超时和耗时统计
+            url: 请求地址
+            rate_limit: 上游速率限制，每次实际发出的请求（包括重试和对冲）各取一个令牌；
+                        重试时令牌不足则不再重试，对冲时令牌不足则不发出对冲请求
+            **kwargs: 传给 requests 的其他参数（json、headers 等）
+        
+        Returns:
+            最终响应（重试用尽时为最后一次的响应，由调用方 raise_for_status）
+        
+        Raises:
+            Overloaded: 第一次请求就取不到令牌（429）
+        """
+        return self._hedged(model, 'POST', url, kwargs, rate_limit)
+    
+    def get(self, model: str, url: str, **kwargs: Any) -> requests.Response:
+        """发送 GET 请求（重试，不对冲）"""
+        return self._with_retries(model, 'GET', url, kwargs)
+    
+    def stats(self) -> Dict[str, Any]:
+        """请求、重试和对冲计数"""
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.stats_counters)
+        stats['hedgeEnabled'] = self.hedge_enabled
+        return stats
+    
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats_counters[name] += 1
+    
+    def _backoff(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """抖动退避时间，优先使用 Retry-After"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    try:
+                        delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                        return min(max(delay, 0), self.backoff_max)
+                    except (TypeError, ValueError):
+                        pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    def _with_retries(self, model: str, method: str, url: str, kwargs: Dict[str, Any],
+                      rate_limit: Optional[RateLimit] = None,
+                      reserved: bool = False) -> requests.Response:
+        """reserved 为 True 时第一次请求的令牌已由调用方取得"""
+        kwargs.setdefault('timeout', self.timeout_for(model))
+        if rate_limit is not None and not reserved:
+            time.sleep(rate_limit(None))
+        attempt = 0
+        while True:
+            self._count('requests')
+            started = time.monotonic()
+            response: Optional[requests.Response] = None
+            error: Optional[Exception] = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                retryable = method in IDEMPOTENT_METHODS or _request_not_sent(e)
+                if attempt >= self.max_retries or not retryable:
+                    raise
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    if response.ok:
+                        self.latency.record(model, time.monotonic() - started)
+                    return response
+            
+            delay = self._backoff(attempt, response)
+            if rate_limit is not None:
+                # 重试同样消耗令牌，令牌不足时不再重试，返回本次的结果
+                try:
+                    delay = max(delay, rate_limit(None))
+                except Overloaded:
+                    if response is None:
+                        raise error from None  # type: ignore
+                    return response
+            if response is not None:
+                response.close()
+            print(f'上游请求失败（{response.status_code if response is not None else "连接错误"}），'
+                  f'{delay:.1f} 秒后重试 ({attempt + 1}/{self.max_retries})')
+            time.sleep(delay)
+            attempt += 1
+            self._count('retries')
+    
+    def _hedged(self, model: str, method: str, url: str, kwargs: Dict[str, Any],
+                rate_limit: Optional[RateLimit] = None) -> requests.Response:
+        threshold = None
+        if self.hedge_enabled:
+            threshold = self.latency.percentile(model, self.hedge_percentile, self.hedge_min_samples)
+        if threshold is None:
+            return self._with_retries(model, method, url, kwargs, rate_limit)
+        
+        delay = max(threshold, self.hedge_min_delay)
+        primary = self._hedge_executor.submit(self._with_retries, model, method, url, dict(kwargs),
+                                              rate_limit)
+        done, _ = wait([primary], timeout=delay)
+        if done or not _reserve_now(rate_limit):
+            return primary.result()
+        
+        # 主请求耗时超过阈值，发出对冲请求，取先成功返回的一个
+        self._count('hedges')
+        hedge = self._hedge_executor.submit(self._with_retries, model, method, url, dict(kwargs),
+                                            rate_limit, True)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        # 失败的响应先保留，两个请求都没有成功时返回它
+        fallback: Optional[Tuple[Any, requests.Response]] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner: Optional[Tuple[Any, requests.Response]] = None
+            # 同一轮可能两个请求都已结束，优先取成功的响应
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if response.ok and winner is None:
+                    winner = (future, response)
+                elif not response.ok and fallback is None:
+                    fallback = (future, response)
+                else:
+                    response.close()
+            if winner is not None:
+                if fallback is not None:
+                    fallback[1].close()
+                # 落后的请求在后台结束后丢弃
+                for loser in pending:
+                    loser.add_done_callback(_close_response)
+                break
+        else:
+            if fallback is None:
+                raise error  # type: ignore
+            winner = fallback
+        
+        if winner[0] is hedge:
+            self._count('hedgeWins')
+        return winner[1]
+
+
+def _reserve_now(rate_limit: Optional[RateLimit]) -> bool:
+    """不等待地取一个令牌（对冲请求用），令牌不足时返回 False"""
+    if rate_limit is None:
+        return True
+    try:
+        rate_limit(0)
+    except Overloaded:
+        return False
+    return True
+
+
+def _close_response(future) -> None:
+    """关闭被丢弃的对冲响应"""
+    try:
+        future.result().close()
+    except Exception:
+        pass
+
+
+class AsyncUpstreamClient:
+    """
+    UpstreamClient 的异步版本（httpx 连接池）：等待上游时不占用线程
+    
+    超时、重试、退避和对冲策略取自同步客户端，请求计数和耗时统计也与其共用
+    """
+    
+    def __init__(self, policy: UpstreamClient, pool_size: int = 256,
+                 proxy_url: Optional[str] = None):
+        """
+        Args:
+            policy: 提供超时、重试和对冲配置的同步客户端
+            pool_size: 连接池大小（应不小于同时等待上游的请求数）
+            proxy_url: 代理地址
+        """
+        if httpx is None:
+            raise RuntimeError('异步服务模式需要 httpx: pip install httpx')
+        self.policy = policy
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            proxy=proxy_url,
+            follow_redirects=True  # 与 requests 一致（DALL-E 图片链接可能重定向）
+        )
+    
+    async def post(self, model: str, url: str, rate_limit: Optional[RateLimit] = None,
+                   **kwargs: Any) -> 'httpx.Response':
+        """发送 POST 请求（重试 + 可选对冲），见 UpstreamClient.post"""
+        return await self._hedged(model, 'POST', url, kwargs, rate_limit)
+    
+    async def get(self, model: str, url: str, **kwargs: Any) -> 'httpx.Response':
+        """发送 GET 请求（重试，不对冲）"""
+        return await self._with_retries(model, 'GET', url, kwargs)
+    
+    async def aclose(self) -> None:
+        await self.client.aclose()
+    
+    async def _with_retries(self, model: str, method: str, url: str, kwargs: Dict[str, Any],
+                            rate_limit: Optional[RateLimit] = None,
+                            reserved: bool = False) -> 'httpx.Response':
+        connect_timeout, read_timeout = self.policy.timeout_for(model)
+        kwargs.setdefault('timeout', httpx.Timeout(read_timeout, connect=connect_timeout))
+        policy = self.policy
+        if rate_limit is not None and not reserved:
+            await asyncio.sleep(rate_limit(None))
+        attempt = 0
+        while True:
+            policy._count('requests')
+            started = time.monotonic()
+            response: Optional[httpx.Response] = None
+            error: Optional[Exception] = None
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except (httpx.NetworkError, httpx.TimeoutException) as e:
+                retryable = method in IDEMPOTENT_METHODS or _request_not_sent(e)
+                if attempt >= policy.max_retries or not retryable:
+                    raise
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= policy.max_retries:
+                    if response.is_success:
+                        policy.latency.record(model, time.monotonic() - started)
+                    return response
+            
+            delay = policy._backoff(attempt, response)  # type: ignore
+            if rate_limit is not None:
+                # 重试同样消耗令牌，令牌不足时不再重试，返回本次的结果
+                try:
+                    delay = max(delay, rate_limit(None))
+                except Overloaded:
+                    if response is None:
+                        raise error from None  # type: ignore
+                    return response
+            if response is not None:
+                await response.aclose()
+            print(f'上游请求失败（{response.status_code if response is not None else "连接错误"}），'
+                  f'{delay:.1f} 秒后重试 ({attempt + 1}/{policy.max_retries})')
+            await asyncio.sleep(delay)
+            attempt += 1
+            policy._count('retries')
+    
+    async def _hedged(self, model: str, method: str, url: str, kwargs: Dict[str, Any],
+                      rate_limit: Optional[RateLimit] = None) -> 'httpx.Response':
+        policy = self.policy
+        threshold = None
+        if policy.hedge_enabled:
+            threshold = policy.latency.percentile(model, policy.hedge_percentile,
+                                                  policy.hedge_min_samples)
+        if threshold is None:
+            return await self._with_retries(model, method, url, kwargs, rate_limit)
+        
+        delay = max(threshold, policy.hedge_min_delay)
+        primary = asyncio.ensure_future(self._with_retries(model, method, url, dict(kwargs),
+                                                           rate_limit))
+        pending: Set[asyncio.Future] = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+            if not _reserve_now(rate_limit):
+                return await primary
+            
+            # 主请求耗时超过阈值，发出对冲请求，取先成功返回的一个
+            policy._count('hedges')
+            hedge = asyncio.ensure_future(self._with_retries(model, method, url, dict(kwargs),
+                                                             rate_limit, True))
+            pending.add(hedge)
+            error: Optional[BaseException] = None
+            # 失败的响应先保留，两个请求都没有成功时返回它
+            fallback: Optional[Tuple[asyncio.Future, httpx.Response]] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner: Optional[Tuple[asyncio.Future, httpx.Response]] = None
+                # 同一轮可能两个请求都已结束，优先取成功的响应
+                for task in done:
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    if response.is_success and winner is None:
+                        winner = (task, response)
+                    elif not response.is_success and fallback is None:
+                        fallback = (task, response)
+                    else:
+                        await response.aclose()
+                if winner is not None:
+                    if fallback is not None:
+                        await fallback[1].aclose()
+                    break
+            else:
+                if fallback is None:
+                    raise error  # type: ignore
+                winner = fallback
+            
+            if winner[0] is hedge:
+                policy._count('hedgeWins')
+            return winner[1]
+        finally:
+            # 落后的请求（或调用方被取消时的全部请求）直接取消
+            for task in pending:
+                task.cancel()